@@ -1,18 +1,48 @@
+import threading
 import uuid
 
 import requests
 from flask import Flask, g, request
 from jwt_validation.exceptions import ValidationFailure
 from jwt_validation.validate import validate
+from requests.adapters import HTTPAdapter
+from storage_api.dependencies import token_validation
 from storage_api.exceptions import ApplicationError
+from urllib3.util.retry import Retry
 
 app = Flask(__name__)
 
 app.config.from_pyfile("config.py")
 
 
+_adapter = None
+_adapter_lock = threading.Lock()
+
+
+def get_adapter():
+    """Returns the transport adapter shared by every request's session, so connections to other services are
+    pooled and kept open to be reused"""
+    global _adapter
+    with _adapter_lock:
+        if _adapter is None:
+            retry = Retry(total=app.config['HTTP_RETRIES'], backoff_factor=app.config['HTTP_RETRY_BACKOFF'],
+                          status_forcelist=(502, 503, 504), raise_on_status=False)
+            _adapter = HTTPAdapter(pool_connections=app.config['HTTP_POOL_CONNECTIONS'],
+                                   pool_maxsize=app.config['HTTP_POOL_SIZE'], max_retries=retry)
+        return _adapter
+
+
 class RequestsSessionTimeout(requests.Session):
-    """Custom requests session class to set some defaults on g.requests"""
+    """Custom requests session class to set some defaults on g.requests. Its calls are made through the shared
+    adapter, so each request has a session of its own but not a connection pool of its own"""
+
+    def __init__(self):
+        super(RequestsSessionTimeout, self).__init__()
+        adapter = get_adapter()
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        if not app.config['HTTP_KEEP_ALIVE']:
+            self.headers['Connection'] = 'close'
 
     def request(self, *args, **kwargs):
         # Set a default timeout for the request.
@@ -23,6 +53,10 @@ class RequestsSessionTimeout(requests.Session):
 
         return super(RequestsSessionTimeout, self).request(*args, **kwargs)
 
+    def close(self):
+        # The shared adapter's connections are left open for the sessions of other requests
+        self.adapters.clear()
+
 
 @app.before_request
 def before_request():
@@ -38,8 +72,11 @@ def before_request():
         raise ApplicationError("Missing Authorization header", "AUTH1", 401)
 
     try:
-        validate(app.config['AUTHENTICATION_API_URL'] + '/authentication/validate',
-                 request.headers['Authorization'], g.requests)
+        # Tokens already validated, or whose signature can be verified locally, aren't sent to authentication-api
+        if not token_validation.is_valid(request.headers['Authorization']):
+            validate(app.config['AUTHENTICATION_API_URL'] + '/authentication/validate',
+                     request.headers['Authorization'], g.requests)
+            token_validation.add_valid(request.headers['Authorization'])
     except ValidationFailure as fail:
         raise ApplicationError(fail.message, "AUTH1", 401)
 
@@ -0,0 +1,185 @@
+import asyncio
+import collections
+import contextvars
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from storage_api.main import app
+
+
+class AsgiApplication(object):
+    """Serves a WSGI app to an ASGI server, such as uvicorn, from one event loop.
+
+    The app, and each read of its response, runs in a bounded pool of threads and the response is sent from the
+    event loop between reads. A connection only has a thread while the app is working on it, so a slow client
+    waiting on a download holds a coroutine rather than a thread. Blocking storage, clamd and authentication
+    calls all happen in the pool, and no more than max_workers run at the same time.
+
+    The app runs in a context of its own for each request, so Flask's request context is kept from one read of
+    the response to the next even though they may run in different threads. The request body is read from the
+    server by the thread the app is running in, as the app asks for it.
+    """
+
+    def __init__(self, wsgi_app, max_workers):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=max(max_workers, 1), thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError('Unsupported ASGI scope type - {}'.format(scope['type']))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        context = contextvars.Context()
+        lock = threading.Lock()
+        body = RequestBody(receive, loop)
+        response = {}
+        # Data the app gives to write, which is sent ahead of anything its response yields after it
+        written = collections.deque()
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('started'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+            return write
+
+        def write(data):
+            written.append(bytes(data))
+
+        def call(func, *args):
+            # Calls for a request are made one at a time, in its own context. The lock keeps a call from starting
+            # while one abandoned by a cancelled request is still running in the pool
+            def run():
+                with lock:
+                    return context.run(func, *args)
+            return loop.run_in_executor(self.executor, run)
+
+        def read(iterator):
+            # The next chunk of the response, or None once it has all been read. Data written while the app
+            # works on a chunk goes ahead of it, as it would have been sent first
+            if not written:
+                chunk = next(iterator, None)
+                if not written:
+                    return chunk
+                if chunk is not None:
+                    written.append(chunk)
+            return written.popleft()
+
+        iterable = await call(self.wsgi_app, get_environ(scope, body), start_response)
+        disconnected = None
+        try:
+            iterator = await call(iter, iterable)
+            chunk = await call(read, iterator)
+            # The app has stopped reading the request, so the server can be watched for the client going away
+            body.detach()
+            disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+
+            response['started'] = True
+            await send({'type': 'http.response.start', 'status': response['status'],
+                        'headers': response['headers']})
+            while chunk is not None and not disconnected.done():
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await call(read, iterator)
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if disconnected is not None:
+                disconnected.cancel()
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                await call(close)
+
+
+class RequestBody(io.RawIOBase):
+    """Read-only, unseekable file over the body of an ASGI request, for the WSGI app to read from its thread"""
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b''
+        self._more_body = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer and self._more_body and self._receive is not None:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect':
+                # Ends the body early, which the app sees as the client disconnecting
+                self._more_body = False
+                break
+            self._buffer = message.get('body', b'')
+            self._more_body = message.get('more_body', False)
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def detach(self):
+        """Stops the body being read from the server, so nothing else is waiting on it"""
+        self._receive = None
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+def get_environ(scope, body):
+    """Returns the WSGI environ for an ASGI HTTP scope, with body as its input"""
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BufferedReader(body),
+        # The body ends where the server says it does, so it can be read without a Content-Length
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+        environ['REMOTE_PORT'] = str(scope['client'][1])
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+
+# For an ASGI server, such as uvicorn storage_api.asgi:application
+application = AsgiApplication(app, app.config['ASGI_THREADS'])
@@ -0,0 +1,139 @@
+import json
+import os
+
+from flask import current_app, request
+from storage_api.concurrency import ordered_prefetch, with_current_context
+from storage_api.dependencies.storage.zip_stream import ZipMember, ZipStream
+from storage_api.exceptions import ApplicationError
+from werkzeug.http import dump_options_header
+
+# Status of each file of a batch download
+FOUND = 'found'
+NOT_FOUND = 'not_found'
+FAILED = 'failed'
+
+# Member of a batch download archive giving the status of each requested file
+MANIFEST_NAME = 'manifest.json'
+
+
+def get_batch_files():
+    """Returns the (file_id, subdirectories) of each file listed in the body of a batch request, such as
+    {"files": [{"file_id": "...", "subdirectories": "..."}]}"""
+    body = request.get_json(silent=True)
+    files = body.get('files') if isinstance(body, dict) else None
+    if not isinstance(files, list) or not files or not all(is_batch_file(file) for file in files):
+        raise ApplicationError("Invalid batch request", 400, 400)
+    if len(files) > current_app.config['BATCH_MAX_FILES']:
+        raise ApplicationError("Too many files in batch request", 400, 400)
+    return [(file['file_id'], file.get('subdirectories')) for file in files]
+
+
+def is_batch_file(file):
+    if not isinstance(file, dict) or not isinstance(file.get('file_id'), str) or not file['file_id']:
+        return False
+    subdirectories = file.get('subdirectories')
+    if subdirectories is not None and not isinstance(subdirectories, str):
+        return False
+    # Both are echoed in the response, including in the headers of multipart downloads
+    return file['file_id'].isprintable() and (subdirectories or '').isprintable()
+
+
+def get_batch_reference(file_id, subdirectories):
+    reference = {"file_id": file_id}
+    if subdirectories is not None:
+        reference["subdirectories"] = subdirectories
+    return reference
+
+
+def get_reference(bucket, file_id, subdirectories):
+    """Returns the reference of a file, as given when it was saved"""
+    if subdirectories is not None:
+        return "{}/{}?subdirectories={}".format(bucket, file_id, subdirectories)
+    return "{}/{}".format(bucket, file_id)
+
+
+def fetch_files(storage_location, bucket, files, concurrency):
+    """Gets each (file_id, subdirectories) in files from the storage type, up to concurrency at a time, yielding
+    (file_id, subdirectories, stored_item, status) in the order of files. stored_item is None unless status is
+    FOUND, and is only fetched shortly before it is needed so only a few files are open at once."""
+    def fetch(file):
+        file_id, subdirectories = file
+        try:
+            stored_item = storage_location.get_file(bucket, file_id, subdirectories)
+        except Exception as ex:
+            current_app.logger.exception('Failed to get {} for a batch download. Exception - {}'.format(file_id, ex))
+            return file_id, subdirectories, None, FAILED
+        if stored_item is None or stored_item.file is None:
+            return file_id, subdirectories, None, NOT_FOUND
+        return file_id, subdirectories, stored_item, FOUND
+
+    return ordered_prefetch(with_current_context(fetch), files, concurrency)
+
+
+def zip_files(results):
+    """Returns a ZipStream of the files found by fetch_files, each named by its subdirectories, file_id and file
+    name, followed by a MANIFEST_NAME member giving the status of every requested file"""
+    def members():
+        manifest = []
+        names = set()
+        try:
+            for file_id, subdirectories, stored_item, status in results:
+                entry = dict(get_batch_reference(file_id, subdirectories), status=status)
+                if stored_item is not None:
+                    entry["name"] = get_member_name(file_id, subdirectories, stored_item)
+                    if entry["name"] in names:
+                        # Requested more than once, the archive only needs it once
+                        stored_item.file.close()
+                    else:
+                        names.add(entry["name"])
+                        yield ZipMember(entry["name"], iter_chunks(stored_item), stored_item.last_modified)
+                manifest.append(entry)
+        finally:
+            results.close()
+        yield ZipMember(MANIFEST_NAME, [json.dumps({"files": manifest}).encode()], None)
+
+    return ZipStream(members())
+
+
+def multipart_files(results, boundary):
+    """Generates a multipart/mixed body with a part for each file requested from fetch_files, in order. Each
+    part's X-Status header gives the status of the file, only found files have any content"""
+    try:
+        for file_id, subdirectories, stored_item, status in results:
+            headers = [('X-File-Id', file_id)]
+            if subdirectories is not None:
+                headers.append(('X-Subdirectories', subdirectories))
+            headers.append(('X-Status', status))
+            if stored_item is not None:
+                headers.append(('Content-Type', stored_item.meta_type or 'application/octet-stream'))
+                headers.append(('Content-Disposition', dump_options_header(
+                    'attachment', {'filename': get_file_name(file_id, stored_item)})))
+            header_lines = ''.join('{}: {}\r\n'.format(name, value) for name, value in headers)
+            yield '--{}\r\n{}\r\n'.format(boundary, header_lines).encode()
+            if stored_item is not None:
+                yield from iter_chunks(stored_item)
+            yield b'\r\n'
+        yield '--{}--\r\n'.format(boundary).encode()
+    finally:
+        results.close()
+
+
+def get_member_name(file_id, subdirectories, stored_item):
+    directories = subdirectories.split(',') if subdirectories else []
+    return '/'.join(directories + [file_id, get_file_name(file_id, stored_item)])
+
+
+def get_file_name(file_id, stored_item):
+    # The file storage type names items by their path
+    return os.path.basename(stored_item.file_name or file_id)
+
+
+def iter_chunks(stored_item):
+    try:
+        while True:
+            chunk = stored_item.file.read(stored_item.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        stored_item.file.close()
@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Every cache registered by name, so their statistics can be reported together
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def register_cache(name, cache):
+    """Adds a cache to those reported by get_cache_stats, replacing any already registered with the name"""
+    with _caches_lock:
+        _caches[name] = cache
+    return cache
+
+
+def get_cache_stats():
+    with _caches_lock:
+        caches = dict(_caches)
+    return {name: cache.stats() for name, cache in caches.items()}
+
+
+class LRUCache(object):
+    """Thread safe in-process cache that evicts the least recently used entry once it holds max_size entries.
+
+    Entries expire ttl seconds after they are added, unless put is given a ttl for the entry. A ttl of None
+    means entries only leave the cache when evicted or removed.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+            return default
+
+    def put(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        if self.max_size <= 0 or (ttl is not None and ttl <= 0):
+            return
+        with self._lock:
+            self._entries[key] = (value, None if ttl is None else time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def remove(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
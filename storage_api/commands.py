@@ -0,0 +1,20 @@
+import click
+from flask.cli import with_appcontext
+from storage_api.dependencies.storage.file_storage_adapter import \
+    FileStorageAdapter
+
+
+@click.command('rebuild-file-index')
+@click.argument('bucket', required=False)
+@with_appcontext
+def rebuild_file_index(bucket):
+    """Index every file held by the file storage type, optionally for a single bucket."""
+    indexed = FileStorageAdapter.get_index().rebuild(bucket)
+    click.echo("Indexed {} files".format(indexed))
+
+
+def register_commands(app):
+    """Adds all CLI commands into the app."""
+    app.cli.add_command(rebuild_file_index)
+
+    app.logger.info("Commands registered")
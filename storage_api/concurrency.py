@@ -0,0 +1,74 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, g, has_request_context, request
+
+
+def ordered_prefetch(func, items, max_workers, memory_budget=None, cost=None):
+    """Calls func on each item using a bounded pool of workers, yielding the results in the order of items.
+
+    Work runs ahead of whatever is consuming the results, but no more than max_workers calls are in flight
+    and, if memory_budget is given, the cost of the items in flight or waiting to be consumed is kept within
+    it. An item costing more than the whole budget is only started once everything before it is consumed.
+
+    The pool uses threads, which become green threads when gunicorn's eventlet worker has monkey patched
+    threading, so this suits blocking I/O with either worker class.
+    """
+    items = iter(items)
+    pending = deque()
+    pending_cost = 0
+    next_item = None
+    exhausted = False
+
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        try:
+            while True:
+                while not exhausted and len(pending) < max(max_workers, 1):
+                    if next_item is None:
+                        try:
+                            item = next(items)
+                        except StopIteration:
+                            exhausted = True
+                            break
+                        next_item = (item, cost(item) if cost is not None else 0)
+                    item, item_cost = next_item
+                    if memory_budget is not None and pending and pending_cost + item_cost > memory_budget:
+                        break
+                    pending.append((executor.submit(func, item), item_cost))
+                    pending_cost += item_cost
+                    next_item = None
+
+                if not pending:
+                    return
+
+                future, item_cost = pending.popleft()
+                result = future.result()
+                pending_cost -= item_cost
+                yield result
+        finally:
+            # Don't leave work running if the consumer stops early
+            for future, item_cost in pending:
+                future.cancel()
+
+
+def with_current_context(func):
+    """Wraps func to run with the current app, a request context for the current request and the same values in
+    g, so it can be run by another thread. Flask contexts belong to the thread they are pushed in, so a worker
+    has none of them.
+
+    The worker's request is a new one for the same WSGI environ, so func can read things like the path and headers
+    but not the body. Sharing the request itself would close its files when the worker's context ends.
+    """
+    app = current_app._get_current_object()
+    values = {name: g.get(name) for name in g}
+    environ = request.environ if has_request_context() else None
+
+    def run(*args, **kwargs):
+        with app.app_context():
+            for name, value in values.items():
+                setattr(g, name, value)
+            if environ is None:
+                return func(*args, **kwargs)
+            with app.request_context(environ):
+                return func(*args, **kwargs)
+    return run
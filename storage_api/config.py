@@ -4,6 +4,16 @@ FLASK_LOG_LEVEL = os.environ['LOG_LEVEL']
 
 COMMIT = os.environ['COMMIT']
 DEFAULT_TIMEOUT = int(os.environ['DEFAULT_TIMEOUT'])
+# Most connections kept open to each host by the connection pool shared by requests for calls to other services
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+# Most hosts the shared connection pool keeps connections open to
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "10"))
+# Whether connections to other services are kept open to be reused by later calls
+HTTP_KEEP_ALIVE = os.getenv("HTTP_KEEP_ALIVE", "True").lower() == "true"
+# Times a call to another service is retried after failing to connect, or getting a 502, 503 or 504 for a GET
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+# Backoff factor for the seconds waited between retries, which double with each retry
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.1"))
 
 APP_NAME = os.environ['APP_NAME']
 
@@ -13,15 +23,85 @@ STORAGE_TYPE = os.environ['STORAGE_TYPE']
 # Location the API will use for storage, either local or S3
 FILE_STORAGE_LOCATION = os.environ['FILE_STORAGE_LOCATION']
 
+# Location of the file_id index used by the file storage type, defaults to a hidden folder in FILE_STORAGE_LOCATION
+FILE_INDEX_LOCATION = os.getenv("FILE_INDEX_LOCATION", os.path.join(FILE_STORAGE_LOCATION, ".index"))
+# Whether a file missing from the index is searched for on disk. Can be disabled once the index has been rebuilt
+FILE_INDEX_SCAN_ON_MISS = os.getenv("FILE_INDEX_SCAN_ON_MISS", "True").lower() == "true"
+
+# Whether identical uploads are stored once under the hash of their content, with each file_id referring to it
+STORAGE_DEDUPLICATION = os.getenv("STORAGE_DEDUPLICATION", "False").lower() == "true"
+# Location the file storage type keeps deduplicated content in, defaults to a hidden folder in FILE_STORAGE_LOCATION.
+# Files are hard links to the content, so it has to be on the same filesystem as FILE_STORAGE_LOCATION
+FILE_CONTENT_LOCATION = os.getenv("FILE_CONTENT_LOCATION", os.path.join(FILE_STORAGE_LOCATION, ".content"))
+
 AUTHENTICATION_API_URL = os.environ['AUTHENTICATION_API_URL']
 AUTHENTICATION_API_ROOT = os.environ['AUTHENTICATION_API_ROOT']
+# Most successful token validations cached by a hash of the token, 0 validates every request with authentication-api
+JWT_VALIDATION_CACHE_SIZE = int(os.getenv("JWT_VALIDATION_CACHE_SIZE", "10000"))
+# Seconds a successful validation is cached for, never beyond the token's exp
+JWT_VALIDATION_CACHE_TTL = int(os.getenv("JWT_VALIDATION_CACHE_TTL", "300"))
+# JSON Web Key Set of the keys tokens are signed with. When set, RS256, RS384 and RS512 tokens are verified locally
+# instead of by authentication-api
+JWT_SIGNING_KEYS_URL = os.getenv("JWT_SIGNING_KEYS_URL")
+# Seconds the signing keys are cached for before they are fetched again
+JWT_SIGNING_KEYS_TTL = int(os.getenv("JWT_SIGNING_KEYS_TTL", "3600"))
+# iss and aud a token verified locally must have, either is not checked when not set
+JWT_ISSUER = os.getenv("JWT_ISSUER")
+JWT_AUDIENCE = os.getenv("JWT_AUDIENCE")
 
 MAX_HEALTH_CASCADE = os.environ['MAX_HEALTH_CASCADE']
 
 FILE_EXTERNAL_URL_BASE = os.environ['FILE_EXTERNAL_URL_BASE']
 
+# Whether generated directory archives are cached, on local disk and for S3 external URLs in S3 under temp/
+ARCHIVE_CACHE_ENABLED = os.getenv("ARCHIVE_CACHE_ENABLED", "False").lower() == "true"
+# Location of the local disk archive cache, defaults to a hidden folder in FILE_STORAGE_LOCATION
+ARCHIVE_CACHE_LOCATION = os.getenv("ARCHIVE_CACHE_LOCATION", os.path.join(FILE_STORAGE_LOCATION, ".archives"))
+# Most bytes of archives kept in the local disk cache, the least recently used are removed first
+ARCHIVE_CACHE_MAX_SIZE = int(os.getenv("ARCHIVE_CACHE_MAX_SIZE", str(1024 * 1024 * 1024)))
+# Seconds a cached archive is used for before it is generated again
+ARCHIVE_CACHE_TTL = int(os.getenv("ARCHIVE_CACHE_TTL", "3600"))
+
+# How files from the file storage type are served, either stream, sendfile, x-sendfile or x-accel-redirect
+FILE_SERVE_MODE = os.getenv("FILE_SERVE_MODE", "stream")
+# Internal nginx location that maps on to FILE_STORAGE_LOCATION, used when FILE_SERVE_MODE is x-accel-redirect
+FILE_ACCEL_REDIRECT_LOCATION = os.getenv("FILE_ACCEL_REDIRECT_LOCATION", "/protected-storage")
+
+# How uploads are read, either buffered (the whole request is parsed before any file is saved) or stream (each
+# file is saved as it is read from the request)
+UPLOAD_INGESTION_MODE = os.getenv("UPLOAD_INGESTION_MODE", "buffered")
+# Most bytes of a streamed upload held in memory before it is written to a temporary file, where one is needed
+UPLOAD_MEMORY_THRESHOLD = int(os.getenv("UPLOAD_MEMORY_THRESHOLD", str(1024 * 1024)))
+# Most files of an upload request scanned and saved at the same time
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "4"))
+# Most bytes accepted in a request body, larger requests get a 413. Unset accepts any size
+MAX_CONTENT_LENGTH = int(os.environ["MAX_CONTENT_LENGTH"]) if os.getenv("MAX_CONTENT_LENGTH") else None
+
+# Most files a batch request can list
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "10000"))
+# Most files of a batch download fetched at the same time, ahead of the one being sent
+BATCH_DOWNLOAD_CONCURRENCY = int(os.getenv("BATCH_DOWNLOAD_CONCURRENCY", "8"))
+
+# Most threads storage_api.asgi runs the app in, each working on one request at a time between reads of its response
+ASGI_THREADS = int(os.getenv("ASGI_THREADS", "32"))
+
+# clamd listening on TCP, used for virus scanning instead of CLAMD_SOCKET if both are set
 CLAMD_HOST = os.getenv("CLAMD_HOST")
 CLAMD_PORT = int(os.getenv("CLAMD_PORT", "0"))
+# Unix socket of clamd, the LocalSocket in clamd.conf
+CLAMD_SOCKET = os.getenv("CLAMD_SOCKET", "/var/run/clamd.scan/clamd.sock")
+# Most connections to clamd kept open for scanning, each scans one file at a time
+CLAMD_POOL_SIZE = int(os.getenv("CLAMD_POOL_SIZE", "4"))
+# Seconds a scan can take, including waiting for a free connection, before it fails
+CLAMD_TIMEOUT = float(os.getenv("CLAMD_TIMEOUT", "60"))
+# Seconds a clamd connection can be idle before it is checked with a PING before being reused
+CLAMD_HEALTH_CHECK_INTERVAL = float(os.getenv("CLAMD_HEALTH_CHECK_INTERVAL", "10"))
+# Most scan verdicts cached by content hash, 0 scans every file
+CLAMD_VERDICT_CACHE_SIZE = int(os.getenv("CLAMD_VERDICT_CACHE_SIZE", "10000"))
+# Seconds a scan verdict is cached for
+CLAMD_VERDICT_CACHE_TTL = int(os.getenv("CLAMD_VERDICT_CACHE_TTL", "3600"))
+# Seconds between checks of the clamd signature database version, which cached verdicts are only used with
+CLAMD_VERSION_CHECK_INTERVAL = float(os.getenv("CLAMD_VERSION_CHECK_INTERVAL", "60"))
 
 DEPENDENCIES = {
     'authentication-api': AUTHENTICATION_API_ROOT
@@ -29,6 +109,58 @@ DEPENDENCIES = {
 
 S3_BUCKET = os.environ['S3_BUCKET']
 S3_URL_EXPIRE_IN_SECONDS = os.environ['S3_URL_EXPIRE_IN_SECONDS']
+# Whether deleting checks the file exists first, so a missing file gets a 404 at the cost of an extra request
+S3_DELETE_CHECK_EXISTS = os.getenv("S3_DELETE_CHECK_EXISTS", "True").lower() == "true"
+# Most S3 requests made at the same time for the files of a batch request
+S3_BATCH_CONCURRENCY = int(os.getenv("S3_BATCH_CONCURRENCY", "8"))
+# Most presigned URLs cached, 0 signs a new URL every time
+S3_PRESIGNED_URL_CACHE_SIZE = int(os.getenv("S3_PRESIGNED_URL_CACHE_SIZE", "10000"))
+# Fraction of S3_URL_EXPIRE_IN_SECONDS a cached presigned URL is reused for
+S3_PRESIGNED_URL_REUSE_FRACTION = float(os.getenv("S3_PRESIGNED_URL_REUSE_FRACTION", "0.5"))
+# Size in bytes from which files are uploaded to S3 in parts
+S3_MULTIPART_THRESHOLD = int(os.getenv("S3_MULTIPART_THRESHOLD", str(64 * 1024 * 1024)))
+# Size in bytes of each part of a multipart upload, at least 5MiB
+S3_MULTIPART_CHUNKSIZE = int(os.getenv("S3_MULTIPART_CHUNKSIZE", str(16 * 1024 * 1024)))
+# Most parts of a multipart upload sent at once
+S3_MULTIPART_CONCURRENCY = int(os.getenv("S3_MULTIPART_CONCURRENCY", "8"))
+# Most S3 keys whose metadata is cached, 0 looks up the metadata every time
+S3_METADATA_CACHE_SIZE = int(os.getenv("S3_METADATA_CACHE_SIZE", "10000"))
+# Seconds the metadata of an S3 key is cached for
+S3_METADATA_CACHE_TTL = int(os.getenv("S3_METADATA_CACHE_TTL", "300"))
+# Seconds an S3 key that doesn't exist is cached as missing for
+S3_METADATA_CACHE_NEGATIVE_TTL = int(os.getenv("S3_METADATA_CACHE_NEGATIVE_TTL", "5"))
+# How S3 objects are downloaded, either stream (sent to the client as they are read) or buffer (read into memory first)
+S3_DOWNLOAD_MODE = os.getenv("S3_DOWNLOAD_MODE", "stream")
+# Size in bytes of the chunks S3 objects are streamed in
+S3_STREAM_CHUNK_SIZE = int(os.getenv("S3_STREAM_CHUNK_SIZE", str(64 * 1024)))
+# Number of objects fetched at the same time when zipping an S3 directory, 1 fetches them one at a time
+S3_ZIP_CONCURRENCY = int(os.getenv("S3_ZIP_CONCURRENCY", "8"))
+# Most bytes of fetched objects held in memory while zipping an S3 directory
+S3_ZIP_MEMORY_BUDGET = int(os.getenv("S3_ZIP_MEMORY_BUDGET", str(64 * 1024 * 1024)))
+# Most connections to S3 kept open for reuse. By default enough for a zip, batch download, multipart upload and
+# batch request to all be making as many requests as they can at the same time
+S3_POOL_CONNECTIONS = int(os.getenv("S3_POOL_CONNECTIONS", str(sum((S3_ZIP_CONCURRENCY, BATCH_DOWNLOAD_CONCURRENCY,
+                                                                    S3_MULTIPART_CONCURRENCY, S3_BATCH_CONCURRENCY)))))
+
+# Whether log lines are written to stdout by a background thread, so requests don't wait on a slow stdout
+LOG_QUEUE_ENABLED = os.getenv("LOG_QUEUE_ENABLED", "False").lower() == "true"
+# Most log lines waiting to be written while LOG_QUEUE_ENABLED
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# What happens to a log line when LOG_QUEUE_SIZE lines are already waiting, either drop or block
+LOG_QUEUE_OVERFLOW = os.getenv("LOG_QUEUE_OVERFLOW", "drop")
+
+if LOG_QUEUE_ENABLED:
+    _log_handler = {
+        '()': 'storage_api.extensions.QueueingStreamHandler',
+        'stream': 'ext://sys.stdout',
+        'max_size': LOG_QUEUE_SIZE,
+        'overflow': LOG_QUEUE_OVERFLOW
+    }
+else:
+    _log_handler = {
+        'class': 'logging.StreamHandler',
+        'stream': 'ext://sys.stdout'
+    }
 
 LOGCONFIG = {
     'version': 1,
@@ -47,18 +179,8 @@ LOGCONFIG = {
         }
     },
     'handlers': {
-        'console': {
-            'class': 'logging.StreamHandler',
-            'formatter': 'simple',
-            'filters': ['contextual'],
-            'stream': 'ext://sys.stdout'
-        },
-        'audit_console': {
-            'class': 'logging.StreamHandler',
-            'formatter': 'audit',
-            'filters': ['contextual'],
-            'stream': 'ext://sys.stdout'
-        }
+        'console': dict(_log_handler, formatter='simple', filters=['contextual']),
+        'audit_console': dict(_log_handler, formatter='audit', filters=['contextual'])
     },
     'loggers': {
         'storage_api': {
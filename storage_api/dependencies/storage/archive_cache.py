@@ -0,0 +1,146 @@
+import hashlib
+import io
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+
+from storage_api.model.storage_item import StorageItem
+
+
+def listing_fingerprint(entries):
+    """Returns a fingerprint of a directory listing, given (name, size, version) for each entry.
+
+    version is whatever changes when the content of an entry changes, such as an S3 ETag or a modified time.
+    """
+    content_hash = hashlib.sha256()
+    for name, size, version in sorted(entries):
+        content_hash.update('{}\0{}\0{}\n'.format(name, size, version).encode())
+    return content_hash.hexdigest()
+
+
+class ArchiveCache(object):
+    """Local disk cache of generated directory archives, keyed by a fingerprint of the directory listing.
+
+    Archives are written to the cache as they are streamed to the first client that asks for them. Archives
+    older than ttl seconds are never used, and the least recently used archives are removed once the cache
+    holds more than max_size bytes.
+    """
+
+    ARCHIVE_EXTENSION = '.zip'
+
+    def __init__(self, location, max_size, ttl):
+        self.location = location
+        self.max_size = max_size
+        self.ttl = ttl
+
+    def archive_path(self, fingerprint):
+        return os.path.join(self.location, fingerprint + self.ARCHIVE_EXTENSION)
+
+    def get(self, fingerprint):
+        """Returns the cached archive opened for reading, or None if there isn't a fresh one"""
+        path = self.archive_path(fingerprint)
+        try:
+            archive = io.open(path, 'rb')
+        except OSError:
+            return None
+
+        stat = os.fstat(archive.fileno())
+        if self.is_expired(stat):
+            archive.close()
+            self._remove(path)
+            return None
+
+        # The access time orders archives for eviction, the modified time is when the archive was created
+        try:
+            os.utime(path, (time.time(), stat.st_mtime))
+        except OSError:
+            pass
+        return archive
+
+    def get_item(self, fingerprint, name):
+        """Returns the cached archive as a StorageItem, or None if there isn't a fresh one"""
+        archive = self.get(fingerprint)
+        if archive is None:
+            return None
+        stat = os.fstat(archive.fileno())
+        return StorageItem(archive, "application/zip", name, size=stat.st_size,
+                           last_modified=datetime.fromtimestamp(stat.st_mtime, timezone.utc))
+
+    def store(self, fingerprint, chunks):
+        """Returns an iterator over chunks that also writes them to the cache.
+
+        The archive is only added to the cache once every chunk has been read, so a client that disconnects
+        part way through doesn't leave a partial archive behind.
+        """
+        return _CachingStream(self, fingerprint, chunks)
+
+    def is_expired(self, stat):
+        return self.ttl is not None and time.time() - stat.st_mtime > self.ttl
+
+    def evict(self):
+        """Removes expired archives, then the least recently used ones until the cache is within max_size"""
+        archives = []
+        for entry in os.scandir(self.location):
+            if not entry.name.endswith(self.ARCHIVE_EXTENSION):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if self.is_expired(stat):
+                self._remove(entry.path)
+            else:
+                archives.append((stat.st_atime, stat.st_size, entry.path))
+
+        total_size = sum(size for accessed, size, path in archives)
+        for accessed, size, path in sorted(archives):
+            if self.max_size is None or total_size <= self.max_size:
+                break
+            self._remove(path)
+            total_size -= size
+
+    def _add(self, fingerprint, temp_path):
+        os.replace(temp_path, self.archive_path(fingerprint))
+        self.evict()
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class _CachingStream(object):
+
+    def __init__(self, cache, fingerprint, chunks):
+        self.cache = cache
+        self.fingerprint = fingerprint
+        self.chunks = chunks
+        self._iterator = None
+
+    def __iter__(self):
+        if self._iterator is None:
+            self._iterator = self._generate()
+        return self._iterator
+
+    def close(self):
+        if self._iterator is not None:
+            self._iterator.close()
+        close_chunks = getattr(self.chunks, 'close', None)
+        if close_chunks is not None:
+            close_chunks()
+
+    def _generate(self):
+        os.makedirs(self.cache.location, exist_ok=True)
+        # Written under a temporary name and renamed so readers never see a partially written archive
+        temp_path = '{}.{}.tmp'.format(self.cache.archive_path(self.fingerprint), uuid.uuid4().hex)
+        try:
+            with io.open(temp_path, 'wb') as archive:
+                for chunk in self.chunks:
+                    archive.write(chunk)
+                    yield chunk
+            self.cache._add(self.fingerprint, temp_path)
+        finally:
+            self.cache._remove(temp_path)
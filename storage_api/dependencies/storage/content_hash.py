@@ -0,0 +1,33 @@
+import hashlib
+
+CHUNK_SIZE = 64 * 1024
+
+
+def new_content_hash():
+    """Returns the hash used to fingerprint stored content, which is also the ETag of the stored file"""
+    return hashlib.sha256()
+
+
+def copy_and_hash(source, destination):
+    """Copies the source stream to the destination stream, returning the content hash of what was copied"""
+    content_hash = new_content_hash()
+    while True:
+        chunk = source.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        content_hash.update(chunk)
+        destination.write(chunk)
+    return content_hash.hexdigest()
+
+
+def hash_stream(stream):
+    """Returns the content hash of a seekable stream, leaving it where it started"""
+    position = stream.tell()
+    content_hash = new_content_hash()
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        content_hash.update(chunk)
+    stream.seek(position)
+    return content_hash.hexdigest()
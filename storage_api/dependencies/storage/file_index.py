@@ -0,0 +1,131 @@
+import json
+import os
+import uuid
+
+
+class FileIndex(object):
+    """On-disk index mapping (bucket, subdirectories, file_id) to the stored file.
+
+    Every indexed file has a small JSON entry at <index>/<bucket>/<subdirectories...>/<file_id>.json
+    holding the file's path relative to the storage location, so finding a file is a single read instead
+    of a walk over the bucket. Entries live on disk so they are shared by every worker process and
+    survive restarts.
+    """
+
+    ENTRY_EXTENSION = '.json'
+
+    def __init__(self, storage_location, index_location):
+        self.storage_location = storage_location
+        self.index_location = index_location
+
+    def entry_path(self, bucket, subdirectories, file_id):
+        """Returns the path of the file's index entry. Raises ValueError if the entry, or the directory the file
+        would be stored in, is outside the bucket, such as for subdirectories containing .."""
+        parts = self.split_path(bucket, subdirectories)
+        entry_path = os.path.join(self.index_location, *parts, file_id + self.ENTRY_EXTENSION)
+        if not self.is_within(os.path.realpath(entry_path), os.path.realpath(self.index_location)) or \
+                not self.is_within(os.path.realpath(os.path.join(self.storage_location, *parts)),
+                                   os.path.realpath(os.path.join(self.storage_location, bucket))) or \
+                not self.is_within(os.path.realpath(os.path.join(self.storage_location, bucket)),
+                                   os.path.realpath(self.storage_location)):
+            raise ValueError('The file {} in bucket {} and subdirectories {} is outside the bucket'
+                             .format(file_id, bucket, subdirectories))
+        return entry_path
+
+    def get(self, bucket, subdirectories, file_id):
+        """Returns the index entry for the file, or None if the file has not been indexed"""
+        try:
+            with open(self.entry_path(bucket, subdirectories, file_id), 'r') as entry_file:
+                return json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+
+    def get_path(self, bucket, subdirectories, file_id):
+        """Returns the absolute path of an indexed file, or None if the file has not been indexed"""
+        entry = self.get(bucket, subdirectories, file_id)
+        if entry is None:
+            return None
+        return os.path.join(self.storage_location, entry['path'])
+
+    def put(self, bucket, subdirectories, file_id, filename, **metadata):
+        """Records that file_id is stored as filename in the given bucket and subdirectories"""
+        entry = dict(metadata)
+        entry['path'] = os.path.join(*self.split_path(bucket, subdirectories), filename)
+
+        entry_path = self.entry_path(bucket, subdirectories, file_id)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+
+        # Write to a temporary file and rename it so readers never see a partially written entry
+        temp_path = '{}.{}.tmp'.format(entry_path, uuid.uuid4().hex)
+        try:
+            with open(temp_path, 'w') as entry_file:
+                json.dump(entry, entry_file)
+            os.replace(temp_path, entry_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return entry
+
+    def remove(self, bucket, subdirectories, file_id):
+        try:
+            os.remove(self.entry_path(bucket, subdirectories, file_id))
+            return True
+        except (FileNotFoundError, ValueError):
+            return False
+
+    def rebuild(self, bucket=None):
+        """Indexes every stored file (in one bucket, or all buckets) and drops entries for missing files.
+
+        Returns the number of files in the index after the rebuild.
+        """
+        if bucket is None:
+            buckets = [name for name in os.listdir(self.storage_location)
+                       if not name.startswith('.') and os.path.isdir(os.path.join(self.storage_location, name))]
+        else:
+            buckets = [bucket]
+
+        indexed = 0
+        for bucket_name in buckets:
+            bucket_path = os.path.join(self.storage_location, bucket_name)
+            for path, dirs, files in os.walk(bucket_path):
+                # Skip hidden directories, which is where the index itself lives by default
+                dirs[:] = [directory for directory in dirs if not directory.startswith('.')]
+                relative = os.path.relpath(path, bucket_path)
+                subdirectories = None if relative == os.curdir else ','.join(relative.split(os.sep))
+
+                for filename in files:
+                    if '.' not in filename or filename.startswith('.'):
+                        continue
+                    file_id = filename.split('.', 1)[0]
+                    entry = self.get(bucket_name, subdirectories, file_id)
+                    if entry is None or os.path.basename(entry['path']) != filename:
+                        self.put(bucket_name, subdirectories, file_id, filename)
+                    indexed += 1
+
+            self._remove_stale_entries(os.path.join(self.index_location, bucket_name))
+        return indexed
+
+    def _remove_stale_entries(self, bucket_index_path):
+        for path, dirs, files in os.walk(bucket_index_path):
+            for filename in files:
+                if not filename.endswith(self.ENTRY_EXTENSION):
+                    continue
+                try:
+                    with open(os.path.join(path, filename), 'r') as entry_file:
+                        entry = json.load(entry_file)
+                    stale = not os.path.isfile(os.path.join(self.storage_location, entry['path']))
+                except (OSError, ValueError, KeyError):
+                    stale = True
+                if stale:
+                    os.remove(os.path.join(path, filename))
+
+    @staticmethod
+    def is_within(path, directory):
+        return os.path.commonpath([path, directory]) == directory
+
+    @staticmethod
+    def split_path(bucket, subdirectories):
+        parts = [bucket]
+        if subdirectories is not None:
+            parts.extend(subdirectories.split(','))
+        return parts
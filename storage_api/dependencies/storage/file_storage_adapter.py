@@ -2,11 +2,15 @@ import io
 import os
 import threading
 import uuid
-import zipfile
+from datetime import datetime, timezone
 from mimetypes import guess_extension, guess_type
 
 from flask import current_app
+from storage_api.dependencies.storage.archive_cache import listing_fingerprint
+from storage_api.dependencies.storage.content_hash import copy_and_hash, hash_stream
+from storage_api.dependencies.storage.file_index import FileIndex
 from storage_api.dependencies.storage.storage_base import StorageBase
+from storage_api.dependencies.storage.zip_stream import ZipMember, ZipStream
 from storage_api.model.storage_item import StorageItem
 
 
@@ -21,18 +25,40 @@ class FileStorageAdapter(StorageBase):
                 FileStorageAdapter._instance = super(FileStorageAdapter, cls).__new__(cls)
         return FileStorageAdapter._instance
 
-    def get_file(self, bucket, file_id, subdirectories=None):
+    def get_file(self, bucket, file_id, subdirectories=None, byte_range=None):
+        # Range requests are served by seeking the local file, so byte_range isn't needed
         path = FileStorageAdapter.get_directory_path(bucket, subdirectories)
-        file = FileStorageAdapter.get_file_stream(path, file_id)
+        file, entry = FileStorageAdapter.get_indexed_file_stream(bucket, file_id, subdirectories)
+        if file is None:
+            file = FileStorageAdapter.get_file_stream(path, file_id, current_app.config['FILE_INDEX_SCAN_ON_MISS'])
+            if file and os.path.dirname(file.name) == path:
+                # Found by scanning, so index it to avoid scanning for it again
+                try:
+                    FileStorageAdapter.get_index().put(bucket, subdirectories, file_id, os.path.basename(file.name))
+                except ValueError as ex:
+                    # Outside the bucket, so never indexed
+                    current_app.logger.warning('Not indexing file. Exception - {}'.format(ex))
         if file:
-            return StorageItem(file, FileStorageAdapter.get_mime(file.name), file.name)
+            stored_item = StorageItem(file, FileStorageAdapter.get_mime(file.name), file.name,
+                                      os.path.abspath(file.name), etag=entry.get('sha256') if entry else None)
+            try:
+                stat = os.fstat(file.fileno())
+                stored_item.size = stat.st_size
+                stored_item.last_modified = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+            except OSError:
+                # Not a real file, so the size is unknown and range requests won't be supported
+                pass
+            return stored_item
         return None
 
+    def get_etag(self, bucket, file_id, subdirectories=None):
+        entry = FileStorageAdapter.get_index().get(bucket, subdirectories, file_id)
+        if entry is None:
+            return None
+        return entry.get('sha256')
+
     def get_file_external_url(self, bucket, file_id, subdirectories=None):
-        if subdirectories is not None:
-            reference = '{}/{}?subdirectories={}'.format(bucket, file_id, subdirectories)
-        else:
-            reference = "{}/{}".format(bucket, file_id)
+        reference = FileStorageAdapter.get_reference(bucket, file_id, subdirectories)
 
         if self.is_directory(bucket, file_id, subdirectories):
             if subdirectories is not None:
@@ -46,8 +72,19 @@ class FileStorageAdapter(StorageBase):
         response = {
             "external_reference": "{}/{}".format(current_app.config['FILE_EXTERNAL_URL_BASE'], reference)
         }
+        etag = self.get_etag(bucket, file_id, subdirectories)
+        if etag is not None:
+            response["etag"] = etag
         return response
 
+    def get_file_external_urls(self, bucket, files):
+        # The URLs are only formatted, files aren't looked for so there are no ETags and directories aren't
+        # given their own URLs
+        return [{"external_reference": "{}/{}".format(current_app.config['FILE_EXTERNAL_URL_BASE'],
+                                                      FileStorageAdapter.get_reference(bucket, file_id,
+                                                                                       subdirectories))}
+                for file_id, subdirectories in files]
+
     def is_directory(self, bucket, file_id, subdirectories=None):
         path = FileStorageAdapter.get_directory_path(bucket, subdirectories)
         path = os.path.join(path, file_id)
@@ -56,28 +93,77 @@ class FileStorageAdapter(StorageBase):
     def zip_directory(self, bucket, file_id, subdirectories, name):
         path = FileStorageAdapter.get_directory_path(bucket, subdirectories)
         path = os.path.join(path, file_id)
+        if name is None:
+            name = "archive.zip"
+
+        archive_cache = FileStorageAdapter.get_archive_cache()
+        fingerprint = None
+        if archive_cache is not None:
+            fingerprint = FileStorageAdapter.get_directory_fingerprint(path)
+            if fingerprint is not None:
+                cached_archive = archive_cache.get_item(fingerprint, name)
+                if cached_archive is not None:
+                    return cached_archive
+
         zipped_directory = FileStorageAdapter.zip_contents(path)
         if zipped_directory:
-            if name is None:
-                name = "archive.zip"
+            if fingerprint is not None:
+                zipped_directory = archive_cache.store(fingerprint, zipped_directory)
             return StorageItem(zipped_directory, "application/zip", name)
         return None
 
     def delete_file(self, bucket, file_id, subdirectories=None):
-        try:
-            path = FileStorageAdapter.get_directory_path(bucket, subdirectories)
+        return self.delete_files(bucket, [(file_id, subdirectories)])[0] is True
+
+    def delete_files(self, bucket, files):
+        # The index is opened once for the batch, and a directory searched for files that aren't indexed is only
+        # listed once however many of them are in it
+        index = FileStorageAdapter.get_index()
+        listings = {}
+        results = []
+        for file_id, subdirectories in files:
+            try:
+                results.append(FileStorageAdapter.remove_stored_file(index, listings, bucket, file_id,
+                                                                     subdirectories))
+            except Exception as ex:
+                error_message = 'Failed to delete to the requested file. Exception - {}' \
+                    .format(ex)
+                current_app.logger.exception(error_message)
+                results.append(None)
+        return results
 
-            for search_file in os.listdir(path):
-                if search_file.startswith("{0}.".format(file_id)):
-                    full_path = os.path.join(path, search_file)
-                    os.remove(full_path)
-                    return True
+    @staticmethod
+    def remove_stored_file(index, listings, bucket, file_id, subdirectories):
+        indexed_path = index.get_path(bucket, subdirectories, file_id)
+        if indexed_path is not None:
+            content_hash = None
+            if current_app.config['STORAGE_DEDUPLICATION']:
+                # The hash recorded when the file was saved saves reading the whole file to find its content
+                content_hash = (index.get(bucket, subdirectories, file_id) or {}).get('sha256')
+            try:
+                FileStorageAdapter.remove_file(indexed_path, content_hash)
+                return True
+            except FileNotFoundError:
+                current_app.logger.warning('Indexed file {} no longer exists'.format(indexed_path))
+            finally:
+                index.remove(bucket, subdirectories, file_id)
+
+        if not current_app.config['FILE_INDEX_SCAN_ON_MISS']:
+            return False
 
-        except Exception as ex:
-            error_message = 'Failed to delete to the requested file. Exception - {}' \
-                .format(ex)
-            current_app.logger.exception(error_message)
-        return False
+        path = FileStorageAdapter.get_directory_path(bucket, subdirectories)
+        if path not in listings:
+            try:
+                # By file_id, the first file listed for each one is the one removed
+                listings[path] = {search_file.split('.', 1)[0]: search_file
+                                  for search_file in reversed(os.listdir(path)) if '.' in search_file}
+            except FileNotFoundError:
+                listings[path] = {}
+        search_file = listings[path].pop(file_id, None)
+        if search_file is None:
+            return False
+        FileStorageAdapter.remove_file(os.path.join(path, search_file))
+        return True
 
     def save_file(self, bucket, storage_item, subdirectories=None):
         try:
@@ -94,7 +180,27 @@ class FileStorageAdapter(StorageBase):
             extension = FileStorageAdapter.get_extension(storage_item.meta_type)
             filename = '{0}{1}'.format(key, extension)
             filepath = os.path.join(directory, filename)
-            storage_item.file.save(filepath)
+            if current_app.config['STORAGE_DEDUPLICATION']:
+                content_hash, size = FileStorageAdapter.save_content(storage_item.file, filepath)
+            else:
+                try:
+                    with io.open(filepath, 'wb') as destination:
+                        content_hash = copy_and_hash(storage_item.file, destination)
+                        size = destination.tell()
+                except Exception:
+                    # Such as the upload being cut short while it is streamed from the request. The part that was
+                    # written isn't indexed, so it would never be rolled back
+                    if os.path.exists(filepath):
+                        os.remove(filepath)
+                    raise
+
+            try:
+                FileStorageAdapter.get_index().put(bucket, subdirectories, str(key), filename,
+                                                   sha256=content_hash, size=size)
+            except Exception:
+                # A file that is not in the index may never be found again, so don't keep it
+                os.remove(filepath)
+                raise
 
             response = {
                 "bucket": bucket,
@@ -114,6 +220,108 @@ class FileStorageAdapter(StorageBase):
             current_app.logger.exception(error_message)
             raise ex
 
+    @staticmethod
+    def is_reserved_bucket(bucket):
+        """Returns whether bucket is a hidden folder, or holds FILE_INDEX_LOCATION, FILE_CONTENT_LOCATION or
+        ARCHIVE_CACHE_LOCATION when they are set to a folder in FILE_STORAGE_LOCATION"""
+        if StorageBase.is_reserved_bucket(bucket):
+            return True
+        bucket_path = os.path.realpath(os.path.join(current_app.config['FILE_STORAGE_LOCATION'], bucket))
+        return any(FileIndex.is_within(os.path.realpath(current_app.config[location]), bucket_path)
+                   for location in ('FILE_INDEX_LOCATION', 'FILE_CONTENT_LOCATION', 'ARCHIVE_CACHE_LOCATION'))
+
+    @staticmethod
+    def get_reference(bucket, file_id, subdirectories=None):
+        if subdirectories is not None:
+            return '{}/{}?subdirectories={}'.format(bucket, file_id, subdirectories)
+        return "{}/{}".format(bucket, file_id)
+
+    @staticmethod
+    def get_index():
+        return FileIndex(current_app.config['FILE_STORAGE_LOCATION'], current_app.config['FILE_INDEX_LOCATION'])
+
+    @staticmethod
+    def save_content(source, path):
+        """Saves the content of source at path as a hard link to the copy of the content in FILE_CONTENT_LOCATION,
+        which is only written if the content isn't already stored. Returns the hash and size of the content.
+
+        The number of links to the stored content counts the files referring to it, see release_content. If the
+        link can't be made, such as on a filesystem without hard links, the content is saved at path on its own.
+        """
+        if source.seekable():
+            # Already in memory or a temporary file, so it can be hashed without writing it anywhere
+            content_hash = hash_stream(source)
+            try:
+                os.link(FileStorageAdapter.get_content_path(content_hash), path)
+                return content_hash, os.stat(path).st_size
+            except OSError:
+                # Not stored yet, or can't be linked to
+                pass
+
+        content_location = current_app.config['FILE_CONTENT_LOCATION']
+        os.makedirs(content_location, exist_ok=True)
+        temporary_path = os.path.join(content_location, '{}.tmp'.format(uuid.uuid4()))
+        try:
+            with io.open(temporary_path, 'wb') as destination:
+                content_hash = copy_and_hash(source, destination)
+                size = destination.tell()
+            try:
+                FileStorageAdapter.link_content(temporary_path, content_hash, path)
+            except OSError as ex:
+                current_app.logger.warning('Failed to link to stored content, saving it unshared. Exception - {}'
+                                           .format(ex))
+                os.replace(temporary_path, path)
+            return content_hash, size
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    @staticmethod
+    def link_content(temporary_path, content_hash, path):
+        content_path = FileStorageAdapter.get_content_path(content_hash)
+        os.makedirs(os.path.dirname(content_path), exist_ok=True)
+        while True:
+            try:
+                # Fails if the content is already stored, in which case the temporary copy is discarded
+                os.link(temporary_path, content_path)
+            except FileExistsError:
+                pass
+            try:
+                os.link(content_path, path)
+                return
+            except FileNotFoundError:
+                # The last file referring to the content was deleted since it was stored, so store it again
+                continue
+
+    @staticmethod
+    def remove_file(path, content_hash=None):
+        """Removes a stored file, and the deduplicated content it links to if no other file does. The content is
+        stored under its hash, which is read from the file if content_hash isn't given"""
+        if current_app.config['STORAGE_DEDUPLICATION'] and os.stat(path).st_nlink > 1:
+            if content_hash is None:
+                with io.open(path, 'rb') as stored_file:
+                    content_hash = hash_stream(stored_file)
+        else:
+            content_hash = None
+        os.remove(path)
+        if content_hash is not None:
+            FileStorageAdapter.release_content(content_hash)
+
+    @staticmethod
+    def release_content(content_hash):
+        """Removes the stored content with the hash once no file links to it"""
+        content_path = FileStorageAdapter.get_content_path(content_hash)
+        try:
+            if os.stat(content_path).st_nlink <= 1:
+                os.remove(content_path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def get_content_path(content_hash):
+        # Spread across folders by the start of the hash, so no one folder holds all the content
+        return os.path.join(current_app.config['FILE_CONTENT_LOCATION'], content_hash[:2], content_hash)
+
     @staticmethod
     def add_sub_directory_to_path(directory, subdirectories, is_save):
         subdirectories = subdirectories.split(',')
@@ -159,25 +367,55 @@ class FileStorageAdapter(StorageBase):
     @staticmethod
     def zip_contents(directory):
         try:
-            memory_file = io.BytesIO()
             files = [f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))]
-            with zipfile.ZipFile(memory_file, 'w') as zf:
-                for individual_file in files:
-                    data = zipfile.ZipInfo(individual_file)
-                    data.compress_type = zipfile.ZIP_DEFLATED
-                    zf.write("{}/{}".format(directory, individual_file), os.path.basename(individual_file))
-            memory_file.seek(0)
-            return memory_file
+            return ZipStream(FileStorageAdapter.iter_zip_members(directory, files))
         except Exception as ex:
             error_message = 'Failed to zip to the requested files. Exception - {}' \
                 .format(ex)
             current_app.logger.exception(error_message)
 
     @staticmethod
-    def get_file_stream(directory, file_id):
+    def get_directory_fingerprint(directory):
+        try:
+            entries = []
+            for entry in os.scandir(directory):
+                if entry.is_file():
+                    stat = entry.stat()
+                    entries.append((entry.name, stat.st_size, stat.st_mtime_ns))
+            return listing_fingerprint(entries)
+        except OSError:
+            return None
+
+    @staticmethod
+    def iter_zip_members(directory, files):
+        for individual_file in files:
+            path = os.path.join(directory, individual_file)
+            with io.open(path, 'rb') as member_file:
+                modified = datetime.fromtimestamp(os.fstat(member_file.fileno()).st_mtime)
+                yield ZipMember(os.path.basename(individual_file),
+                                iter(lambda: member_file.read(StorageItem.CHUNK_SIZE), b''), modified)
+
+    @staticmethod
+    def get_indexed_file_stream(bucket, file_id, subdirectories):
+        """Returns the opened file and its index entry, or (None, None) if the file isn't indexed"""
+        index = FileStorageAdapter.get_index()
+        entry = index.get(bucket, subdirectories, file_id)
+        if entry is None:
+            return None, None
+        try:
+            return io.open(os.path.join(index.storage_location, entry['path']), 'rb'), entry
+        except FileNotFoundError:
+            # The file has been removed without going through the adapter, so the entry is stale
+            index.remove(bucket, subdirectories, file_id)
+            return None, None
+
+    @staticmethod
+    def get_file_stream(directory, file_id, scan=True):
         if len(file_id) > 4 and file_id[-4] == '.':  # check if file_id includes file extension
             if os.path.isfile(os.path.join(directory, file_id)):
                 return io.open(os.path.join(directory, file_id), 'rb')
+        if not scan:
+            return None
         try:
             for path, dirs, files in os.walk(directory):
                 for file in files:
@@ -1,56 +1,171 @@
 import io
 import os
+import tempfile
 import threading
 import uuid
-import zipfile
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from itertools import chain, islice
 from mimetypes import guess_extension
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
 from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
 from flask import current_app
+from werkzeug.datastructures import Range
+from werkzeug.http import parse_content_range_header
+from storage_api.cache import LRUCache, register_cache
+from storage_api.concurrency import ordered_prefetch, with_current_context
+from storage_api.dependencies.storage.archive_cache import listing_fingerprint
+from storage_api.dependencies.storage.content_hash import copy_and_hash, hash_stream
 from storage_api.dependencies.storage.storage_base import StorageBase
+from storage_api.dependencies.storage.zip_stream import IteratorFile, ZipMember, ZipStream
 from storage_api.exceptions import ApplicationError
 from storage_api.model.storage_item import StorageItem
 
+# Most keys S3 deletes in one delete_objects request
+DELETE_OBJECTS_MAX_KEYS = 1000
+# Where content saved with STORAGE_DEDUPLICATION is stored, under its hash, and where references to it are recorded
+CONTENT_PREFIX = 'content/'
+CONTENT_REFERENCES_PREFIX = 'content-references/'
+
 
 class S3StorageAdapter(StorageBase):
 
     _instance = None
     _lock = threading.Lock()
     _connection = None
+    _presigned_urls = None
+    _metadata = None
 
     def __new__(cls, s3_instance=None):
         with S3StorageAdapter._lock:
             if S3StorageAdapter._instance is None:
                 S3StorageAdapter._instance = super(S3StorageAdapter, cls).__new__(cls)
+                # The pool is shared by every request, each of which may make several S3 requests at once
                 S3StorageAdapter._instance._connection = boto3.client('s3',
                                                                       config=Config(
                                                                           signature_version='s3v4',
-                                                                          s3={'addressing_style': 'virtual'}))
+                                                                          s3={'addressing_style': 'virtual'},
+                                                                          max_pool_connections=current_app.config[
+                                                                              'S3_POOL_CONNECTIONS']))
         return S3StorageAdapter._instance
 
-    def get_file(self, bucket, file_id, subdirectories=None):
+    def get_file(self, bucket, file_id, subdirectories=None, byte_range=None):
         full_key = S3StorageAdapter.get_full_key(bucket, file_id, subdirectories)
+        s3_bucket = current_app.config['S3_BUCKET']
+        metadata_cache = S3StorageAdapter.get_metadata_cache()
+        cached = metadata_cache.get(('file', full_key))
+        if cached is not None and not cached['exists']:
+            return None
 
         try:
-            response = self._connection.get_object(Bucket=current_app.config['S3_BUCKET'], Key=full_key)
-            file = io.BytesIO(response["Body"].read())
-            metadata = response["Metadata"]
-            return StorageItem(file, metadata['content-type'], metadata['file-name'])
+            # A file saved with STORAGE_DEDUPLICATION is a reference to its content, which is got from the
+            # content's key. Once the reference has been read the content can be got straight away.
+            content_key = cached.get('content_key') if cached is not None else None
+            reference = cached if content_key is not None else None
+            if content_key is not None:
+                response = self.get_content_response(s3_bucket, full_key, content_key, byte_range)
+            else:
+                response = self.get_object_response(s3_bucket, full_key, byte_range)
+            if reference is None and 'content-key' in response["Metadata"]:
+                response["Body"].close()
+                reference = S3StorageAdapter.get_response_metadata(response)
+                content_key = reference['content_key']
+                response = self.get_content_response(s3_bucket, full_key, content_key, byte_range)
+            stream = current_app.config['S3_DOWNLOAD_MODE'].lower() == 'stream'
+            if stream:
+                # Closing the item's file closes the body, which releases the connection if the client disconnects
+                file = response["Body"]
+            else:
+                file = io.BytesIO(response["Body"].read())
+            metadata = reference or S3StorageAdapter.get_response_metadata(response)
+            stored_item = StorageItem(file, metadata['content_type'], metadata['file_name'],
+                                      size=response.get('ContentLength'), last_modified=response.get('LastModified'),
+                                      etag=metadata['etag'])
+            stored_item.chunk_size = current_app.config['S3_STREAM_CHUNK_SIZE']
+
+            content_range = parse_content_range_header(response.get('ContentRange'))
+            if content_range is not None:
+                stored_item.size = content_range.length
+                stored_item.content_range = (content_range.start, content_range.stop)
+            elif stream and stored_item.size is not None:
+                # The body can only be read once, from the start, so it holds the range of the whole object
+                stored_item.content_range = (0, stored_item.size)
+            stored_item.range_reader = partial(self.read_range, s3_bucket, content_key or full_key,
+                                               chunk_size=stored_item.chunk_size)
+            metadata_cache.put(('file', full_key), {
+                'exists': True,
+                'size': stored_item.size,
+                'content_type': stored_item.meta_type,
+                'file_name': stored_item.file_name,
+                'etag': stored_item.etag,
+                'last_modified': stored_item.last_modified,
+                'content_key': content_key})
+            return stored_item
         except ClientError as e:
             if e.response['Error']['Code'] == 'NoSuchKey':
+                self.cache_missing(full_key)
                 error_message = 'Key {} does not exist. Exception - {}' \
                     .format(full_key, e)
                 current_app.logger.warning(error_message)
                 return None
             raise
+        except ApplicationError as ex:
+            # The cached reference may name content that has since been replaced
+            metadata_cache.remove(('file', full_key))
+            current_app.logger.error(ex.message)
+            raise
         except Exception as ex:
             error_message = 'Failed to get to the requested file. Exception - {}' \
                 .format(ex)
             current_app.logger.warning(error_message)
             raise ApplicationError('Failed to get to the requested file', 'S3-GET')
 
+    @staticmethod
+    def is_reserved_bucket(bucket):
+        # Deduplicated content and the references to it are kept at the top level of S3_BUCKET, where they would
+        # otherwise be reachable as buckets. They are reserved whether or not STORAGE_DEDUPLICATION is on, as it
+        # may have been on before
+        return StorageBase.is_reserved_bucket(bucket) or \
+            bucket + '/' in (CONTENT_PREFIX, CONTENT_REFERENCES_PREFIX)
+
+    def get_object_response(self, s3_bucket, key, byte_range=None):
+        if byte_range is not None and byte_range.units == 'bytes':
+            # Only fetch the first requested range, S3 will tell us the size of the whole object
+            return self.get_object_range(s3_bucket, key, Range(byte_range.units, byte_range.ranges[:1]))
+        return self._connection.get_object(Bucket=s3_bucket, Key=key)
+
+    def get_content_response(self, s3_bucket, key, content_key, byte_range=None):
+        """Gets the deduplicated content the reference at key refers to. The reference exists, so content that
+        doesn't is an error rather than a missing file, and the reference must not be cached as missing"""
+        try:
+            return self.get_object_response(s3_bucket, content_key, byte_range)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            raise ApplicationError('Content {} of key {} does not exist'.format(content_key, key), 'S3-CONTENT', 500)
+
+    def resolve(self, bucket, file_id, subdirectories=None, byte_range=None, archive_name=None):
+        # Files are fetched far more often than directories, so get the object first and only list the
+        # directory if there is no such key. A file then takes one request instead of a list and a get.
+        stored_item = self.get_file(bucket, file_id, subdirectories, byte_range=byte_range)
+        if stored_item is not None:
+            return stored_item, False
+        full_key = S3StorageAdapter.get_full_key(bucket, file_id, subdirectories)
+        keys = self.list_keys(current_app.config['S3_BUCKET'], full_key)
+        listed = list(islice(keys, 2))
+        if len(listed) == 1 and listed[0]['Key'] == full_key:
+            # Only the file itself, which was cached as missing but has been saved since, such as by another
+            # instance. As for is_directory, that isn't a directory
+            S3StorageAdapter.get_metadata_cache().remove(('file', full_key))
+            return self.get_file(bucket, file_id, subdirectories, byte_range=byte_range), False
+        zipped_directory = self.zip_directory(bucket, file_id, subdirectories, archive_name, chain(listed, keys))
+        return zipped_directory, zipped_directory is not None
+
     def save_file(self, bucket, storage_item, subdirectories=None):
         try:
             key = str(uuid.uuid4())
@@ -60,14 +175,28 @@ class S3StorageAdapter(StorageBase):
             if subdirectories is not None:
                 reference = reference + "?subdirectories={}".format(subdirectories)
 
-            self._connection.put_object(Body=storage_item.file,
-                                        ContentType=storage_item.meta_type,
-                                        Bucket=current_app.config['S3_BUCKET'],
-                                        Key=full_key,
-                                        Metadata={
-                                            'file-name': storage_item.file_name,
-                                            'content-type': storage_item.meta_type}
-                                        )
+            file = storage_item.file
+            if not file.seekable():
+                # Metadata has to be sent with the object, so an upload being streamed from the request is
+                # hashed as it is copied to a temporary file, which is then uploaded
+                file = tempfile.SpooledTemporaryFile(max_size=current_app.config['UPLOAD_MEMORY_THRESHOLD'])
+                content_hash = copy_and_hash(storage_item.file, file)
+                file.seek(0)
+            else:
+                # Metadata has to be sent with the object, so hash the uploaded file before sending it
+                content_hash = hash_stream(file)
+
+            try:
+                storage_item.size = S3StorageAdapter.get_stream_size(file)
+                content_key = None
+                if current_app.config['STORAGE_DEDUPLICATION']:
+                    content_key = self.save_reference(file, full_key, storage_item, content_hash)
+                else:
+                    self.upload_file(file, full_key, storage_item, content_hash)
+            finally:
+                if file is not storage_item.file:
+                    file.close()
+            self.cache_saved(full_key, storage_item, content_hash, content_key)
             url = self.get_s3_signed_url(full_key)
 
             response = {
@@ -88,110 +217,435 @@ class S3StorageAdapter(StorageBase):
             current_app.logger.exception(error_message)
             raise ApplicationError('Failed to save to the requested file', 'S3-SAVE')
 
-    def zip_directory(self, bucket, file_id, subdirectories, name):
+    def upload_file(self, file, full_key, storage_item, content_hash):
+        metadata = {
+            'file-name': storage_item.file_name,
+            'content-type': storage_item.meta_type,
+            'sha256': content_hash}
+
+        if storage_item.size >= current_app.config['S3_MULTIPART_THRESHOLD']:
+            # Large files are sent in parts over several connections. If a part fails the upload is
+            # aborted, so S3 doesn't keep the parts that were sent.
+            self._connection.upload_fileobj(file,
+                                            current_app.config['S3_BUCKET'],
+                                            full_key,
+                                            ExtraArgs={'ContentType': storage_item.meta_type,
+                                                       'Metadata': metadata},
+                                            Config=S3StorageAdapter.get_transfer_config())
+        else:
+            self._connection.put_object(Body=file,
+                                        ContentType=storage_item.meta_type,
+                                        Bucket=current_app.config['S3_BUCKET'],
+                                        Key=full_key,
+                                        Metadata=metadata
+                                        )
+
+    def save_reference(self, file, full_key, storage_item, content_hash):
+        """Saves the file as an empty object at full_key referring to its content, which is stored once under
+        CONTENT_PREFIX with its hash as the key and only uploaded if it isn't stored already. Each reference is
+        also recorded under CONTENT_REFERENCES_PREFIX, so the content can be deleted along with the last one.
+        Returns the key of the content.
+
+        A delete of the content's last other reference that listed the references before this one was recorded
+        can still delete the content after it has been checked for, so it is checked for again once the file is
+        saved and uploaded again if it has gone. Only a delete held up between listing the references and deleting
+        the content for the whole of the save can leave the file without its content."""
+        s3_bucket = current_app.config['S3_BUCKET']
+        content_key = CONTENT_PREFIX + content_hash
+        # Recorded before checking for the content, so a delete of the content's last other reference that lists
+        # the references after this sees it and keeps the content
+        self._connection.put_object(Bucket=s3_bucket, Key=S3StorageAdapter.get_content_reference_key(
+            content_hash, full_key), Body=b'')
+        if self.head_file(content_key) is None:
+            self.upload_file(file, content_key, storage_item, content_hash)
+        self._connection.put_object(Body=b'',
+                                    ContentType=storage_item.meta_type,
+                                    Bucket=s3_bucket,
+                                    Key=full_key,
+                                    Metadata={
+                                        'file-name': storage_item.file_name,
+                                        'content-type': storage_item.meta_type,
+                                        'sha256': content_hash,
+                                        'content-key': content_key})
+        if self.head_file(content_key) is None:
+            file.seek(0)
+            self.upload_file(file, content_key, storage_item, content_hash)
+        return content_key
+
+    def delete_content_reference(self, full_key, content_hash):
+        """Deletes the record of a reference to content, and the content if no other reference is left"""
+        s3_bucket = current_app.config['S3_BUCKET']
+        self._connection.delete_object(Bucket=s3_bucket,
+                                       Key=S3StorageAdapter.get_content_reference_key(content_hash, full_key))
+        references = self._connection.list_objects_v2(Bucket=s3_bucket,
+                                                      Prefix=S3StorageAdapter.get_content_reference_key(
+                                                          content_hash, ''),
+                                                      MaxKeys=1)
+        if not references.get('Contents'):
+            self._connection.delete_object(Bucket=s3_bucket, Key=CONTENT_PREFIX + content_hash)
+
+    def zip_directory(self, bucket, file_id, subdirectories, name, keys=None):
+        # keys is the listing of the directory, where it has already been started
         try:
             full_key = S3StorageAdapter.get_full_key(bucket, file_id, subdirectories)
-            response = self._connection.list_objects(Bucket=current_app.config['S3_BUCKET'],
-                                                     Prefix=full_key,
-                                                     Delimiter=',')
-            if 'Contents' in response:
-                files = []
-                keys = response['Contents']
-                if len(keys) > 0:
-                    for s3_key in keys:
-                        key = s3_key['Key']
-                        response = self._connection.get_object(Bucket=current_app.config['S3_BUCKET'], Key=key)
-                        file = io.BytesIO(response["Body"].read())
-                        metadata = response["Metadata"]
-                        files.append(StorageItem(file, metadata['content-type'], metadata['file-name']))
-
-                    memory_file = io.BytesIO()
-
-                    with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-                        for individual_file in files:
-                            individual_file.file.seek(0)
-                            zf.writestr(S3StorageAdapter.get_full_filename(individual_file),
-                                        individual_file.file.getvalue())
-                    memory_file.seek(0)
-
-                    if memory_file:
-                        if name is None:
-                            name = "archive.zip"
-                        return StorageItem(memory_file, "application/zip", name)
-            return None
+            if name is None:
+                name = "archive.zip"
+
+            if keys is None:
+                keys = self.list_keys(current_app.config['S3_BUCKET'], full_key)
+            fingerprint = None
+            if S3StorageAdapter.get_archive_cache() is not None:
+                # The whole listing is needed to tell if a cached archive is still up to date
+                keys = list(keys)
+                fingerprint = S3StorageAdapter.get_listing_fingerprint(keys)
+            return self._zip_keys(iter(keys), name, fingerprint)
         except Exception as ex:
             error_message = 'Failed to zip to the requested files. Exception - {}' \
                 .format(ex)
             current_app.logger.exception(error_message)
             raise ApplicationError(error_message, 'S3-ZIP', 500)
 
-    def get_file_external_url(self, bucket, file_id, subdirectories=None):
-        if self.is_directory(bucket, file_id, subdirectories):
-            key = str(uuid.uuid4())
-            name = "{}.zip".format(key)
-            storage_item = self.zip_directory(bucket, file_id, subdirectories, name)
-
-            if storage_item is None:
-                return None
-
-            full_key = "temp/{}".format(S3StorageAdapter.get_full_key(bucket, key, None))
+    def _zip_keys(self, keys, name, fingerprint=None):
+        archive_cache = S3StorageAdapter.get_archive_cache()
+        if archive_cache is not None and fingerprint is not None:
+            cached_archive = archive_cache.get_item(fingerprint, name)
+            if cached_archive is not None:
+                return cached_archive
 
-            self._connection.put_object(Body=storage_item.file,
-                                        ContentType=storage_item.meta_type,
-                                        Bucket=current_app.config['S3_BUCKET'],
-                                        Key=full_key,
-                                        Metadata={
-                                            'file-name': storage_item.file_name,
-                                            'content-type': storage_item.meta_type}
-                                        )
+        first_key = next(keys, None)
+        if first_key is None:
+            return None
+        # Objects, and any further pages of the listing, are only fetched as the archive is read so the
+        # response can start straight away
+        members = self._iter_zip_members(current_app.config['S3_BUCKET'], chain([first_key], keys),
+                                         current_app.config['S3_ZIP_CONCURRENCY'],
+                                         current_app.config['S3_ZIP_MEMORY_BUDGET'])
+        zipped_directory = ZipStream(members)
+        if archive_cache is not None and fingerprint is not None:
+            zipped_directory = archive_cache.store(fingerprint, zipped_directory)
+        return StorageItem(zipped_directory, "application/zip", name)
+
+    def _iter_zip_members(self, s3_bucket, keys, concurrency=1, memory_budget=None):
+        if concurrency > 1:
+            # Fetch the next few objects while earlier ones are being written to the archive. Objects are
+            # read into memory, apart from any too big for the budget which are streamed when their turn comes.
+            def fetch(s3_key):
+                return self._get_zip_member(s3_bucket, s3_key['Key'],
+                                            memory_budget is None or s3_key.get('Size', 0) <= memory_budget,
+                                            memory_budget)
+
+            def cost(s3_key):
+                return min(s3_key.get('Size', 0), memory_budget)
+
+            responses = ordered_prefetch(fetch, keys, concurrency, memory_budget, cost if memory_budget else None)
+        else:
+            responses = (self._get_zip_member(s3_bucket, s3_key['Key'], False) for s3_key in keys)
 
-            return {"external_reference": self.get_s3_signed_url(full_key)}
+        for response in responses:
+            body = response["Body"]
+            try:
+                metadata = response["Metadata"]
+                item = StorageItem(body, metadata['content-type'], metadata['file-name'])
+                yield ZipMember(S3StorageAdapter.get_full_filename(item),
+                                body.iter_chunks(StorageItem.CHUNK_SIZE), response.get("LastModified"))
+            finally:
+                body.close()
+
+    def _get_zip_member(self, s3_bucket, key, read, memory_budget=None):
+        response = self._connection.get_object(Bucket=s3_bucket, Key=key)
+        if 'content-key' in response["Metadata"]:
+            # A reference is empty, so its size in the listing says nothing of the size of the content
+            response["Body"].close()
+            metadata = response["Metadata"]
+            response = self.get_content_response(s3_bucket, key, metadata['content-key'])
+            response["Metadata"] = metadata
+            read = read and (memory_budget is None or response.get('ContentLength', 0) <= memory_budget)
+        if read:
+            with closing(response["Body"]) as body:
+                data = body.read()
+            response["Body"] = StreamingBody(io.BytesIO(data), len(data))
+        return response
 
+    def get_file_external_url(self, bucket, file_id, subdirectories=None):
+        # Check for a file first, only listing the directory if there is no such key
         full_key = S3StorageAdapter.get_full_key(bucket, file_id, subdirectories)
-        if self.does_file_exist(full_key):
-            return {"external_reference": self.get_s3_signed_url(full_key)}
+        metadata = self.get_metadata(full_key)
+        if metadata['exists']:
+            if metadata.get('content_key'):
+                # The reference is empty, so the URL is for the content, with the reference's content type
+                url = self.get_s3_signed_url(metadata['content_key'], metadata['content_type'])
+            else:
+                url = self.get_s3_signed_url(full_key)
+            result = {"external_reference": url}
+            etag = metadata['etag']
+            if etag is not None:
+                result["etag"] = etag
+            return result
+
+        if S3StorageAdapter.get_archive_cache() is not None:
+            return self.get_cached_archive_url(bucket, file_id, subdirectories)
+
+        key = str(uuid.uuid4())
+        name = "{}.zip".format(key)
+        storage_item = self.zip_directory(bucket, file_id, subdirectories, name)
+
+        if storage_item is None:
+            return None
+
+        full_key = "temp/{}".format(S3StorageAdapter.get_full_key(bucket, key, None))
+        self.upload_archive(storage_item, full_key)
+        return {"external_reference": self.get_s3_signed_url(full_key)}
+
+    def get_file_external_urls(self, bucket, files):
+        # Only files are looked for, a directory is reported as not found rather than being zipped
+        full_keys = [S3StorageAdapter.get_full_key(bucket, file_id, subdirectories)
+                     for file_id, subdirectories in files]
+        metadata = self.get_batch_metadata(full_keys)
+        results = []
+        for full_key in full_keys:
+            key_metadata = metadata[full_key]
+            if not key_metadata['exists']:
+                results.append(None)
+                continue
+            if key_metadata.get('content_key'):
+                url = self.get_s3_signed_url(key_metadata['content_key'], key_metadata['content_type'])
+            else:
+                url = self.get_s3_signed_url(full_key)
+            result = {"external_reference": url}
+            if key_metadata.get('etag') is not None:
+                result["etag"] = key_metadata['etag']
+            results.append(result)
+        return results
+
+    def get_batch_metadata(self, keys):
+        """Returns the metadata of each key by key, from the cache where it can. Otherwise each directory of the
+        keys is listed once, as far as the keys in it go, with any keys left when listing would take more requests
+        than checking them looked up by head_object, S3_BATCH_CONCURRENCY at a time.
+
+        A listing only tells whether a key exists and its size, so for keys that are only listed the rest of the
+        metadata is None. Empty keys are looked up, as they may be references to deduplicated content.
+        """
+        metadata_cache = S3StorageAdapter.get_metadata_cache()
+        metadata = {}
+        directories = {}
+        for key in keys:
+            cached = metadata_cache.get(('file', key))
+            if cached is not None:
+                metadata[key] = cached
+            else:
+                directories.setdefault(os.path.dirname(key), set()).add(key)
+
+        heads = []
+        for directory, directory_keys in directories.items():
+            heads.extend(self.list_metadata(directory, directory_keys, metadata))
+        heads.extend(key for key, key_metadata in metadata.items()
+                     if key_metadata['exists'] and key_metadata['size'] == 0 and key_metadata['file_name'] is None)
+        metadata.update(zip(heads, ordered_prefetch(with_current_context(self.get_metadata), heads,
+                                                    current_app.config['S3_BATCH_CONCURRENCY'])))
+        return metadata
+
+    def list_metadata(self, directory, keys, metadata):
+        """Adds the metadata of the keys in a directory that are found by listing it to metadata, returning any
+        keys that were left unlisted as looking them up one at a time takes fewer requests"""
+        remaining = set(keys)
+        last_key = max(keys)
+        # Shortening the first key gives a key just before it, so the listing starts from the first of the keys
+        paginator = self._connection.get_paginator('list_objects_v2')
+        pages = paginator.paginate(Bucket=current_app.config['S3_BUCKET'], Prefix=directory + '/', Delimiter='/',
+                                   StartAfter=min(keys)[:-1])
+        requests = 0
+        for page in pages:
+            requests += 1
+            contents = page.get('Contents', [])
+            for s3_key in contents:
+                if s3_key['Key'] in remaining:
+                    remaining.discard(s3_key['Key'])
+                    metadata[s3_key['Key']] = {
+                        'exists': True,
+                        'size': s3_key.get('Size'),
+                        'content_type': None,
+                        'file_name': None,
+                        'etag': None,
+                        'last_modified': s3_key.get('LastModified'),
+                        'content_key': None}
+            if not remaining or (contents and contents[-1]['Key'] >= last_key):
+                break
+            if requests >= len(remaining):
+                return remaining
+        for key in remaining:
+            # Listed past where the key would be, so there is no such key
+            metadata[key] = self.cache_missing(key)
+        return []
+
+    def get_cached_archive_url(self, bucket, file_id, subdirectories=None):
+        """Returns the external URL of an archive of the directory, reusing the one uploaded for an earlier
+        request if the directory hasn't changed since and the archive is younger than ARCHIVE_CACHE_TTL"""
+        try:
+            keys = list(self.list_keys(current_app.config['S3_BUCKET'],
+                                       S3StorageAdapter.get_full_key(bucket, file_id, subdirectories)))
+        except Exception as ex:
+            error_message = 'Failed to zip to the requested files. Exception - {}' \
+                .format(ex)
+            current_app.logger.exception(error_message)
+            raise ApplicationError(error_message, 'S3-ZIP', 500)
+        if not keys:
+            return None
 
-        return None
+        fingerprint = S3StorageAdapter.get_listing_fingerprint(keys)
+        full_key = "temp/{}".format(S3StorageAdapter.get_full_key(bucket, fingerprint, None))
+        head = self.head_file(full_key)
+        if head is None or datetime.now(timezone.utc) - head['LastModified'] > \
+                timedelta(seconds=current_app.config['ARCHIVE_CACHE_TTL']):
+            storage_item = self._zip_keys(iter(keys), "{}.zip".format(fingerprint), fingerprint)
+            self.upload_archive(storage_item, full_key)
+        return {"external_reference": self.get_s3_signed_url(full_key)}
+
+    def upload_archive(self, storage_item, full_key):
+        archive = storage_item.file
+        if not hasattr(archive, 'read'):
+            # The archive is generated as it is uploaded, multipart upload doesn't need its size up front
+            archive = IteratorFile(archive)
+        try:
+            self._connection.upload_fileobj(archive,
+                                            current_app.config['S3_BUCKET'],
+                                            full_key,
+                                            ExtraArgs={'ContentType': storage_item.meta_type,
+                                                       'Metadata': {
+                                                           'file-name': storage_item.file_name,
+                                                           'content-type': storage_item.meta_type}},
+                                            Config=S3StorageAdapter.get_transfer_config())
+        finally:
+            storage_item.file.close()
+
+    def get_etag(self, bucket, file_id, subdirectories=None):
+        metadata = self.get_metadata(S3StorageAdapter.get_full_key(bucket, file_id, subdirectories))
+        return metadata.get('etag')
 
     def delete_file(self, bucket, file_id, subdirectories=None):
         full_key = S3StorageAdapter.get_full_key(bucket, file_id, subdirectories)
 
-        if self.does_file_exist(full_key):
+        # delete_object succeeds whether or not the key exists, so a missing file can only be reported after a
+        # head_object. Without the check every delete is a single request and reports the file as deleted, unless
+        # files are deduplicated, when the head_object also tells which content the file refers to.
+        metadata = None
+        if current_app.config['S3_DELETE_CHECK_EXISTS'] or current_app.config['STORAGE_DEDUPLICATION']:
+            metadata = self.get_metadata(full_key)
+            if not metadata['exists'] and current_app.config['S3_DELETE_CHECK_EXISTS']:
+                return False
+        try:
+            self._connection.delete_object(Bucket=current_app.config['S3_BUCKET'], Key=full_key)
+            S3StorageAdapter.get_presigned_url_cache().remove(full_key)
+            self.cache_missing(full_key)
+            S3StorageAdapter.invalidate_directories(full_key)
+            if metadata is not None and metadata.get('content_key'):
+                self.delete_content_reference(full_key, metadata['content_key'][len(CONTENT_PREFIX):])
+            return True
+        except ClientError as ex:
+            error_message = 'Failed to delete to the requested file. Exception - {}' \
+                .format(ex)
+            current_app.logger.exception(error_message)
+            raise ApplicationError(error_message, 'S3-DELETE', 500)
+
+    def delete_files(self, bucket, files):
+        full_keys = [S3StorageAdapter.get_full_key(bucket, file_id, subdirectories)
+                     for file_id, subdirectories in files]
+        results = [True] * len(full_keys)
+        metadata = {}
+        if current_app.config['S3_DELETE_CHECK_EXISTS'] or current_app.config['STORAGE_DEDUPLICATION']:
+            # As for delete_file, but the keys are checked S3_BATCH_CONCURRENCY at a time
+            metadata = dict(zip(full_keys, ordered_prefetch(with_current_context(self.get_metadata), full_keys,
+                                                            current_app.config['S3_BATCH_CONCURRENCY'])))
+            if current_app.config['S3_DELETE_CHECK_EXISTS']:
+                results = [metadata[full_key]['exists'] for full_key in full_keys]
+
+        keys = sorted({full_key for full_key, result in zip(full_keys, results) if result})
+        failed = set()
+        for start in range(0, len(keys), DELETE_OBJECTS_MAX_KEYS):
+            batch = keys[start:start + DELETE_OBJECTS_MAX_KEYS]
             try:
-                self._connection.delete_object(Bucket=current_app.config['S3_BUCKET'], Key=full_key)
-                return True
+                # Quiet, so only the keys that couldn't be deleted are listed in the response
+                response = self._connection.delete_objects(Bucket=current_app.config['S3_BUCKET'],
+                                                           Delete={'Objects': [{'Key': key} for key in batch],
+                                                                   'Quiet': True})
+                errors = response.get('Errors', [])
             except ClientError as ex:
-                error_message = 'Failed to delete to the requested file. Exception - {}' \
-                    .format(ex)
-                current_app.logger.exception(error_message)
-                raise ApplicationError(error_message, 'S3-DELETE', 500)
-
-        return False
+                errors = [{'Key': key, 'Message': str(ex)} for key in batch]
+            for error in errors:
+                current_app.logger.error('Failed to delete {}. Error - {}'.format(error['Key'], error.get('Message')))
+                failed.add(error['Key'])
+
+        for key in keys:
+            if key in failed:
+                continue
+            S3StorageAdapter.get_presigned_url_cache().remove(key)
+            self.cache_missing(key)
+            S3StorageAdapter.invalidate_directories(key)
+            content_key = metadata.get(key, {}).get('content_key')
+            if content_key:
+                try:
+                    self.delete_content_reference(key, content_key[len(CONTENT_PREFIX):])
+                except ClientError as ex:
+                    # The file is deleted, only its content is left behind
+                    current_app.logger.exception('Failed to release {}. Exception - {}'.format(content_key, ex))
+        return [None if full_key in failed else result for full_key, result in zip(full_keys, results)]
 
     def is_directory(self, bucket, file_id, subdirectories=None):
         full_key = S3StorageAdapter.get_full_key(bucket, file_id, subdirectories)
-        response = self._connection.list_objects(Bucket=current_app.config['S3_BUCKET'],
-                                                 Prefix=full_key,
-                                                 Delimiter=',')
-        if 'Contents' in response:
-            keys = response['Contents']
-            if len(keys) > 0:
-                if len(keys) == 1:
-                    if keys[0]['Key'] == full_key:
-                        return False
-                return True
-        return False
-
-    def get_s3_signed_url(self, key):
+        metadata_cache = S3StorageAdapter.get_metadata_cache()
+        cached = metadata_cache.get(('directory', full_key))
+        if cached is not None:
+            return cached
+
+        # Two keys are enough to tell a directory from a single file with the same name
+        response = self._connection.list_objects_v2(Bucket=current_app.config['S3_BUCKET'],
+                                                    Prefix=full_key,
+                                                    Delimiter=',',
+                                                    MaxKeys=2)
+        keys = response.get('Contents', [])
+        is_directory = len(keys) > 1 or (len(keys) == 1 and keys[0]['Key'] != full_key)
+        metadata_cache.put(('directory', full_key), is_directory,
+                           None if is_directory else current_app.config['S3_METADATA_CACHE_NEGATIVE_TTL'])
+        return is_directory
+
+    def list_keys(self, s3_bucket, prefix):
+        """Yields the objects under prefix, fetching each page of the listing as it is needed"""
+        paginator = self._connection.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=s3_bucket, Prefix=prefix, Delimiter=','):
+            yield from page.get('Contents', [])
+
+    def get_object_range(self, s3_bucket, full_key, byte_range):
+        try:
+            return self._connection.get_object(Bucket=s3_bucket, Key=full_key, Range=byte_range.to_header())
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidRange':
+                raise
+            # The range is beyond the end of the object, get the whole object so its size is known
+            return self._connection.get_object(Bucket=s3_bucket, Key=full_key)
+
+    def read_range(self, s3_bucket, full_key, start, stop, chunk_size=StorageItem.CHUNK_SIZE):
+        response = self._connection.get_object(Bucket=s3_bucket, Key=full_key,
+                                               Range='bytes={}-{}'.format(start, stop - 1))
+        return response['Body'].iter_chunks(chunk_size)
+
+    def get_s3_signed_url(self, key, content_type=None):
+        presigned_urls = S3StorageAdapter.get_presigned_url_cache()
+        cache_key = key if content_type is None else (key, content_type)
+        url = presigned_urls.get(cache_key)
+        if url is not None:
+            return url
+        params = {
+            'Bucket': current_app.config['S3_BUCKET'],
+            'Key': key
+        }
+        if content_type is not None:
+            params['ResponseContentType'] = content_type
         try:
             url = self._connection.generate_presigned_url(
                 ClientMethod='get_object',
-                Params={
-                    'Bucket': current_app.config['S3_BUCKET'],
-                    'Key': key
-                },
+                Params=params,
                 ExpiresIn=current_app.config['S3_URL_EXPIRE_IN_SECONDS']
             )
+            presigned_urls.put(cache_key, url)
             return url
         except ClientError as ex:
             error_message = 'Failed to generate external key for {}. Exception - {}' \
@@ -199,14 +653,122 @@ class S3StorageAdapter(StorageBase):
             current_app.logger.warning(error_message)
             raise ApplicationError(error_message, 'S3-EXTERNAL-URL', 500)
 
+    @staticmethod
+    def get_presigned_url_cache():
+        """Returns the cache of presigned URLs by key. A URL is reused until S3_PRESIGNED_URL_REUSE_FRACTION of
+        S3_URL_EXPIRE_IN_SECONDS has passed, so a URL that is handed out is always valid for the rest"""
+        with S3StorageAdapter._lock:
+            if S3StorageAdapter._presigned_urls is None:
+                ttl = int(current_app.config['S3_URL_EXPIRE_IN_SECONDS']) * \
+                    current_app.config['S3_PRESIGNED_URL_REUSE_FRACTION']
+                S3StorageAdapter._presigned_urls = register_cache(
+                    's3_presigned_urls', LRUCache(current_app.config['S3_PRESIGNED_URL_CACHE_SIZE'], ttl))
+            return S3StorageAdapter._presigned_urls
+
+    @staticmethod
+    def get_metadata_cache():
+        """Returns the cache of what is known about each key: whether it is a file, with its size, content type,
+        file name and hash, and whether it is a directory. Keys found not to exist are only cached for
+        S3_METADATA_CACHE_NEGATIVE_TTL, as another instance may save them"""
+        with S3StorageAdapter._lock:
+            if S3StorageAdapter._metadata is None:
+                S3StorageAdapter._metadata = register_cache(
+                    's3_metadata', LRUCache(current_app.config['S3_METADATA_CACHE_SIZE'],
+                                            current_app.config['S3_METADATA_CACHE_TTL']))
+            return S3StorageAdapter._metadata
+
+    def get_metadata(self, key):
+        """Returns the cached metadata of the key, getting it with a head_object if it isn't cached"""
+        metadata_cache = S3StorageAdapter.get_metadata_cache()
+        metadata = metadata_cache.get(('file', key))
+        if metadata is not None:
+            return metadata
+
+        head = self.head_file(key)
+        if head is None:
+            return self.cache_missing(key)
+        metadata = S3StorageAdapter.get_response_metadata(head)
+        metadata_cache.put(('file', key), metadata)
+        return metadata
+
+    @staticmethod
+    def get_response_metadata(response):
+        """Returns the metadata of the object from a get_object or head_object response, as it is cached. For a
+        reference to deduplicated content the size isn't known and the last modified time is the reference's"""
+        object_metadata = response.get('Metadata', {})
+        return {
+            'exists': True,
+            'size': None if 'content-key' in object_metadata else response.get('ContentLength'),
+            'content_type': object_metadata.get('content-type', response.get('ContentType')),
+            'file_name': object_metadata.get('file-name'),
+            'etag': object_metadata.get('sha256'),
+            'last_modified': response.get('LastModified'),
+            'content_key': object_metadata.get('content-key')}
+
+    @staticmethod
+    def cache_saved(key, storage_item, content_hash, content_key=None):
+        """Records a file this instance has just saved, so reading it back doesn't need a head_object"""
+        S3StorageAdapter.get_metadata_cache().put(('file', key), {
+            'exists': True,
+            'size': storage_item.size,
+            'content_type': storage_item.meta_type,
+            'file_name': storage_item.file_name,
+            'etag': content_hash,
+            'last_modified': None,
+            'content_key': content_key})
+        S3StorageAdapter.invalidate_directories(key)
+
+    @staticmethod
+    def cache_missing(key):
+        metadata = {'exists': False}
+        S3StorageAdapter.get_metadata_cache().put(('file', key), metadata,
+                                                  current_app.config['S3_METADATA_CACHE_NEGATIVE_TTL'])
+        return metadata
+
+    @staticmethod
+    def invalidate_directories(key):
+        """Forgets whether the key and each directory above it is a directory, as adding or removing the key
+        may have changed it"""
+        metadata_cache = S3StorageAdapter.get_metadata_cache()
+        while key:
+            metadata_cache.remove(('directory', key))
+            key = os.path.dirname(key)
+
     def does_file_exist(self, key):
+        return self.get_metadata(key)['exists']
+
+    def head_file(self, key):
+        """Returns the head_object response for the key, or None if the key doesn't exist"""
         try:
-            self._connection.head_object(Bucket=current_app.config['S3_BUCKET'], Key=key)
+            return self._connection.head_object(Bucket=current_app.config['S3_BUCKET'], Key=key)
         except ClientError as e:
             if e.response['Error']['Code'] == '404':
-                return False
+                return None
             raise ApplicationError('Failed to check if key exists. Exception - {}'.format(e), 'S3-EXISTS')
-        return True
+
+    @staticmethod
+    def get_transfer_config():
+        """Returns how uploads are split into parts, and how many parts are sent at once"""
+        return TransferConfig(multipart_threshold=current_app.config['S3_MULTIPART_THRESHOLD'],
+                              multipart_chunksize=current_app.config['S3_MULTIPART_CHUNKSIZE'],
+                              max_concurrency=current_app.config['S3_MULTIPART_CONCURRENCY'])
+
+    @staticmethod
+    def get_stream_size(stream):
+        """Returns the number of bytes from the current position to the end of a seekable stream"""
+        position = stream.tell()
+        stream.seek(0, io.SEEK_END)
+        size = stream.tell() - position
+        stream.seek(position)
+        return size
+
+    @staticmethod
+    def get_listing_fingerprint(keys):
+        return listing_fingerprint((s3_key['Key'], s3_key.get('Size'), s3_key.get('ETag')) for s3_key in keys)
+
+    @staticmethod
+    def get_content_reference_key(content_hash, full_key):
+        return '{}{}/{}'.format(CONTENT_REFERENCES_PREFIX, content_hash, full_key)
 
     @staticmethod
     def get_full_key(bucket, file_id, subdirectories=None):
@@ -1,15 +1,37 @@
 from abc import ABCMeta, abstractmethod
 
+from flask import current_app
+from storage_api.dependencies.storage.archive_cache import ArchiveCache
+
 
 class StorageBase(metaclass=ABCMeta):
     @abstractmethod
-    def get_file(self, bucket, file_id, subdirectories=None):
+    def get_file(self, bucket, file_id, subdirectories=None, byte_range=None):
+        raise NotImplementedError()
+
+    def resolve(self, bucket, file_id, subdirectories=None, byte_range=None, archive_name=None):
+        """Finds whatever is stored as file_id, returning (stored_item, is_directory).
+
+        A directory is returned as a zip archive of its files. stored_item is None if nothing is stored as file_id.
+        Storage types where checking for a directory is costly can override this to look for a file first.
+        """
+        if self.is_directory(bucket, file_id, subdirectories):
+            return self.zip_directory(bucket, file_id, subdirectories, archive_name), True
+        return self.get_file(bucket, file_id, subdirectories, byte_range=byte_range), False
+
+    @abstractmethod
+    def get_etag(self, bucket, file_id, subdirectories=None):
         raise NotImplementedError()
 
     @abstractmethod
     def get_file_external_url(self, bucket, file_id, subdirectories=None):
         raise NotImplementedError()
 
+    def get_file_external_urls(self, bucket, files):
+        """Returns a list with, for each (file_id, subdirectories) in files, what get_file_external_url returns for
+        it. Storage types that can look up many files at once should override this."""
+        return [self.get_file_external_url(bucket, file_id, subdirectories) for file_id, subdirectories in files]
+
     @abstractmethod
     def zip_directory(self, bucket, file_id, subdirectories, name):
         raise NotImplementedError()
@@ -22,6 +44,37 @@ class StorageBase(metaclass=ABCMeta):
     def delete_file(self, bucket, file_id, subdirectories=None):
         raise NotImplementedError()
 
+    def delete_files(self, bucket, files):
+        """Deletes each (file_id, subdirectories) in files, returning a list with, for each file, True if it was
+        deleted, False if it wasn't found or None if deleting it failed.
+
+        Storage types that can delete many files at once should override this.
+        """
+        results = []
+        for file_id, subdirectories in files:
+            try:
+                results.append(self.delete_file(bucket, file_id, subdirectories))
+            except Exception as ex:
+                current_app.logger.exception('Failed to delete {}. Exception - {}'.format(file_id, ex))
+                results.append(None)
+        return results
+
     @abstractmethod
     def save_file(self, bucket, storage_item, subdirectories=None):
         raise NotImplementedError()
+
+    @staticmethod
+    def is_reserved_bucket(bucket):
+        """Returns whether bucket is a name the API can't use, as the storage type keeps something of its own
+        there. Hidden folders, such as the default FILE_INDEX_LOCATION and ARCHIVE_CACHE_LOCATION, are never
+        buckets"""
+        return bucket.startswith('.')
+
+    @staticmethod
+    def get_archive_cache():
+        """Returns the cache of generated directory archives, or None if it is disabled"""
+        if not current_app.config['ARCHIVE_CACHE_ENABLED']:
+            return None
+        return ArchiveCache(current_app.config['ARCHIVE_CACHE_LOCATION'],
+                            current_app.config['ARCHIVE_CACHE_MAX_SIZE'],
+                            current_app.config['ARCHIVE_CACHE_TTL'])
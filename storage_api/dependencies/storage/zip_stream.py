@@ -0,0 +1,100 @@
+import io
+import time
+import zipfile
+from collections import namedtuple
+
+# A file to add to a ZipStream. chunks is an iterable of bytes, modified is a datetime or None
+ZipMember = namedtuple('ZipMember', ['name', 'chunks', 'modified'])
+
+
+class _ChunkSink(object):
+    """Write-only, unseekable file that zipfile writes the archive into, collecting the bytes until drained"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        if data:
+            self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        if self._chunks:
+            data = b''.join(self._chunks)
+            self._chunks = []
+            yield data
+
+
+class ZipStream(object):
+    """Generates a zip archive as an iterator of bytes, reading each member only as the archive is consumed.
+
+    As the output can't be seeked, zipfile writes sizes and CRCs in data descriptors after each member rather
+    than in the local headers. ZIP64 is always used for members as their size isn't known up front.
+    """
+
+    def __init__(self, members, compression=zipfile.ZIP_DEFLATED):
+        self.members = members
+        self.compression = compression
+        self._iterator = None
+
+    def __iter__(self):
+        if self._iterator is None:
+            self._iterator = self._generate()
+        return self._iterator
+
+    def close(self):
+        if self._iterator is not None:
+            self._iterator.close()
+        close_members = getattr(self.members, 'close', None)
+        if close_members is not None:
+            close_members()
+
+    def _generate(self):
+        sink = _ChunkSink()
+        with zipfile.ZipFile(sink, 'w', self.compression) as archive:
+            for member in self.members:
+                info = zipfile.ZipInfo(member.name, self._date_time(member.modified))
+                info.compress_type = self.compression
+                with archive.open(info, 'w', force_zip64=True) as member_file:
+                    for chunk in member.chunks:
+                        member_file.write(chunk)
+                        yield from sink.drain()
+                yield from sink.drain()
+        yield from sink.drain()
+
+    @staticmethod
+    def _date_time(modified):
+        if modified is None:
+            return time.localtime(time.time())[:6]
+        # Zip files can't hold dates before 1980
+        return max(modified.timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+
+
+class IteratorFile(io.RawIOBase):
+    """Read-only file over an iterator of bytes, for APIs that need a file rather than an iterator"""
+
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        # Fill the whole buffer where possible, as some readers treat a short read as the end of the file
+        filled = 0
+        while filled < len(buffer):
+            if not self._buffer:
+                try:
+                    self._buffer = next(self._iterator)
+                except StopIteration:
+                    break
+                continue
+            size = min(len(buffer) - filled, len(self._buffer))
+            buffer[filled:filled + size] = self._buffer[:size]
+            self._buffer = self._buffer[size:]
+            filled += size
+        return filled
@@ -5,10 +5,19 @@ from storage_api.dependencies.storage.s3_storage_adapter import \
     S3StorageAdapter
 
 
-def get_storage_type():
+def get_storage_type_class():
     if current_app.config["STORAGE_TYPE"].lower() == 'file':
-        return FileStorageAdapter()
+        return FileStorageAdapter
     elif current_app.config["STORAGE_TYPE"].lower() == 's3':
-        return S3StorageAdapter()
+        return S3StorageAdapter
     else:
         raise NotImplementedError('no service implemented for {0}'.format(current_app.config["STORAGE_TYPE"]))
+
+
+def is_reserved_bucket(bucket):
+    # Checked on the class, so no connection to the storage is needed
+    return get_storage_type_class().is_reserved_bucket(bucket)
+
+
+def get_storage_type():
+    return get_storage_type_class()()
@@ -0,0 +1,187 @@
+import base64
+import binascii
+import hashlib
+import json
+import threading
+import time
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from flask import current_app, g
+from jwt_validation.exceptions import ValidationFailure
+from storage_api.cache import LRUCache, register_cache
+
+# Hash for each RSASSA-PKCS1-v1_5 algorithm
+RSA_ALGORITHMS = {
+    'RS256': hashes.SHA256,
+    'RS384': hashes.SHA384,
+    'RS512': hashes.SHA512
+}
+# Fewest seconds between fetches of the signing keys for tokens signed with a key that isn't known
+SIGNING_KEYS_REFRESH_INTERVAL = 60
+
+_validations = None
+_signing_keys = None
+_signing_keys_fetched = None
+_lock = threading.Lock()
+
+
+def get_validation_cache():
+    """Returns the cache of successful validations, or None if JWT_VALIDATION_CACHE_SIZE is 0"""
+    global _validations
+    with _lock:
+        if _validations is None and current_app.config['JWT_VALIDATION_CACHE_SIZE'] > 0:
+            _validations = register_cache('jwt_validations', LRUCache(current_app.config['JWT_VALIDATION_CACHE_SIZE'],
+                                                                      current_app.config['JWT_VALIDATION_CACHE_TTL']))
+        return _validations
+
+
+def is_valid(token):
+    """Returns True if token is known to be valid, from a cached validation or by verifying its signature
+    against the keys at JWT_SIGNING_KEYS_URL, or False if it has to be validated by authentication-api.
+    Raises ValidationFailure if verifying the token locally finds it invalid.
+
+    Only tokens with an exp claim are cached or verified locally.
+    """
+    claims = get_claims(token)
+    if claims is None:
+        return False
+    cache = get_validation_cache()
+    if cache is not None and cache.get(get_cache_key(token)):
+        return True
+    if not current_app.config['JWT_SIGNING_KEYS_URL']:
+        return False
+
+    verified = verify_signature(token)
+    if verified is None:
+        return False
+    if not verified:
+        raise ValidationFailure("Invalid token signature")
+    now = time.time()
+    if claims['exp'] <= now:
+        raise ValidationFailure("Token has expired")
+    if isinstance(claims.get('nbf'), (int, float)) and claims['nbf'] > now:
+        raise ValidationFailure("Token is not yet valid")
+    if current_app.config['JWT_ISSUER'] and claims.get('iss') != current_app.config['JWT_ISSUER']:
+        raise ValidationFailure("Token has an invalid issuer")
+    if current_app.config['JWT_AUDIENCE'] and current_app.config['JWT_AUDIENCE'] not in get_audience(claims):
+        raise ValidationFailure("Token has an invalid audience")
+    add_valid(token)
+    return True
+
+
+def add_valid(token):
+    """Caches a successful validation of token until JWT_VALIDATION_CACHE_TTL seconds have passed or the token
+    expires, whichever is sooner"""
+    claims = get_claims(token)
+    cache = get_validation_cache()
+    if claims is None or cache is None:
+        return
+    cache.put(get_cache_key(token), True, min(current_app.config['JWT_VALIDATION_CACHE_TTL'],
+                                              claims['exp'] - time.time()))
+
+
+def get_cache_key(token):
+    # The token itself isn't kept, so the cache holds nothing that could be used to authenticate
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def get_claims(token):
+    """Returns the payload of a JWT, which may be prefixed with Bearer, without verifying it. Returns None if it
+    can't be decoded or has no exp claim"""
+    parts = get_parts(token)
+    if parts is None:
+        return None
+    try:
+        claims = json.loads(decode_segment(parts[1]))
+    except ValueError:
+        return None
+    if not isinstance(claims, dict) or not isinstance(claims.get('exp'), (int, float)):
+        return None
+    return claims
+
+
+def get_audience(claims):
+    # aud may be a single audience or a list of them
+    audience = claims.get('aud')
+    return [audience] if isinstance(audience, str) else audience if isinstance(audience, list) else []
+
+
+def get_parts(token):
+    if token[:7].lower() == 'bearer ':
+        token = token[7:]
+    parts = token.strip().split('.')
+    return parts if len(parts) == 3 else None
+
+
+def decode_segment(segment):
+    try:
+        return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+    except (binascii.Error, ValueError) as ex:
+        raise ValueError('Invalid base64url segment') from ex
+
+
+def verify_signature(token):
+    """Returns whether token's signature was made with one of the signing keys, or None if it can't be verified
+    locally, such as when its algorithm isn't supported or its key can't be fetched"""
+    header_segment, payload_segment, signature_segment = get_parts(token)
+    try:
+        header = json.loads(decode_segment(header_segment))
+        signature = decode_segment(signature_segment)
+    except ValueError:
+        return False
+    if not isinstance(header, dict) or header.get('alg') not in RSA_ALGORITHMS:
+        return None
+
+    key = get_signing_key(header.get('kid'))
+    if key is None:
+        return None
+    message = '{}.{}'.format(header_segment, payload_segment).encode('ascii')
+    return verify_rsa(message, signature, key, header['alg'])
+
+
+def verify_rsa(message, signature, key, algorithm):
+    """Verifies an RSASSA-PKCS1-v1_5 signature with an RSA public key"""
+    try:
+        key.verify(signature, message, padding.PKCS1v15(), RSA_ALGORITHMS[algorithm]())
+    except InvalidSignature:
+        return False
+    return True
+
+
+def get_signing_key(key_id):
+    """Returns the public key of the signing key with key_id, fetching the keys from JWT_SIGNING_KEYS_URL
+    when they are older than JWT_SIGNING_KEYS_TTL seconds or don't include key_id"""
+    global _signing_keys, _signing_keys_fetched
+    with _lock:
+        keys = _signing_keys
+        fetched = _signing_keys_fetched
+    age = time.monotonic() - fetched if fetched is not None else None
+    if keys is not None and age < current_app.config['JWT_SIGNING_KEYS_TTL'] and \
+            (key_id in keys or age < SIGNING_KEYS_REFRESH_INTERVAL):
+        return keys.get(key_id)
+
+    try:
+        response = g.requests.get(current_app.config['JWT_SIGNING_KEYS_URL'])
+        response.raise_for_status()
+        keys = parse_signing_keys(response.json())
+    except Exception as ex:
+        current_app.logger.warning('Failed to fetch the token signing keys. Exception - {}'.format(ex))
+        keys = keys or {}
+    with _lock:
+        _signing_keys = keys
+        _signing_keys_fetched = time.monotonic()
+    return keys.get(key_id)
+
+
+def parse_signing_keys(jwks):
+    """Returns the RSA signing keys of a JSON Web Key Set as a dict of public keys by key id"""
+    keys = {}
+    for key in jwks.get('keys', []):
+        if key.get('kty') != 'RSA' or key.get('use', 'sig') != 'sig':
+            continue
+        numbers = rsa.RSAPublicNumbers(int.from_bytes(decode_segment(key['e']), 'big'),
+                                       int.from_bytes(decode_segment(key['n']), 'big'))
+        keys[key.get('kid')] = numbers.public_key()
+    return keys
@@ -0,0 +1,241 @@
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+from flask import current_app
+from storage_api.cache import LRUCache, register_cache
+from storage_api.dependencies.storage.content_hash import hash_stream
+
+CHUNK_SIZE = 64 * 1024
+
+_scanner = None
+_scanner_lock = threading.Lock()
+
+
+def get_virus_scanner():
+    """Returns the scanner for the clamd configured by CLAMD_HOST and CLAMD_PORT, or CLAMD_SOCKET if they
+    aren't set. The scanner is shared so its connections are reused across requests"""
+    global _scanner
+    with _scanner_lock:
+        if _scanner is None:
+            if current_app.config['CLAMD_HOST'] and current_app.config['CLAMD_PORT']:
+                address = (current_app.config['CLAMD_HOST'], current_app.config['CLAMD_PORT'])
+                family = socket.AF_INET
+            else:
+                address = current_app.config['CLAMD_SOCKET']
+                family = socket.AF_UNIX
+            verdicts = None
+            if current_app.config['CLAMD_VERDICT_CACHE_SIZE'] > 0:
+                verdicts = register_cache('clamd_verdicts', LRUCache(current_app.config['CLAMD_VERDICT_CACHE_SIZE'],
+                                                                     current_app.config['CLAMD_VERDICT_CACHE_TTL']))
+            _scanner = ClamdScanner(address, family,
+                                    pool_size=current_app.config['CLAMD_POOL_SIZE'],
+                                    timeout=current_app.config['CLAMD_TIMEOUT'],
+                                    health_check_interval=current_app.config['CLAMD_HEALTH_CHECK_INTERVAL'],
+                                    verdicts=verdicts,
+                                    version_check_interval=current_app.config['CLAMD_VERSION_CHECK_INTERVAL'])
+        return _scanner
+
+
+class ScanError(Exception):
+    """Raised when a file couldn't be scanned, so whether it holds a threat isn't known"""
+
+
+class ClamdScanner(object):
+    """Scans files with clamd, sending them in chunks with the INSTREAM command so a file is never held in memory.
+
+    Up to pool_size connections are kept open as clamd sessions and reused by later scans. A connection that
+    has been idle for more than health_check_interval seconds is checked with a PING before it is reused, as
+    clamd closes sessions that are idle for too long. Each scan, including waiting for a free connection,
+    fails with a ScanError if it takes more than timeout seconds.
+
+    If given a verdicts cache, the verdict for each file is cached by the hash of its content and the version of
+    clamd and its signature database, so the same content isn't scanned again until the signatures are updated.
+    The version is checked at most every version_check_interval seconds. If it can't be read, every file is
+    scanned, as a cached verdict might be from older signatures.
+    """
+
+    def __init__(self, address, family=socket.AF_UNIX, pool_size=4, timeout=60, health_check_interval=10,
+                 chunk_size=CHUNK_SIZE, verdicts=None, version_check_interval=60):
+        self.address = address
+        self.family = family
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.chunk_size = chunk_size
+        self.verdicts = verdicts
+        self.version_check_interval = version_check_interval
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(pool_size, 1))
+        self._version = None
+        self._version_checked = None
+
+    def scan(self, file):
+        """Returns the name of the threat found in the rest of file, or None if none was found"""
+        version = self.get_version() if self.verdicts is not None else None
+        if version is None:
+            return self._scan(file)
+
+        key = (hash_stream(file), version)
+        verdict = self.verdicts.get(key)
+        if verdict is None:
+            verdict = (self._scan(file),)
+            self.verdicts.put(key, verdict)
+        return verdict[0]
+
+    def get_version(self):
+        """Returns the version of clamd and its signature database, such as 0.103.8/26914, or None if it can't be
+        read"""
+        with self._lock:
+            if self._version_checked is not None and \
+                    time.monotonic() - self._version_checked < self.version_check_interval:
+                return self._version
+        try:
+            # Such as ClamAV 0.103.8/26914/Mon Jun 12 07:54:16 2023
+            reply = self._run(ClamdConnection.version)
+            engine, separator, database = reply.partition(' ')[2].partition('/')
+            version = '{}/{}'.format(engine, database.partition('/')[0]) if engine and database else None
+        except ScanError as ex:
+            current_app.logger.warning('Failed to get the clamd version. Exception - {}'.format(ex))
+            version = None
+        with self._lock:
+            self._version = version
+            self._version_checked = time.monotonic()
+        return version
+
+    def _scan(self, file):
+        reply = self._run(ClamdConnection.instream, self._iter_chunks(file))
+        if reply.endswith('FOUND'):
+            return reply[len('stream:'):-len('FOUND')].strip()
+        return None
+
+    def _run(self, command, *args):
+        """Runs a ClamdConnection command on a pooled connection, returning clamd's reply"""
+        deadline = time.monotonic() + self.timeout
+        if not self._slots.acquire(timeout=self.timeout):
+            raise ScanError('Timed out waiting for a clamd connection')
+        try:
+            connection = self._get_connection(deadline)
+            try:
+                reply = command(connection, *args, deadline=deadline)
+            except Exception as ex:
+                connection.close()
+                raise ScanError('Failed to scan with clamd. Exception - {}'.format(ex)) from ex
+
+            if reply.endswith('ERROR'):
+                # Such as the file being larger than clamd's StreamMaxLength, after which clamd ends the session
+                connection.close()
+                raise ScanError('clamd failed to scan. Reply - {}'.format(reply))
+            self._release(connection)
+            return reply
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Closes the idle connections"""
+        with self._lock:
+            while self._idle:
+                self._idle.pop().close()
+
+    def _get_connection(self, deadline):
+        while True:
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                try:
+                    return ClamdConnection(self.address, self.family, deadline)
+                except OSError as ex:
+                    raise ScanError('Failed to connect to clamd. Exception - {}'.format(ex)) from ex
+            if time.monotonic() - connection.last_used <= self.health_check_interval:
+                return connection
+            try:
+                if connection.ping(deadline):
+                    return connection
+            except OSError:
+                pass
+            connection.close()
+
+    def _release(self, connection):
+        with self._lock:
+            self._idle.append(connection)
+
+    def _iter_chunks(self, file):
+        while True:
+            chunk = file.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class ClamdConnection(object):
+    """A connection to clamd in an IDSESSION, which runs any number of commands on one connection"""
+
+    def __init__(self, address, family, deadline):
+        self._socket = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            self._set_timeout(deadline)
+            self._socket.connect(address)
+            self._socket.sendall(b'zIDSESSION\0')
+        except Exception:
+            self._socket.close()
+            raise
+        self._next_id = 1
+        self._buffer = b''
+        self.last_used = time.monotonic()
+
+    def ping(self, deadline):
+        return self._command(b'PING', (), deadline) == 'PONG'
+
+    def version(self, deadline):
+        return self._command(b'VERSION', (), deadline)
+
+    def instream(self, chunks, deadline):
+        """Sends chunks to clamd to be scanned as one stream, returning clamd's reply"""
+        return self._command(b'INSTREAM', chunks, deadline)
+
+    def close(self):
+        try:
+            self._socket.sendall(b'zEND\0')
+        except OSError:
+            pass
+        self._socket.close()
+
+    def _command(self, command, chunks, deadline):
+        request_id = self._next_id
+        self._next_id += 1
+
+        self._set_timeout(deadline)
+        self._socket.sendall(b'z' + command + b'\0')
+        if command == b'INSTREAM':
+            for chunk in chunks:
+                self._set_timeout(deadline)
+                self._socket.sendall(struct.pack('!L', len(chunk)))
+                self._socket.sendall(chunk)
+            self._set_timeout(deadline)
+            self._socket.sendall(struct.pack('!L', 0))
+
+        reply = self._read_reply(deadline)
+        self.last_used = time.monotonic()
+        # Replies in a session start with the id of the command they answer
+        reply_id, separator, reply = reply.partition(': ')
+        if reply_id != str(request_id):
+            raise ConnectionError('Unexpected reply from clamd - {}'.format(reply))
+        return reply
+
+    def _read_reply(self, deadline):
+        while b'\0' not in self._buffer:
+            self._set_timeout(deadline)
+            data = self._socket.recv(4096)
+            if not data:
+                raise ConnectionError('clamd closed the connection')
+            self._buffer += data
+        reply, separator, self._buffer = self._buffer.partition(b'\0')
+        return reply.decode('utf-8', 'replace').strip()
+
+    def _set_timeout(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout('Timed out talking to clamd')
+        self._socket.settimeout(remaining)
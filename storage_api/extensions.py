@@ -1,6 +1,10 @@
-import collections
+import atexit
 import json
 import logging
+import os
+import queue
+import sys
+import threading
 import traceback
 
 from flask import ctx, g, request
@@ -41,23 +45,151 @@ class JsonFormatter(logging.Formatter):
             exc = None
 
         # Timestamp must be first (webops request)
-        log_entry = collections.OrderedDict(
+        return encode_log_entry(
             [('timestamp', self.formatTime(record)),
              ('level', record.levelname),
              ('traceid', record.trace_id),
              ('message', record.msg % record.args),
              ('exception', exc)])
 
-        return json.dumps(log_entry)
-
 
 class JsonAuditFormatter(logging.Formatter):
     def format(self, record):
         # Timestamp must be first (webops request)
-        log_entry = collections.OrderedDict(
+        return encode_log_entry(
             [('timestamp', self.formatTime(record)),
              ('level', 'AUDIT'),
              ('traceid', record.trace_id),
              ('message', record.msg % record.args)])
 
-        return json.dumps(log_entry)
+
+# The C accelerated string encoder json.dumps uses, where it is available
+_encode_string = json.encoder.encode_basestring_ascii
+
+
+def encode_log_entry(items):
+    """Encodes (key, value) pairs as a JSON object, giving exactly what json.dumps gives for them in an OrderedDict.
+    The strings and lists of strings log entries are made of are encoded directly, which is quicker than going
+    through json.dumps"""
+    return '{' + ', '.join(_encode_string(key) + ': ' + encode_log_value(value) for key, value in items) + '}'
+
+
+def encode_log_value(value):
+    if value is None:
+        return 'null'
+    if type(value) is str:
+        return _encode_string(value)
+    if type(value) is list and all(type(item) is str for item in value):
+        return '[' + ', '.join(map(_encode_string, value)) + ']'
+    return json.dumps(value)
+
+
+_log_writers = {}
+_log_writers_lock = threading.Lock()
+
+
+def get_log_writer(stream, max_size):
+    """Returns the LogWriter for stream, so every handler writing to a stream shares one queue and keeps the
+    order of its lines"""
+    with _log_writers_lock:
+        writer = _log_writers.get(id(stream))
+        if writer is None:
+            writer = _log_writers[id(stream)] = LogWriter(stream, max_size)
+        return writer
+
+
+class LogWriter(object):
+    """Writes lines to a stream from a background thread, holding up to max_size lines waiting to be written.
+
+    Lines that don't fit in the queue are dropped unless added with block, and a warning saying how many were
+    dropped is written once the queue has been emptied.
+
+    The thread is started by the first line written in each process, so a worker forked after the app is loaded,
+    such as by gunicorn --preload, starts a thread of its own rather than queueing lines nothing will write.
+    """
+
+    def __init__(self, stream, max_size):
+        self.stream = stream
+        self.max_size = max(max_size, 1)
+        self.dropped = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        atexit.register(self.stop)
+
+    def write(self, line, block=False):
+        """Queues line to be written, returning False if it was dropped"""
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put(line, block=block)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+
+    def stop(self, timeout=5):
+        """Writes the lines already queued and stops the thread"""
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # Anything queued in the parent process is left for the parent's thread to write
+            self.dropped = 0
+            self._queue = queue.Queue(self.max_size)
+            self._thread = threading.Thread(target=self._run, args=(self._queue,), name='log-writer', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self, lines):
+        while True:
+            line = lines.get()
+            try:
+                if line is not None:
+                    self.stream.write(line + '\n')
+                if line is None or lines.empty():
+                    # Every line queued before any that were dropped has now been written
+                    self._write_dropped_warning()
+                    self.stream.flush()
+            except Exception:
+                # There's nowhere left to report a failure to write the log
+                pass
+            if line is None:
+                return
+
+    def _write_dropped_warning(self):
+        with self._lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            message = '{} log records were dropped as the log queue was full'.format(dropped)
+            record = logging.makeLogRecord({'levelname': 'WARNING', 'trace_id': 'N/A', 'exc_info': None,
+                                            'msg': message})
+            self.stream.write(JsonFormatter().format(record) + '\n')
+
+
+class QueueingStreamHandler(logging.Handler):
+    """Formats records in the thread logging them, then hands them to a LogWriter to be written to stream, so
+    logging doesn't wait for the stream. overflow sets what happens to a record when max_size records are already
+    waiting, either drop or block until there is room"""
+
+    def __init__(self, stream=None, max_size=10000, overflow='drop'):
+        super(QueueingStreamHandler, self).__init__()
+        self.overflow = overflow
+        self.writer = get_log_writer(stream if stream is not None else sys.stdout, max_size)
+
+    def emit(self, record):
+        try:
+            self.writer.write(self.format(record), block=self.overflow == 'block')
+        except Exception:
+            self.handleError(record)
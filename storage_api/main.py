@@ -1,8 +1,10 @@
 from storage_api.app import app
 from storage_api.blueprints import register_blueprints
+from storage_api.commands import register_commands
 from storage_api.exceptions import register_exception_handlers
 from storage_api.extensions import register_extensions
 
 register_extensions(app)
 register_exception_handlers(app)
 register_blueprints(app)
+register_commands(app)
@@ -4,8 +4,45 @@ class StorageItem(object):
     meta_type = None
     file = None
     file_name = None
+    path = None
+    size = None
+    last_modified = None
+    etag = None
+    content_range = None
+    range_reader = None
 
-    def __init__(self, file, mime, file_name):
+    CHUNK_SIZE = 64 * 1024
+    chunk_size = CHUNK_SIZE
+
+    def __init__(self, file, mime, file_name, path=None, size=None, last_modified=None, etag=None):
         self.meta_type = mime
         self.file = file
         self.file_name = file_name
+        # Absolute path of the file on local disk, if the storage type has one
+        self.path = path
+        # Size in bytes and last modified datetime of the whole stored object, if known
+        self.size = size
+        self.last_modified = last_modified
+        # Content hash of the stored object, used as a strong ETag
+        self.etag = etag
+
+    def read_range(self, start, stop):
+        """Returns an iterator over the bytes of the stored object from start up to (but excluding) stop.
+
+        If file only holds part of the object, content_range is set to the (start, stop) it holds and
+        range_reader is used to fetch any other part of the object.
+        """
+        if self.content_range is not None and self.content_range == (start, stop):
+            return self._iter_file(stop - start)
+        if self.range_reader is not None:
+            return self.range_reader(start, stop)
+        self.file.seek(start)
+        return self._iter_file(stop - start)
+
+    def _iter_file(self, length):
+        while length > 0:
+            chunk = self.file.read(min(self.chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
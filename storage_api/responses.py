@@ -0,0 +1,176 @@
+import os
+import uuid
+from urllib.parse import quote
+
+from flask import Response, current_app, request, send_file, stream_with_context
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+
+# Serve the file by streaming it through the application
+SERVE_MODE_STREAM = 'stream'
+# Serve the file from its path so the WSGI server can hand the file descriptor to the kernel's sendfile
+SERVE_MODE_SENDFILE = 'sendfile'
+# Return an X-Sendfile header so a fronting Apache/lighttpd serves the file
+SERVE_MODE_X_SENDFILE = 'x-sendfile'
+# Return an X-Accel-Redirect header so a fronting nginx serves the file
+SERVE_MODE_X_ACCEL_REDIRECT = 'x-accel-redirect'
+
+# Requests for more ranges than this are answered with the whole file
+MAX_RANGES = 50
+
+
+def send_storage_item(stored_item, as_attachment=False):
+    """Builds the response for a StorageItem retrieved from a storage type.
+
+    Items that exist on local disk are served using FILE_SERVE_MODE, anything else is streamed. Items whose
+    file is an iterable of bytes rather than a file are streamed as they are generated. Range requests are
+    answered with 206 Partial Content when the size of the item is known.
+    """
+    serve_mode = SERVE_MODE_STREAM
+    if stored_item.path is not None:
+        serve_mode = current_app.config['FILE_SERVE_MODE'].lower()
+
+    download_name = stored_item.file_name if as_attachment else None
+
+    if serve_mode in (SERVE_MODE_X_SENDFILE, SERVE_MODE_X_ACCEL_REDIRECT):
+        # The fronting web server deals with any range request itself
+        stored_item.file.close()
+        response = Response(mimetype=stored_item.meta_type)
+        if serve_mode == SERVE_MODE_X_SENDFILE:
+            response.headers['X-Sendfile'] = stored_item.path
+        else:
+            response.headers['X-Accel-Redirect'] = get_accel_redirect_uri(stored_item.path)
+        if as_attachment:
+            response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+        set_validators(response, stored_item)
+        return response
+
+    if not hasattr(stored_item.file, 'read'):
+        # Generated content such as a ZipStream, sent as it is produced
+        response = Response(stream_with_context(stored_item.file), mimetype=stored_item.meta_type)
+        response.call_on_close(stored_item.file.close)
+        if as_attachment:
+            response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+        return response
+
+    ranges = get_requested_ranges(stored_item)
+    if ranges is not None:
+        response = send_ranges(stored_item, ranges)
+    elif stored_item.content_range is not None:
+        # The file can only be read from the start, or holds part of the item when the whole item is needed
+        response = Response(stored_item.read_range(0, stored_item.size), mimetype=stored_item.meta_type)
+        response.content_length = stored_item.size
+        response.call_on_close(stored_item.file.close)
+    elif serve_mode == SERVE_MODE_SENDFILE:
+        stored_item.file.close()
+        response = send_file(stored_item.path, mimetype=stored_item.meta_type, as_attachment=as_attachment,
+                             download_name=download_name, conditional=stored_item.size is None, etag=False)
+    else:
+        # Range requests have already been dealt with if the size is known
+        response = send_file(stored_item.file, mimetype=stored_item.meta_type, as_attachment=as_attachment,
+                             download_name=download_name, conditional=stored_item.size is None)
+
+    if as_attachment and 'Content-Disposition' not in response.headers:
+        response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    if stored_item.size is not None:
+        response.accept_ranges = 'bytes'
+    set_validators(response, stored_item)
+    return response
+
+
+def set_validators(response, stored_item):
+    """Sets the Last-Modified and ETag of the item on its response, so clients can make conditional requests"""
+    if stored_item.last_modified is not None:
+        response.last_modified = stored_item.last_modified
+    if stored_item.etag is not None:
+        response.set_etag(stored_item.etag)
+
+
+def send_not_modified(etag):
+    """Builds the 304 response for a conditional request whose If-None-Match matched the ETag"""
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def get_requested_ranges(stored_item):
+    """Returns the satisfiable (start, stop) byte ranges requested for the item.
+
+    None is returned if the whole item should be sent instead, either because no usable Range header was
+    sent, the If-Range validator doesn't match, or the size of the item isn't known.
+    """
+    byte_range = request.range
+    if byte_range is None or byte_range.units != 'bytes' or stored_item.size is None:
+        return None
+    if len(byte_range.ranges) > MAX_RANGES:
+        return None
+    if 'If-Range' in request.headers and not if_range_matches(stored_item):
+        return None
+
+    size = stored_item.size
+    ranges = []
+    for start, stop in byte_range.ranges:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+
+def if_range_matches(stored_item):
+    if_range = request.if_range
+    if if_range.etag is not None:
+        # If-Range requires a strong comparison, so weak ETags never match
+        if request.headers['If-Range'].startswith('W/'):
+            return False
+        return stored_item.etag is not None and stored_item.etag == if_range.etag
+    if if_range.date is not None and stored_item.last_modified is not None:
+        return stored_item.last_modified.replace(microsecond=0) == if_range.date
+    return False
+
+
+def send_ranges(stored_item, ranges):
+    size = stored_item.size
+    if not ranges:
+        stored_item.file.close()
+        raise RequestedRangeNotSatisfiable(length=size)
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        response = Response(stored_item.read_range(start, stop), status=206, mimetype=stored_item.meta_type)
+        response.content_range = ContentRange('bytes', start, stop, size)
+        response.content_length = stop - start
+    else:
+        boundary = uuid.uuid4().hex
+        parts = []
+        content_length = 0
+        for start, stop in ranges:
+            part_header = '--{}\r\nContent-Type: {}\r\nContent-Range: {}\r\n\r\n'.format(
+                boundary, stored_item.meta_type, ContentRange('bytes', start, stop, size).to_header()).encode()
+            parts.append((part_header, start, stop))
+            content_length += len(part_header) + (stop - start) + 2
+        closing = '--{}--\r\n'.format(boundary).encode()
+        content_length += len(closing)
+
+        def generate():
+            for part_header, start, stop in parts:
+                yield part_header
+                yield from stored_item.read_range(start, stop)
+                yield b'\r\n'
+            yield closing
+
+        response = Response(generate(), status=206,
+                            content_type='multipart/byteranges; boundary={}'.format(boundary))
+        response.content_length = content_length
+
+    response.call_on_close(stored_item.file.close)
+    return response
+
+
+def get_accel_redirect_uri(path):
+    """Maps a path inside FILE_STORAGE_LOCATION on to the internal nginx location that serves it"""
+    relative_path = os.path.relpath(path, os.path.abspath(current_app.config['FILE_STORAGE_LOCATION']))
+    return '{}/{}'.format(current_app.config['FILE_ACCEL_REDIRECT_LOCATION'].rstrip('/'),
+                          quote(relative_path.replace(os.sep, '/')))
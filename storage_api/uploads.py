@@ -0,0 +1,103 @@
+import io
+import tempfile
+
+from werkzeug.sansio.multipart import Data, Epilogue, File, MultipartDecoder, NeedData
+
+CHUNK_SIZE = 64 * 1024
+
+
+class MultipartStream(object):
+    """Parses a multipart/form-data body as it is read, yielding (field name, StreamedFile) for each file.
+
+    A file's content is read from the request body as the file is read, so each file has to be read before
+    the next one is yielded, and any of it left unread is skipped. Fields that aren't files are skipped.
+
+    If reading or parsing the body fails, the exception is kept in error, as whatever was reading the file at
+    the time may have replaced it with its own.
+    """
+
+    def __init__(self, stream, boundary, chunk_size=CHUNK_SIZE):
+        self._stream = stream
+        self._decoder = MultipartDecoder(boundary)
+        self.chunk_size = chunk_size
+        self.error = None
+
+    def __iter__(self):
+        events = self._events()
+        for event in events:
+            if isinstance(event, File):
+                streamed_file = StreamedFile(event, events)
+                yield event.name, streamed_file
+                streamed_file.skip()
+
+    def _events(self):
+        """Yields the parts and their data as the body is read, skipping the data of fields that aren't files"""
+        in_file = False
+        while True:
+            try:
+                event = self._decoder.next_event()
+                if isinstance(event, NeedData):
+                    self._decoder.receive_data(self._stream.read(self.chunk_size) or None)
+                    continue
+            except Exception as ex:
+                self.error = ex
+                raise
+            if isinstance(event, Epilogue):
+                return
+            if isinstance(event, File):
+                in_file = True
+            elif isinstance(event, Data):
+                if not in_file:
+                    continue
+                in_file = event.more_data
+            else:
+                in_file = False
+            yield event
+
+
+class StreamedFile(io.RawIOBase):
+    """Read-only, unseekable file over the data of one part of a MultipartStream"""
+
+    def __init__(self, part, events):
+        self.name = part.name
+        self.filename = part.filename
+        self.content_type = part.headers.get('Content-Type')
+        self._events = events
+        self._buffer = b''
+        self._more_data = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer and self._more_data:
+            event = next(self._events)
+            self._buffer = event.data
+            self._more_data = event.more_data
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def skip(self):
+        """Reads past whatever is left of the part, so the body is at the start of the next part"""
+        while self._more_data:
+            self._more_data = next(self._events).more_data
+        self._buffer = b''
+
+
+def spool(source, max_memory_size):
+    """Copies a stream into a temporary file, kept in memory until it is larger than max_memory_size bytes,
+    and returns the temporary file ready to be read"""
+    spooled = tempfile.SpooledTemporaryFile(max_size=max_memory_size)
+    try:
+        while True:
+            chunk = source.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            spooled.write(chunk)
+        spooled.seek(0)
+    except Exception:
+        spooled.close()
+        raise
+    return spooled
@@ -2,6 +2,7 @@ import datetime
 import json
 
 from flask import Blueprint, Response, current_app, g, request
+from storage_api.cache import get_cache_stats
 
 general = Blueprint('general', __name__)
 
@@ -16,6 +17,14 @@ def check_status():
     }), mimetype='application/json', status=200)
 
 
+@general.route("/health/caches")
+def cache_stats():
+    return Response(response=json.dumps({
+        "app": current_app.config["APP_NAME"],
+        "caches": get_cache_stats()
+    }), mimetype='application/json', status=200)
+
+
 @general.route("/health/cascade/<str_depth>")
 def cascade_health(str_depth):  # pragma: no cover
     depth = int(str_depth)
@@ -1,29 +1,49 @@
 import json
+import uuid
+from concurrent.futures import CancelledError, ThreadPoolExecutor, wait
+from functools import partial
 
-import pyclamd
-from flask import Blueprint, Response, current_app, request, send_file
-from storage_api.config import CLAMD_HOST, CLAMD_PORT
-from storage_api.dependencies import storage_type_factory
+from flask import Blueprint, Response, current_app, request, stream_with_context
+from storage_api import batch
+from storage_api.concurrency import with_current_context
+from storage_api.dependencies import storage_type_factory, virus_scanner
+from storage_api.dependencies.storage_type_factory import is_reserved_bucket
+from storage_api.dependencies.virus_scanner import ScanError
 from storage_api.exceptions import ApplicationError
 from storage_api.model.storage_item import StorageItem
+from storage_api.responses import send_not_modified, send_storage_item
+from storage_api.uploads import MultipartStream, spool
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import HTTPException
 
 storage_bp = Blueprint('storage', __name__)
 
 
+@storage_bp.before_request
+def check_bucket():
+    # Where the storage type keeps its own data, such as the file index, isn't reachable as a bucket
+    bucket = (request.view_args or {}).get('bucket')
+    if bucket is not None and is_reserved_bucket(bucket):
+        raise ApplicationError("Bucket not found", 404, 404)
+
+
 @storage_bp.route('/<bucket>/<file_id>', methods=['GET'])
 def get_file(bucket, file_id):
     """Get a file with the provided file_id from the provided bucket"""
     current_app.logger.info("Retrieve Endpoint called")
     subdirectories = request.args.get('subdirectories')
     storage_location = storage_type_factory.get_storage_type()
-    send_as_attachment = False
     try:
-        if storage_location.is_directory(bucket, file_id, subdirectories):
-            archive_name = request.args.get('archive_name')
-            stored_item = storage_location.zip_directory(bucket, file_id, subdirectories, archive_name)
-            send_as_attachment = True
-        else:
-            stored_item = storage_location.get_file(bucket, file_id, subdirectories)
+        if request.if_none_match:
+            # Stored files never change, so answer from the ETag without opening the file. Directories have no ETag
+            etag = storage_location.get_etag(bucket, file_id, subdirectories)
+            if etag is not None and request.if_none_match.contains_weak(etag):
+                current_app.logger.info("File not modified")
+                return send_not_modified(etag)
+        # Directories are sent as a zip archive attachment
+        stored_item, send_as_attachment = storage_location.resolve(bucket, file_id, subdirectories,
+                                                                   byte_range=request.range,
+                                                                   archive_name=request.args.get('archive_name'))
     except Exception as ex:
         error_message = 'Failed to retrieve the requested file. Exception - {}'\
             .format(ex)
@@ -31,11 +51,7 @@ def get_file(bucket, file_id):
         raise ApplicationError(error_message, 'G01')
     if stored_item and stored_item.file:
         current_app.logger.info("File returned  building response")
-        if send_as_attachment:
-            return send_file(stored_item.file, mimetype=stored_item.meta_type, as_attachment=True,
-                             download_name=stored_item.file_name), 200
-        else:
-            return send_file(stored_item.file, mimetype=stored_item.meta_type), 200
+        return send_storage_item(stored_item, as_attachment=send_as_attachment)
     else:
         raise ApplicationError("File not found", 404, 404)
 
@@ -50,10 +66,13 @@ def get_file_external_url(bucket, file_id):
         result = storage_location.get_file_external_url(bucket, file_id, subdirectories)
         if result is None:
             raise ApplicationError("File not found", 404, 404)
+        etag = result.pop('etag', None)
         response = Response()
         response.status_code = 200
         response.content_type = 'application/json'
         response.data = json.dumps(result)
+        if etag is not None:
+            response.set_etag(etag)
         return response
     except ApplicationError:
         raise
@@ -64,6 +83,59 @@ def get_file_external_url(bucket, file_id):
         raise ApplicationError(error_message, 'G01')
 
 
+@storage_bp.route('/<bucket>/batch/download', methods=['POST'])
+def get_files(bucket):
+    """Get the files listed in the request body from the provided bucket, as a zip archive or a multipart/mixed
+    body. Files are fetched a few at a time as the response is sent"""
+    current_app.logger.info("Batch Retrieve Endpoint called")
+    files = batch.get_batch_files()
+    body = request.get_json()
+    download_format = body.get('format', 'zip')
+    if download_format not in ('zip', 'multipart'):
+        raise ApplicationError("Invalid batch request", 400, 400)
+    try:
+        storage_location = storage_type_factory.get_storage_type()
+    except Exception as ex:
+        error_message = 'Failed to retrieve the requested files. Exception - {}' \
+            .format(ex)
+        current_app.logger.exception(error_message)
+        raise ApplicationError(error_message, 'G01')
+
+    results = batch.fetch_files(storage_location, bucket, files, current_app.config['BATCH_DOWNLOAD_CONCURRENCY'])
+    if download_format == 'multipart':
+        boundary = uuid.uuid4().hex
+        response = Response(stream_with_context(batch.multipart_files(results, boundary)))
+        response.content_type = 'multipart/mixed; boundary={}'.format(boundary)
+        return response
+    archive = StorageItem(batch.zip_files(results), 'application/zip', body.get('archive_name') or 'archive.zip')
+    return send_storage_item(archive, as_attachment=True)
+
+
+@storage_bp.route('/<bucket>/batch/external-url', methods=['POST'])
+def get_file_external_urls(bucket):
+    """Get external URLs of the files listed in the request body from the provided bucket, by their references.
+    Files that aren't found have no URL"""
+    current_app.logger.info("Batch Retrieve External URL Endpoint called")
+    files = batch.get_batch_files()
+    try:
+        storage_location = storage_type_factory.get_storage_type()
+        results = storage_location.get_file_external_urls(bucket, files)
+    except ApplicationError:
+        raise
+    except Exception as ex:
+        error_message = 'Failed to retrieve external urls of the requested files. Exception - {}' \
+            .format(ex)
+        current_app.logger.exception(error_message)
+        raise ApplicationError(error_message, 'G01')
+
+    response = Response()
+    response.status_code = 200
+    response.content_type = 'application/json'
+    response.data = json.dumps({batch.get_reference(bucket, file_id, subdirectories): result
+                                for (file_id, subdirectories), result in zip(files, results)})
+    return response
+
+
 @storage_bp.route('/<bucket>/<file_id>', methods=['DELETE'])
 def delete_file(bucket, file_id):
     """Delete a file with the provided file_id from the provided bucket"""
@@ -83,61 +155,160 @@ def delete_file(bucket, file_id):
         raise ApplicationError(error_message, 'D01')
 
 
+@storage_bp.route('/<bucket>/batch/delete', methods=['POST'])
+def delete_files(bucket):
+    """Delete the files listed in the request body from the provided bucket, returning the result for each"""
+    current_app.logger.info("Batch Delete Endpoint called")
+    files = batch.get_batch_files()
+    # A file listed more than once is only deleted once, and each listing gets its result
+    unique_files = list(dict.fromkeys(files))
+    try:
+        storage_location = storage_type_factory.get_storage_type()
+        results = dict(zip(unique_files, storage_location.delete_files(bucket, unique_files)))
+    except ApplicationError:
+        raise
+    except Exception as ex:
+        error_message = 'Failed to delete the requested files. Exception - {}' \
+            .format(ex)
+        current_app.logger.exception(error_message)
+        raise ApplicationError(error_message, 'D01')
+
+    statuses = {True: 'deleted', False: 'not_found', None: 'failed'}
+    response = Response()
+    response.status_code = 200
+    response.content_type = 'application/json'
+    response.data = json.dumps({"files": [
+        dict(batch.get_batch_reference(file_id, subdirectories), status=statuses[results[file_id, subdirectories]])
+        for file_id, subdirectories in files]})
+    return response
+
+
 @storage_bp.route('/<bucket>', methods=['POST'])
 def save_file(bucket):
     """Save a file to the provided bucket"""
     current_app.logger.info("Save Endpoint called")
 
-    if len(request.files) > 0:
-        result = {}
-        subdirectories = request.args.get('subdirectories')
-        scan = request.args.get('scan')
-
-        for file_key in request.files:
-            file = request.files[file_key]
-
-            if scan == 'True':
-                # Scan the file for threats
-                if CLAMD_HOST and CLAMD_PORT:
-                    clamd = pyclamd.ClamdNetworkSocket(host=CLAMD_HOST, port=CLAMD_PORT)
-                else:
-                    clamd = pyclamd.ClamdUnixSocket()
-                threat_found = clamd.scan_stream(file.read())
-                file.seek(0)
-
-                if threat_found:
-                    rollback(result)
-                    raise ApplicationError("Virus scan failed on uploaded document", 400, 400)
-            try:
-                if result.get(file_key) is None:
-                    result[file_key] = []
-                item = StorageItem(file, file.content_type, file.filename)
-                storage_location = storage_type_factory.get_storage_type()
-                saved_item = storage_location.save_file(bucket, item, subdirectories)
-                result.get(file_key).append(saved_item)
-            except Exception as ex:
-                error_message = 'Failed to save the requested file. Exception  {}' \
-                    .format(ex)
-                current_app.logger.exception(error_message)
-                rollback(result)
-                raise ApplicationError('Failed to save the requested file. Rolling back any changes', 'S-01')
-
-        response = Response()
-        response.status_code = 201
-        response.content_type = 'application/json'
-        response.data = json.dumps(result)
-        return response
+    stream = current_app.config['UPLOAD_INGESTION_MODE'].lower() == 'stream'
+    if stream:
+        if request.mimetype != 'multipart/form-data' or 'boundary' not in request.mimetype_params:
+            raise ApplicationError("No File in request", 400, 400)
+        # Files are read from the request as they are saved, rather than after the whole request is parsed
+        uploads = MultipartStream(request.stream, request.mimetype_params['boundary'].encode())
+        files = iter(uploads)
+    elif len(request.files) > 0:
+        uploads = None
+        files = ((file_key, request.files[file_key]) for file_key in request.files)
     else:
         raise ApplicationError("No File in request", 400, 400)
 
+    subdirectories = request.args.get('subdirectories')
+    scan = request.args.get('scan') == 'True'
+    store = with_current_context(partial(scan_and_save, bucket, subdirectories=subdirectories, scan=scan))
+
+    # Files are scanned and saved at the same time, each file's result is added to the response in request order
+    saving = []
+    read_failed = False
+    with ThreadPoolExecutor(max_workers=max(current_app.config['UPLOAD_CONCURRENCY'], 1)) as executor:
+        try:
+            for file_key, file in files:
+                if stream and scan:
+                    # Scanning reads the file before it is saved, so it is copied out of the request. The next
+                    # file can then be read from the request while this one is scanned and saved
+                    file = FileStorage(spool(file, current_app.config['UPLOAD_MEMORY_THRESHOLD']),
+                                       file.filename, file.name, file.content_type)
+                future = executor.submit(store, file)
+                saving.append((file_key, future))
+                if stream and not scan:
+                    # The file is read from the request as it is saved, so the next file can't be read until then
+                    wait([future])
+                if any(future.done() and future.exception() is not None for key, future in saving):
+                    # Everything will be rolled back, so don't start on any more files
+                    break
+        except Exception:
+            read_failed = True
+
+        if read_failed or any(future.done() and future.exception() is not None for key, future in saving):
+            for key, future in saving:
+                future.cancel()
+
+    result = {}
+    error = None
+    for file_key, future in saving:
+        try:
+            saved_item = future.result()
+        except CancelledError:
+            continue
+        except ApplicationError as ex:
+            error = error or ex
+            continue
+        except Exception as ex:
+            # Such as the virus scanner failing in a way it doesn't report as a ScanError
+            current_app.logger.exception('Failed to save the requested file. Exception - {}'.format(ex))
+            error = error or ApplicationError('Failed to save the requested file. Rolling back any changes', 'S-01')
+            continue
+        result.setdefault(file_key, []).append(saved_item)
+
+    if read_failed or error is not None:
+        rollback(result)
+        if read_failed or (uploads is not None and uploads.error is not None):
+            raise_upload_error(uploads)
+        raise error
+
+    if not result:
+        raise ApplicationError("No File in request", 400, 400)
+
+    response = Response()
+    response.status_code = 201
+    response.content_type = 'application/json'
+    response.data = json.dumps(result)
+    return response
+
+
+def scan_and_save(bucket, file, subdirectories=None, scan=False):
+    """Scans the file for threats if asked to, then saves it, returning the response for the saved file"""
+    if scan:
+        try:
+            threat_found = virus_scanner.get_virus_scanner().scan(file)
+        except ScanError as ex:
+            current_app.logger.exception('Failed to scan uploaded document. Exception - {}'.format(ex))
+            raise ApplicationError("Failed to scan uploaded document", 'S-02', 500)
+        file.seek(0)
+
+        if threat_found:
+            current_app.logger.warning('Virus scan found {} in uploaded document'.format(threat_found))
+            raise ApplicationError("Virus scan failed on uploaded document", 400, 400)
+    try:
+        item = StorageItem(file, file.content_type, file.filename)
+        storage_location = storage_type_factory.get_storage_type()
+        return storage_location.save_file(bucket, item, subdirectories)
+    except Exception as ex:
+        error_message = 'Failed to save the requested file. Exception  {}' \
+            .format(ex)
+        current_app.logger.exception(error_message)
+        raise ApplicationError('Failed to save the requested file. Rolling back any changes', 'S-01')
+
+
+def raise_upload_error(uploads):
+    """Raises the error for a request body that couldn't be read, after any files saved from it are rolled back"""
+    error = getattr(uploads, 'error', None)
+    if isinstance(error, HTTPException):
+        # Such as the body being larger than MAX_CONTENT_LENGTH
+        raise error
+    current_app.logger.warning('Failed to read the uploaded files. Exception - {}'.format(error))
+    raise ApplicationError("Failed to read the uploaded files", 400, 400)
+
 
 def rollback(files):
     try:
         storage_location = storage_type_factory.get_storage_type()
+        saved_files = {}
         for file_key in files:
             for saved_item in files[file_key]:
-                storage_location.delete_file(saved_item['bucket'], saved_item['file_id'],
-                                             saved_item.get('subdirectories'))
+                saved_files.setdefault(saved_item['bucket'], []).append((saved_item['file_id'],
+                                                                         saved_item.get('subdirectory')))
+        # Deleted together, rather than a request at a time
+        for bucket, bucket_files in saved_files.items():
+            storage_location.delete_files(bucket, bucket_files)
     except Exception as ex:
         error_message = 'Failed to rollback. Exception - {}' \
             .format(ex)
@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from storage_api.dependencies.storage.archive_cache import (
+    ArchiveCache, listing_fingerprint)
+
+
+class TestArchiveCache(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location)
+        self.cache = ArchiveCache(os.path.join(self.location, 'archives'), 10, 60)
+
+    def test_listing_fingerprint(self):
+        fingerprint = listing_fingerprint([('a', 1, 'x'), ('b', 2, 'y')])
+
+        self.assertEqual(fingerprint, listing_fingerprint([('b', 2, 'y'), ('a', 1, 'x')]))
+        self.assertNotEqual(fingerprint, listing_fingerprint([('a', 1, 'x'), ('b', 2, 'z')]))
+        self.assertNotEqual(fingerprint, listing_fingerprint([('a', 1, 'x')]))
+
+    def test_get_missing(self):
+        self.assertIsNone(self.cache.get('abc'))
+
+    def test_store_and_get(self):
+        result = b''.join(self.cache.store('abc', [b'te', b'st']))
+
+        self.assertEqual(result, b'test')
+        with self.cache.get('abc') as archive:
+            self.assertEqual(archive.read(), b'test')
+        self.assertEqual(os.listdir(self.cache.location), ['abc.zip'])
+
+    def test_get_item(self):
+        b''.join(self.cache.store('abc', [b'test']))
+
+        item = self.cache.get_item('abc', 'archive.zip')
+
+        self.assertEqual(item.size, 4)
+        self.assertEqual(item.meta_type, 'application/zip')
+        self.assertEqual(item.file_name, 'archive.zip')
+        self.assertIsNotNone(item.last_modified)
+        item.file.close()
+
+    def test_store_incomplete(self):
+        stream = self.cache.store('abc', [b'te', b'st'])
+        next(iter(stream))
+        stream.close()
+
+        self.assertIsNone(self.cache.get('abc'))
+        self.assertEqual(os.listdir(self.cache.location), [])
+
+    def test_get_expired(self):
+        b''.join(self.cache.store('abc', [b'test']))
+        old = time.time() - 120
+        os.utime(self.cache.archive_path('abc'), (old, old))
+
+        self.assertIsNone(self.cache.get('abc'))
+        self.assertFalse(os.path.exists(self.cache.archive_path('abc')))
+
+    def test_evict_least_recently_used(self):
+        b''.join(self.cache.store('a', [b'1234']))
+        b''.join(self.cache.store('b', [b'1234']))
+        now = time.time()
+        os.utime(self.cache.archive_path('a'), (now - 10, now))
+        os.utime(self.cache.archive_path('b'), (now - 20, now))
+        self.cache.get('b').close()
+
+        b''.join(self.cache.store('c', [b'1234']))
+
+        self.assertEqual(sorted(os.listdir(self.cache.location)), ['b.zip', 'c.zip'])
@@ -0,0 +1,27 @@
+import hashlib
+import io
+from unittest import TestCase
+
+from storage_api.dependencies.storage.content_hash import (copy_and_hash,
+                                                           hash_stream)
+
+CONTENT = b'test' * 50000
+
+
+class TestContentHash(TestCase):
+    def test_copy_and_hash(self):
+        destination = io.BytesIO()
+
+        result = copy_and_hash(io.BytesIO(CONTENT), destination)
+
+        self.assertEqual(result, hashlib.sha256(CONTENT).hexdigest())
+        self.assertEqual(destination.getvalue(), CONTENT)
+
+    def test_hash_stream(self):
+        stream = io.BytesIO(CONTENT)
+        stream.seek(4)
+
+        result = hash_stream(stream)
+
+        self.assertEqual(result, hashlib.sha256(CONTENT[4:]).hexdigest())
+        self.assertEqual(stream.tell(), 4)
@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from storage_api.dependencies.storage.file_index import FileIndex
+
+
+class TestFileIndex(TestCase):
+    def setUp(self):
+        self.storage_location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.storage_location)
+        self.index = FileIndex(self.storage_location, os.path.join(self.storage_location, '.index'))
+
+    def store(self, *parts):
+        path = os.path.join(self.storage_location, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as stored_file:
+            stored_file.write(b'test')
+        return path
+
+    def test_get_missing_entry(self):
+        self.assertIsNone(self.index.get('bucket', None, '1'))
+        self.assertIsNone(self.index.get_path('bucket', None, '1'))
+
+    def test_put_and_get_path(self):
+        self.index.put('bucket', None, '1', '1.pdf')
+
+        self.assertEqual(self.index.get('bucket', None, '1'), {'path': 'bucket/1.pdf'})
+        self.assertEqual(self.index.get_path('bucket', None, '1'),
+                         os.path.join(self.storage_location, 'bucket', '1.pdf'))
+
+    def test_put_with_subdirectories(self):
+        self.index.put('bucket', 'a,b', '1', '1.pdf')
+
+        self.assertEqual(self.index.get('bucket', 'a,b', '1'), {'path': 'bucket/a/b/1.pdf'})
+        self.assertIsNone(self.index.get('bucket', None, '1'))
+        self.assertTrue(os.path.isfile(os.path.join(self.storage_location, '.index', 'bucket', 'a', 'b', '1.json')))
+
+    def test_entry_outside_bucket(self):
+        self.assertRaises(ValueError, self.index.put, 'bucket', '..,..,outside', '1', '1.pdf')
+        self.assertRaises(ValueError, self.index.put, 'bucket', '..,other', '1', '1.pdf')
+        self.assertRaises(ValueError, self.index.put, '..', None, '1', '1.pdf')
+
+        self.assertIsNone(self.index.get('bucket', '..,..,outside', '1'))
+        self.assertFalse(self.index.remove('bucket', '..,..,outside', '1'))
+        self.assertEqual(os.listdir(self.storage_location), [])
+
+    def test_put_keeps_metadata(self):
+        self.index.put('bucket', None, '1', '1.pdf', size=4)
+
+        self.assertEqual(self.index.get('bucket', None, '1'), {'path': 'bucket/1.pdf', 'size': 4})
+
+    def test_get_corrupt_entry(self):
+        entry_path = self.index.entry_path('bucket', None, '1')
+        os.makedirs(os.path.dirname(entry_path))
+        with open(entry_path, 'w') as entry_file:
+            entry_file.write('{not json')
+
+        self.assertIsNone(self.index.get('bucket', None, '1'))
+
+    def test_remove(self):
+        self.index.put('bucket', None, '1', '1.pdf')
+
+        self.assertTrue(self.index.remove('bucket', None, '1'))
+        self.assertFalse(self.index.remove('bucket', None, '1'))
+        self.assertIsNone(self.index.get('bucket', None, '1'))
+
+    def test_rebuild(self):
+        self.store('bucket', '1.pdf')
+        self.store('bucket', 'a', 'b', '2.txt')
+        self.store('other', '3.csv')
+        self.index.put('bucket', None, '4', '4.pdf')
+
+        self.assertEqual(self.index.rebuild(), 3)
+
+        self.assertEqual(self.index.get('bucket', None, '1'), {'path': 'bucket/1.pdf'})
+        self.assertEqual(self.index.get('bucket', 'a,b', '2'), {'path': 'bucket/a/b/2.txt'})
+        self.assertEqual(self.index.get('other', None, '3'), {'path': 'other/3.csv'})
+        self.assertIsNone(self.index.get('bucket', None, '4'))
+
+    def test_rebuild_single_bucket(self):
+        self.store('bucket', '1.pdf')
+        self.store('other', '3.csv')
+
+        self.assertEqual(self.index.rebuild('bucket'), 1)
+
+        self.assertIsNotNone(self.index.get('bucket', None, '1'))
+        self.assertIsNone(self.index.get('other', None, '3'))
@@ -1,13 +1,19 @@
 import errno
+import hashlib
 import io
 import os
-from unittest.mock import MagicMock, patch
+import shutil
+import tempfile
+import zipfile
+from unittest.mock import ANY, MagicMock, call, patch
 
 from flask import g
 from flask_testing import TestCase
 from storage_api import main
+from storage_api.dependencies.storage.file_index import FileIndex
 from storage_api.dependencies.storage.file_storage_adapter import \
     FileStorageAdapter
+from storage_api.model.storage_item import StorageItem
 
 
 def side_effect(*args, **kwargs):
@@ -17,12 +23,28 @@ def side_effect(*args, **kwargs):
 mock_file = io.BytesIO(b'testfile')
 
 
+class UnseekableFile(io.BytesIO):
+    def seekable(self):
+        return False
+
+
 class TestFileStorageAdapter(TestCase):
     def create_app(self):
         main.app.config["FILE_STORAGE_LOCATION"] = "abc"
         main.app.config["FILE_EXTERNAL_URL_BASE"] = "FILE_EXTERNAL_URL_BASE"
+        main.app.config["FILE_INDEX_SCAN_ON_MISS"] = True
         return main.app
 
+    def setUp(self):
+        index_patcher = patch('storage_api.dependencies.storage.file_storage_adapter.FileStorageAdapter.get_index')
+        self.mock_index = index_patcher.start().return_value
+        self.mock_index.get.return_value = None
+        self.mock_index.get_path.return_value = None
+        self.addCleanup(index_patcher.stop)
+
+        self.destination = io.BytesIO()
+        self.storage_item = StorageItem(io.BytesIO(b'test'), 'text/plain', 'test.txt')
+
     @patch('storage_api.dependencies.storage.file_storage_adapter.os.walk')
     @patch('storage_api.dependencies.storage.file_storage_adapter.os.listdir')
     @patch('storage_api.dependencies.storage.file_storage_adapter.io.open')
@@ -102,6 +124,76 @@ class TestFileStorageAdapter(TestCase):
         storage_item = file_storage_adapter.get_file("abc", "1")
         self.assertIsNone(storage_item)
 
+    @patch('storage_api.dependencies.storage.file_storage_adapter.os.walk')
+    @patch('storage_api.dependencies.storage.file_storage_adapter.io.open')
+    def test_file_storage_adapter_get_file_indexed(self, mock_file_open, mock_walk):
+        self.mock_index.storage_location = "abc"
+        self.mock_index.get.return_value = {"path": "abc/1.txt", "sha256": "hash"}
+        file_mock = MagicMock(wraps=io.StringIO('test'))
+        file_mock.name = "abc/abc/1.txt"
+        mock_file_open.return_value = file_mock
+
+        file_storage_adapter = FileStorageAdapter()
+        storage_item = file_storage_adapter.get_file("abc", "1")
+
+        self.assertEqual(storage_item.file, file_mock)
+        self.assertEqual(storage_item.meta_type, 'text/plain')
+        self.assertEqual(storage_item.etag, 'hash')
+        mock_file_open.assert_called_with("abc/abc/1.txt", 'rb')
+        mock_walk.assert_not_called()
+
+    @patch('storage_api.dependencies.storage.file_storage_adapter.os.walk')
+    @patch('storage_api.dependencies.storage.file_storage_adapter.io.open')
+    def test_file_storage_adapter_get_file_stale_index_entry(self, mock_file_open, mock_walk):
+        self.mock_index.storage_location = "abc"
+        self.mock_index.get.return_value = {"path": "abc/1.txt"}
+        mock_file_open.side_effect = side_effect
+        mock_walk.return_value = []
+
+        file_storage_adapter = FileStorageAdapter()
+        storage_item = file_storage_adapter.get_file("abc", "1")
+
+        self.assertIsNone(storage_item)
+        self.mock_index.remove.assert_called_with("abc", None, "1")
+
+    @patch('storage_api.dependencies.storage.file_storage_adapter.os.walk')
+    @patch('storage_api.dependencies.storage.file_storage_adapter.io.open')
+    def test_file_storage_adapter_get_file_indexes_scanned_file(self, mock_file_open, mock_walk):
+        mock_walk.return_value = [
+            ('abc/abc', (), ('1.txt',))
+        ]
+        file_mock = MagicMock(wraps=io.StringIO('test'))
+        file_mock.name = "abc/abc/1.txt"
+        mock_file_open.return_value = file_mock
+
+        file_storage_adapter = FileStorageAdapter()
+        file_storage_adapter.get_file("abc", "1")
+
+        self.mock_index.put.assert_called_with("abc", None, "1", "1.txt")
+
+    @patch('storage_api.dependencies.storage.file_storage_adapter.os.walk')
+    def test_file_storage_adapter_get_file_no_scan_on_miss(self, mock_walk):
+        main.app.config["FILE_INDEX_SCAN_ON_MISS"] = False
+
+        file_storage_adapter = FileStorageAdapter()
+        storage_item = file_storage_adapter.get_file("abc", "1")
+
+        self.assertIsNone(storage_item)
+        mock_walk.assert_not_called()
+
+    @patch('storage_api.dependencies.storage.file_storage_adapter.os.remove')
+    @patch('storage_api.dependencies.storage.file_storage_adapter.os.listdir')
+    def test_file_storage_adapter_delete_file_indexed(self, mock_list_dir, mock_remove):
+        self.mock_index.get_path.return_value = "abc/abc/1.txt"
+
+        file_storage_adapter = FileStorageAdapter()
+        result = file_storage_adapter.delete_file("abc", "1")
+
+        self.assertTrue(result)
+        mock_remove.assert_called_with("abc/abc/1.txt")
+        mock_list_dir.assert_not_called()
+        self.mock_index.remove.assert_called_with("abc", None, "1")
+
     @patch('storage_api.dependencies.storage.file_storage_adapter.os.remove')
     @patch('storage_api.dependencies.storage.file_storage_adapter.os.listdir')
     def test_file_storage_adapter_delete_file_successful(self, mock_list_dir, mock_remove):
@@ -112,6 +204,22 @@ class TestFileStorageAdapter(TestCase):
         self.assertTrue(result)
         mock_remove.assert_called()
 
+    @patch('storage_api.dependencies.storage.file_storage_adapter.os.remove')
+    @patch('storage_api.dependencies.storage.file_storage_adapter.os.listdir')
+    def test_delete_files(self, mock_list_dir, mock_remove):
+        self.mock_index.get_path.side_effect = lambda bucket, subdirectories, file_id: \
+            'abc/abc/1.txt' if file_id == '1' else None
+        mock_list_dir.return_value = ["2.txt", "3.pdf"]
+
+        file_storage_adapter = FileStorageAdapter()
+        results = file_storage_adapter.delete_files("abc", [("1", None), ("2", None), ("3", None), ("4", None)])
+
+        self.assertEqual(results, [True, True, True, False])
+        self.assertEqual(mock_remove.call_args_list, [call("abc/abc/1.txt"), call(os.path.join("abc", "abc", "2.txt")),
+                                                      call(os.path.join("abc", "abc", "3.pdf"))])
+        # The directory is only listed once for the batch
+        mock_list_dir.assert_called_once_with(os.path.join("abc", "abc"))
+
     @patch('storage_api.dependencies.storage.file_storage_adapter.os.remove')
     @patch('storage_api.dependencies.storage.file_storage_adapter.os.listdir')
     def test_file_storage_adapter_delete_file_no_matching_file(self, mock_list_dir, mock_remove):
@@ -147,36 +255,58 @@ class TestFileStorageAdapter(TestCase):
             self.assertFalse(result)
             mock_remove.return_value.assert_not_called()
 
+    @patch('storage_api.dependencies.storage.file_storage_adapter.io.open')
     @patch('storage_api.dependencies.storage.file_storage_adapter.os.path.exists')
-    def test_file_storage_adapter_save_file_successful(self, mock_dir):
-        mock_file = MagicMock()
+    def test_file_storage_adapter_save_file_successful(self, mock_dir, mock_file_open):
+        mock_file_open.return_value.__enter__.return_value = self.destination
         file_storage_adapter = FileStorageAdapter()
-        result = file_storage_adapter.save_file("abc", mock_file)
+        result = file_storage_adapter.save_file("abc", self.storage_item)
         self.assertIsNotNone(result)
         self.assertIsNotNone(result['file_id'])
         self.assertEqual(result['bucket'], 'abc')
         self.assertIsNone(result.get('subdirectory'))
         self.assertEqual(result['reference'], 'abc/{}'.format(result['file_id']))
         mock_dir.assert_called()
+        mock_file_open.assert_called_with('abc/abc/{}.txt'.format(result['file_id']), 'wb')
+        self.assertEqual(self.destination.getvalue(), b'test')
+        self.mock_index.put.assert_called_with('abc', None, result['file_id'], '{}.txt'.format(result['file_id']),
+                                               sha256=hashlib.sha256(b'test').hexdigest(), size=4)
 
+    @patch('storage_api.dependencies.storage.file_storage_adapter.io.open')
     @patch('storage_api.dependencies.storage.file_storage_adapter.os.path.exists')
-    def test_file_storage_adapter_save_file_successful_with_subdirectories(self, mock_dir):
-        mock_file = MagicMock()
+    def test_file_storage_adapter_save_file_successful_with_subdirectories(self, mock_dir, mock_file_open):
+        mock_file_open.return_value.__enter__.return_value = self.destination
         file_storage_adapter = FileStorageAdapter()
-        result = file_storage_adapter.save_file("abc", mock_file, "list,of,subdirectories")
+        result = file_storage_adapter.save_file("abc", self.storage_item, "list,of,subdirectories")
         self.assertIsNotNone(result)
         self.assertIsNotNone(result['file_id'])
         self.assertEqual(result['subdirectory'], 'list,of,subdirectories')
         self.assertEqual(result['bucket'], 'abc')
         mock_dir.assert_called()
+        self.mock_index.put.assert_called_with('abc', 'list,of,subdirectories', result['file_id'], ANY,
+                                               sha256=ANY, size=4)
 
+    @patch('storage_api.dependencies.storage.file_storage_adapter.os.remove')
+    @patch('storage_api.dependencies.storage.file_storage_adapter.io.open')
+    @patch('storage_api.dependencies.storage.file_storage_adapter.os.path.exists')
+    def test_file_storage_adapter_save_file_index_failure(self, mock_dir, mock_file_open, mock_remove):
+        with main.app.test_request_context():
+            g.trace_id = "123"
+            mock_file_open.return_value.__enter__.return_value = self.destination
+            self.mock_index.put.side_effect = IOError
+            file_storage_adapter = FileStorageAdapter()
+            with self.assertRaises(IOError):
+                file_storage_adapter.save_file("abc", self.storage_item)
+            mock_remove.assert_called_with(mock_file_open.call_args[0][0])
+
+    @patch('storage_api.dependencies.storage.file_storage_adapter.io.open')
     @patch('storage_api.dependencies.storage.file_storage_adapter.os.makedirs')
     @patch('storage_api.dependencies.storage.file_storage_adapter.os.path.exists')
-    def test_file_storage_adapter_save_file_directory_missing(self, mock_dir, mock_make_dir):
+    def test_file_storage_adapter_save_file_directory_missing(self, mock_dir, mock_make_dir, mock_file_open):
+        mock_file_open.return_value.__enter__.return_value = self.destination
         mock_dir.return_value = False
-        mock_file = MagicMock()
         file_storage_adapter = FileStorageAdapter()
-        result = file_storage_adapter.save_file("abc", mock_file)
+        result = file_storage_adapter.save_file("abc", self.storage_item)
         self.assertIsNotNone(result)
         self.assertIsNotNone(result['file_id'])
         self.assertEqual(result['bucket'], 'abc')
@@ -263,6 +393,48 @@ class TestFileStorageAdapter(TestCase):
         self.assertEqual(result.meta_type, 'application/zip')
         self.assertEqual(result.file, mock_file)
 
+    def test_zip_contents(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        os.makedirs(os.path.join(directory, 'subdirectory'))
+        with open(os.path.join(directory, 'a.txt'), 'wb') as stored_file:
+            stored_file.write(b'test')
+
+        result = FileStorageAdapter.zip_contents(directory)
+
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(result)))
+        self.assertEqual(archive.namelist(), ['a.txt'])
+        self.assertEqual(archive.read('a.txt'), b'test')
+
+    def test_zip_directory_archive_cache(self):
+        storage_location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_location)
+        os.makedirs(os.path.join(storage_location, 'bucket', 'directory_id'))
+        stored_path = os.path.join(storage_location, 'bucket', 'directory_id', 'a.txt')
+        with open(stored_path, 'wb') as stored_file:
+            stored_file.write(b'test')
+
+        main.app.config["FILE_STORAGE_LOCATION"] = storage_location
+        main.app.config["ARCHIVE_CACHE_ENABLED"] = True
+        main.app.config["ARCHIVE_CACHE_LOCATION"] = os.path.join(storage_location, '.archives')
+        self.addCleanup(main.app.config.update, FILE_STORAGE_LOCATION="abc", ARCHIVE_CACHE_ENABLED=False)
+
+        file_storage_adapter = FileStorageAdapter()
+        first = file_storage_adapter.zip_directory('bucket', 'directory_id', None, 'somename')
+        archive = b''.join(first.file)
+
+        cached = file_storage_adapter.zip_directory('bucket', 'directory_id', None, 'somename')
+        self.assertEqual(cached.file.read(), archive)
+        self.assertEqual(cached.size, len(archive))
+        cached.file.close()
+
+        # Changing the directory changes its fingerprint, so the archive is generated again
+        with open(stored_path, 'wb') as stored_file:
+            stored_file.write(b'changed')
+        changed = file_storage_adapter.zip_directory('bucket', 'directory_id', None, 'somename')
+        self.assertFalse(hasattr(changed.file, 'read'))
+        changed.file.close()
+
     @patch('storage_api.dependencies.storage.file_storage_adapter.os.path.isdir')
     def test_get_external_url(self, mock_is_dir):
         mock_is_dir.return_value = False
@@ -296,6 +468,39 @@ class TestFileStorageAdapter(TestCase):
         self.assertIn('external_reference', result)
         self.assertEqual(result['external_reference'], 'FILE_EXTERNAL_URL_BASE/bucket/sub')
 
+    def test_get_etag(self):
+        self.mock_index.get.return_value = {"path": "bucket/file.pdf", "sha256": "hash"}
+
+        file_storage_adapter = FileStorageAdapter()
+
+        self.assertEqual(file_storage_adapter.get_etag('bucket', 'file', 'sub'), 'hash')
+        self.mock_index.get.assert_called_with('bucket', 'sub', 'file')
+
+    def test_get_etag_not_indexed(self):
+        file_storage_adapter = FileStorageAdapter()
+
+        self.assertIsNone(file_storage_adapter.get_etag('bucket', 'file'))
+
+    @patch('storage_api.dependencies.storage.file_storage_adapter.os.path.isdir')
+    def test_get_external_url_etag(self, mock_is_dir):
+        mock_is_dir.return_value = False
+        self.mock_index.get.return_value = {"path": "bucket/file.pdf", "sha256": "hash"}
+
+        file_storage_adapter = FileStorageAdapter()
+        result = file_storage_adapter.get_file_external_url('bucket', 'file')
+
+        self.assertEqual(result['etag'], 'hash')
+
+    @patch('storage_api.dependencies.storage.file_storage_adapter.os.path.isdir')
+    def test_get_file_external_urls(self, mock_is_dir):
+        file_storage_adapter = FileStorageAdapter()
+        results = file_storage_adapter.get_file_external_urls('bucket', [('file', None), ('other', 'a,b')])
+
+        self.assertEqual(results, [{'external_reference': 'FILE_EXTERNAL_URL_BASE/bucket/file'},
+                                   {'external_reference': 'FILE_EXTERNAL_URL_BASE/bucket/other?subdirectories=a,b'}])
+        mock_is_dir.assert_not_called()
+        self.mock_index.get.assert_not_called()
+
     def test_get_extension_supports_csv(self):
         file_storage_adapter = FileStorageAdapter()
 
@@ -309,3 +514,115 @@ class TestFileStorageAdapter(TestCase):
         result = file_storage_adapter.get_mime('test_filename.csv')
 
         self.assertEqual(result, 'text/csv')
+
+    def test_get_file_outside_bucket_not_indexed(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        storage_location = os.path.join(directory, 'storage')
+        os.makedirs(os.path.join(storage_location, 'b'))
+        os.makedirs(os.path.join(directory, 'outside'))
+        with open(os.path.join(directory, 'outside', 'secret.txt'), 'wb') as secret:
+            secret.write(b'secret')
+        self.addCleanup(main.app.config.update, FILE_STORAGE_LOCATION="abc")
+        main.app.config.update(FILE_STORAGE_LOCATION=storage_location)
+        index = FileIndex(storage_location, os.path.join(storage_location, '.index'))
+        g.trace_id = '123'
+
+        with patch.object(FileStorageAdapter, 'get_index', return_value=index):
+            stored_item = FileStorageAdapter().get_file('b', 'secret', '..,..,outside')
+        stored_item.file.close()
+
+        # Nothing is written for a file outside the bucket
+        self.assertEqual(sorted(os.listdir(storage_location)), ['b'])
+        self.assertEqual(sorted(os.listdir(directory)), ['outside', 'storage'])
+
+    def test_is_reserved_bucket(self):
+        storage_location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_location)
+        self.addCleanup(main.app.config.update, FILE_STORAGE_LOCATION="abc",
+                        FILE_CONTENT_LOCATION=main.app.config['FILE_CONTENT_LOCATION'])
+        main.app.config.update(FILE_STORAGE_LOCATION=storage_location,
+                               FILE_CONTENT_LOCATION=os.path.join(storage_location, 'shared', 'content'))
+
+        self.assertTrue(FileStorageAdapter.is_reserved_bucket('.content'))
+        self.assertTrue(FileStorageAdapter.is_reserved_bucket('shared'))
+        self.assertFalse(FileStorageAdapter.is_reserved_bucket('bucket'))
+        self.assertFalse(FileStorageAdapter.is_reserved_bucket('shared-files'))
+
+    def test_save_file_upload_failed(self):
+        class FailingFile(UnseekableFile):
+            def read(self, size=-1):
+                if self.tell() > 0:
+                    raise OSError('Client disconnected')
+                return super(FailingFile, self).read(2)
+
+        storage_location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_location)
+        self.addCleanup(main.app.config.update, FILE_STORAGE_LOCATION="abc")
+        main.app.config.update(FILE_STORAGE_LOCATION=storage_location)
+        g.trace_id = '123'
+
+        with self.assertRaises(OSError):
+            FileStorageAdapter().save_file('bucket', StorageItem(FailingFile(b'test'), 'text/plain', 'test.txt'))
+
+        # The part of the upload already written isn't left in the bucket
+        self.assertEqual(os.listdir(os.path.join(storage_location, 'bucket')), [])
+        self.mock_index.put.assert_not_called()
+
+    def test_save_file_deduplicated(self):
+        storage_location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_location)
+        self.addCleanup(main.app.config.update, FILE_STORAGE_LOCATION="abc",
+                        STORAGE_DEDUPLICATION=main.app.config['STORAGE_DEDUPLICATION'],
+                        FILE_CONTENT_LOCATION=main.app.config['FILE_CONTENT_LOCATION'])
+        main.app.config.update(FILE_STORAGE_LOCATION=storage_location, STORAGE_DEDUPLICATION=True,
+                               FILE_CONTENT_LOCATION=os.path.join(storage_location, '.content'))
+        sha256 = hashlib.sha256(b'test').hexdigest()
+        content_path = os.path.join(storage_location, '.content', sha256[:2], sha256)
+
+        file_storage_adapter = FileStorageAdapter()
+        first = file_storage_adapter.save_file('bucket', self.storage_item)
+        # Streamed uploads can't be hashed before they are written
+        second = file_storage_adapter.save_file('bucket', StorageItem(UnseekableFile(b'test'), 'text/plain',
+                                                                      'other.txt'))
+
+        paths = [os.path.join(storage_location, 'bucket', '{}.txt'.format(saved['file_id']))
+                 for saved in (first, second)]
+        with open(paths[1], 'rb') as stored_file:
+            self.assertEqual(stored_file.read(), b'test')
+        self.assertTrue(os.path.samefile(paths[0], content_path))
+        self.assertTrue(os.path.samefile(paths[1], content_path))
+        self.assertEqual(os.listdir(os.path.join(storage_location, '.content')), [sha256[:2]])
+        self.mock_index.put.assert_called_with('bucket', None, second['file_id'], ANY, sha256=sha256, size=4)
+
+        self.mock_index.get_path.return_value = paths[0]
+        self.assertTrue(file_storage_adapter.delete_file('bucket', first['file_id']))
+        self.assertEqual(os.stat(content_path).st_nlink, 2)
+
+        # The hash is taken from the index entry rather than by reading the file
+        self.mock_index.get_path.return_value = paths[1]
+        self.mock_index.get.return_value = {'path': paths[1], 'sha256': sha256}
+        with patch('storage_api.dependencies.storage.file_storage_adapter.hash_stream') as mock_hash_stream:
+            self.assertTrue(file_storage_adapter.delete_file('bucket', second['file_id']))
+        mock_hash_stream.assert_not_called()
+        self.assertFalse(os.path.exists(content_path))
+
+    @patch('storage_api.dependencies.storage.file_storage_adapter.os.link')
+    def test_save_file_deduplicated_without_links(self, mock_link):
+        mock_link.side_effect = OSError(errno.EPERM, os.strerror(errno.EPERM))
+        storage_location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage_location)
+        self.addCleanup(main.app.config.update, FILE_STORAGE_LOCATION="abc",
+                        STORAGE_DEDUPLICATION=main.app.config['STORAGE_DEDUPLICATION'],
+                        FILE_CONTENT_LOCATION=main.app.config['FILE_CONTENT_LOCATION'])
+        main.app.config.update(FILE_STORAGE_LOCATION=storage_location, STORAGE_DEDUPLICATION=True,
+                               FILE_CONTENT_LOCATION=os.path.join(storage_location, '.content'))
+
+        with main.app.test_request_context():
+            g.trace_id = '123'
+            result = FileStorageAdapter().save_file('bucket', self.storage_item)
+
+        with open(os.path.join(storage_location, 'bucket', '{}.txt'.format(result['file_id'])), 'rb') as stored:
+            self.assertEqual(stored.read(), b'test')
+        self.assertEqual([files for path, dirs, files in os.walk(os.path.join(storage_location, '.content'))
+                          if files], [])
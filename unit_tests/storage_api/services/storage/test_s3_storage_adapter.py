@@ -1,5 +1,10 @@
+import hashlib
 import io
-from unittest.mock import MagicMock, patch
+import shutil
+import tempfile
+import zipfile
+from datetime import datetime, timedelta, timezone
+from unittest.mock import ANY, MagicMock, patch
 
 from botocore.exceptions import ClientError
 from flask import g
@@ -9,6 +14,9 @@ from storage_api.dependencies.storage.s3_storage_adapter import \
     S3StorageAdapter
 from storage_api.exceptions import ApplicationError
 from storage_api.model.storage_item import StorageItem
+from werkzeug.datastructures import Range
+
+not_found = ClientError({'Error': {'Code': '404'}}, 'head_object')
 
 
 @patch('botocore.client')
@@ -16,8 +24,26 @@ class TestS3StorageAdapter(TestCase):
     def create_app(self):
         main.app.config["S3_BUCKET"] = "abc"
         main.app.config["S3_URL_EXPIRE_IN_SECONDS"] = 10
+        main.app.config["S3_DOWNLOAD_MODE"] = "stream"
+        main.app.config["S3_STREAM_CHUNK_SIZE"] = 2
         return main.app
 
+    def setUp(self):
+        # Start every test with an empty presigned URL cache
+        S3StorageAdapter._presigned_urls = None
+        S3StorageAdapter._metadata = None
+
+    @patch('storage_api.dependencies.storage.s3_storage_adapter.boto3')
+    def test_connection_pool(self, mock_boto3, mock_s3):
+        self.addCleanup(setattr, S3StorageAdapter, '_instance', S3StorageAdapter._instance)
+        S3StorageAdapter._instance = None
+
+        S3StorageAdapter()
+
+        config = mock_boto3.client.call_args[1]['config']
+        self.assertEqual(config.max_pool_connections, main.app.config['S3_POOL_CONNECTIONS'])
+        self.assertEqual(main.app.config['S3_POOL_CONNECTIONS'], 32)
+
     def test_get_file_successful(self, mock_s3):
         body = io.BytesIO(b'test')
 
@@ -25,7 +51,8 @@ class TestS3StorageAdapter(TestCase):
             'Body': body,
             'Metadata': {
                 'content-type': 'plain/text',
-                'file-name': 'test.txt'
+                'file-name': 'test.txt',
+                'sha256': 'hash'
             }
         }
 
@@ -36,8 +63,103 @@ class TestS3StorageAdapter(TestCase):
         self.assertIsNotNone(result)
         self.assertEqual('plain/text', result.meta_type)
         self.assertEqual('test.txt', result.file_name)
+        self.assertEqual('hash', result.etag)
         self.assertEqual(b'test', result.file.read())
 
+    def test_get_file_stream(self, mock_s3):
+        body = MagicMock()
+        body.read.side_effect = [b'te', b'st']
+
+        mock_s3.get_object.return_value = {
+            'Body': body,
+            'ContentLength': 4,
+            'Metadata': {
+                'content-type': 'plain/text',
+                'file-name': 'test.txt'
+            }
+        }
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+        result = s3_adapter.get_file('bucket', 'file')
+
+        self.assertIs(body, result.file)
+        self.assertEqual((0, 4), result.content_range)
+        self.assertEqual([b'te', b'st'], list(result.read_range(0, 4)))
+        body.read.assert_called_with(2)
+
+    def test_get_file_buffer(self, mock_s3):
+        main.app.config["S3_DOWNLOAD_MODE"] = "buffer"
+        mock_s3.get_object.return_value = {
+            'Body': io.BytesIO(b'test'),
+            'ContentLength': 4,
+            'ContentType': 'text/plain',
+            'Metadata': {
+                'file-name': 'test.txt'
+            }
+        }
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+        result = s3_adapter.get_file('bucket', 'file')
+
+        self.assertIsInstance(result.file, io.BytesIO)
+        self.assertEqual('text/plain', result.meta_type)
+        self.assertIsNone(result.content_range)
+        self.assertEqual(b'test', result.file.read())
+
+    def test_get_file_range(self, mock_s3):
+        mock_s3.get_object.return_value = {
+            'Body': io.BytesIO(b'es'),
+            'ContentLength': 2,
+            'ContentRange': 'bytes 1-2/4',
+            'Metadata': {
+                'content-type': 'plain/text',
+                'file-name': 'test.txt'
+            }
+        }
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+        result = s3_adapter.get_file('bucket', 'file', byte_range=Range('bytes', [(1, 3), (3, None)]))
+
+        mock_s3.get_object.assert_called_with(Bucket='abc', Key='bucket/file', Range='bytes=1-2')
+        self.assertEqual(4, result.size)
+        self.assertEqual((1, 3), result.content_range)
+        self.assertEqual(b'es', b''.join(result.read_range(1, 3)))
+
+    def test_get_file_invalid_range(self, mock_s3):
+        mock_s3.get_object.side_effect = [
+            ClientError({'Error': {'Code': 'InvalidRange'}}, 'get_object'),
+            {
+                'Body': io.BytesIO(b'test'),
+                'ContentLength': 4,
+                'Metadata': {
+                    'content-type': 'plain/text',
+                    'file-name': 'test.txt'
+                }
+            }
+        ]
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+        result = s3_adapter.get_file('bucket', 'file', byte_range=Range('bytes', [(10, None)]))
+
+        mock_s3.get_object.assert_called_with(Bucket='abc', Key='bucket/file')
+        self.assertEqual(4, result.size)
+        self.assertEqual((0, 4), result.content_range)
+
+    def test_read_range(self, mock_s3):
+        mock_s3.get_object.return_value = {'Body': MagicMock()}
+        mock_s3.get_object.return_value['Body'].iter_chunks.return_value = iter([b'es'])
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+        result = s3_adapter.read_range('abc', 'bucket/file', 1, 3)
+
+        mock_s3.get_object.assert_called_with(Bucket='abc', Key='bucket/file', Range='bytes=1-2')
+        self.assertEqual(b'es', b''.join(result))
+
     def test_get_file_exception(self, mock_s3):
         with main.app.test_request_context():
             g.trace_id = '123'
@@ -67,8 +189,7 @@ class TestS3StorageAdapter(TestCase):
     def test_save_file_successful(self, mock_uuid, mock_s3):
         mock_uuid.uuid4.return_value = "123"
         mock_s3.generate_presigned_url.return_value = "abc"
-        mock_file = MagicMock()
-        item = StorageItem(mock_file, 'plain/text', "test")
+        item = StorageItem(io.BytesIO(b'test'), 'plain/text', "test")
         s3_adapter = S3StorageAdapter()
         s3_adapter._connection = mock_s3
         result = s3_adapter.save_file('bucket', item)
@@ -77,13 +198,14 @@ class TestS3StorageAdapter(TestCase):
         self.assertEqual('bucket', result['bucket'])
         self.assertEqual('123', result['file_id'])
         self.assertEqual('bucket/123', result['reference'])
+        self.assertEqual(hashlib.sha256(b'test').hexdigest(), mock_s3.put_object.call_args[1]['Metadata']['sha256'])
+        self.assertEqual(0, item.file.tell())
 
     @patch('storage_api.dependencies.storage.s3_storage_adapter.uuid')
     def test_save_file_successful_with_sub_dirs(self, mock_uuid, mock_s3):
         mock_uuid.uuid4.return_value = "123"
         mock_s3.generate_presigned_url.return_value = "abc"
-        mock_file = MagicMock()
-        item = StorageItem(mock_file, 'plain/text', "test")
+        item = StorageItem(io.BytesIO(b'test'), 'plain/text', "test")
         s3_adapter = S3StorageAdapter()
         s3_adapter._connection = mock_s3
         result = s3_adapter.save_file('bucket', item, 'dir')
@@ -93,6 +215,33 @@ class TestS3StorageAdapter(TestCase):
         self.assertEqual('123', result['file_id'])
         self.assertEqual('bucket/123?subdirectories=dir', result['reference'])
 
+    @patch('storage_api.dependencies.storage.s3_storage_adapter.uuid')
+    def test_save_file_multipart(self, mock_uuid, mock_s3):
+        self.addCleanup(main.app.config.update, S3_MULTIPART_THRESHOLD=main.app.config['S3_MULTIPART_THRESHOLD'])
+        main.app.config['S3_MULTIPART_THRESHOLD'] = 4
+        mock_uuid.uuid4.return_value = "123"
+        item = StorageItem(io.BytesIO(b'test'), 'text/plain', "test")
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+
+        s3_adapter.save_file('bucket', item)
+
+        mock_s3.put_object.assert_not_called()
+        args, kwargs = mock_s3.upload_fileobj.call_args
+        self.assertEqual((item.file, 'abc', 'bucket/123'), args)
+        self.assertEqual({'ContentType': 'text/plain',
+                          'Metadata': {'file-name': 'test', 'content-type': 'text/plain',
+                                       'sha256': hashlib.sha256(b'test').hexdigest()}}, kwargs['ExtraArgs'])
+        self.assertEqual(4, kwargs['Config'].multipart_threshold)
+        self.assertEqual(4, item.size)
+
+    def test_get_stream_size(self, mock_s3):
+        stream = io.BytesIO(b'test')
+        stream.read(1)
+
+        self.assertEqual(3, S3StorageAdapter.get_stream_size(stream))
+        self.assertEqual(1, stream.tell())
+
     def test_save_file_exception(self, mock_s3):
         with main.app.test_request_context():
             g.trace_id = '123'
@@ -106,9 +255,9 @@ class TestS3StorageAdapter(TestCase):
     def test_zip_directory_successful(self, mock_s3):
         body = io.BytesIO(b'test')
 
-        mock_s3.list_objects.return_value = {'Contents': [
+        mock_s3.get_paginator.return_value.paginate.return_value = [{'Contents': [
             {'Key': 'abc'}
-        ]}
+        ]}]
 
         mock_s3.get_object.return_value = {
             'Body': body,
@@ -126,12 +275,116 @@ class TestS3StorageAdapter(TestCase):
         self.assertEqual('application/zip', result.meta_type)
         self.assertEqual('test.zip', result.file_name)
 
+    def test_zip_directory_contents(self, mock_s3):
+        main.app.config["S3_ZIP_CONCURRENCY"] = 1
+        mock_s3.get_paginator.return_value.paginate.return_value = [{'Contents': [
+            {'Key': 'abc'}
+        ]}]
+
+        body = MagicMock()
+        body.iter_chunks.return_value = iter([b'te', b'st'])
+        mock_s3.get_object.return_value = {
+            'Body': body,
+            'Metadata': {
+                'content-type': 'text/plain',
+                'file-name': 'test'
+            }
+        }
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+        result = s3_adapter.zip_directory('bucket', '123', 'dir', 'test.zip')
+
+        mock_s3.get_object.assert_not_called()
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(result.file)))
+        self.assertEqual(archive.read('test.txt'), b'test')
+        body.close.assert_called_once_with()
+
+    def test_zip_directory_concurrent(self, mock_s3):
+        main.app.config["S3_ZIP_CONCURRENCY"] = 4
+        main.app.config["S3_ZIP_MEMORY_BUDGET"] = 10
+        mock_s3.get_paginator.return_value.paginate.return_value = [{'Contents': [
+            {'Key': 'dir/{}'.format(index), 'Size': 4 if index != 3 else 20} for index in range(6)
+        ]}]
+
+        def get_object(**kwargs):
+            index = kwargs['Key'].split('/')[1]
+            body = MagicMock()
+            body.read.return_value = 'test{}'.format(index).encode()
+            body.iter_chunks.return_value = iter([b'big'])
+            return {'Body': body, 'Metadata': {'content-type': 'text/plain', 'file-name': index}}
+
+        mock_s3.get_object.side_effect = get_object
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+        result = s3_adapter.zip_directory('bucket', '123', 'dir', 'test.zip')
+
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(result.file)))
+        self.assertEqual(archive.namelist(), ['{}.txt'.format(index) for index in range(6)])
+        self.assertEqual(archive.read('2.txt'), b'test2')
+        # Too big for the memory budget, so streamed rather than read
+        self.assertEqual(archive.read('3.txt'), b'big')
+
+    def test_zip_directory_deduplicated(self, mock_s3):
+        main.app.config["S3_ZIP_CONCURRENCY"] = 4
+        main.app.config["S3_ZIP_MEMORY_BUDGET"] = 10
+        # References to deduplicated content are empty
+        mock_s3.get_paginator.return_value.paginate.return_value = [{'Contents': [
+            {'Key': 'dir/small', 'Size': 0}, {'Key': 'dir/big', 'Size': 0}
+        ]}]
+
+        def get_object(**kwargs):
+            name = kwargs['Key'].split('/')[1]
+            body = MagicMock()
+            if kwargs['Key'].startswith('content/'):
+                body.read.return_value = b'test'
+                body.iter_chunks.return_value = iter([b'streamed'])
+                return {'Body': body, 'ContentLength': 20 if name == 'big' else 4,
+                        'Metadata': {'content-type': 'text/plain', 'file-name': 'content'}}
+            return {'Body': body, 'Metadata': {'content-type': 'text/plain', 'file-name': name,
+                                               'content-key': 'content/{}'.format(name)}}
+
+        mock_s3.get_object.side_effect = get_object
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+        result = s3_adapter.zip_directory('bucket', '123', 'dir', 'test.zip')
+
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(result.file)))
+        self.assertEqual(archive.namelist(), ['small.txt', 'big.txt'])
+        self.assertEqual(archive.read('small.txt'), b'test')
+        # The content is too big for the memory budget, so it is streamed rather than read
+        self.assertEqual(archive.read('big.txt'), b'streamed')
+
+    def test_zip_directory_pages(self, mock_s3):
+        main.app.config["S3_ZIP_CONCURRENCY"] = 1
+        pages = [{'Contents': [{'Key': 'dir/0'}]}, {}, {'Contents': [{'Key': 'dir/1'}, {'Key': 'dir/2'}]}]
+        mock_s3.get_paginator.return_value.paginate.return_value = iter(pages)
+
+        def get_object(**kwargs):
+            body = MagicMock()
+            body.iter_chunks.return_value = iter([b'test'])
+            return {'Body': body, 'Metadata': {'content-type': 'text/plain', 'file-name': kwargs['Key'][-1]}}
+
+        mock_s3.get_object.side_effect = get_object
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+        result = s3_adapter.zip_directory('bucket', '123', 'dir', 'test.zip')
+
+        mock_s3.get_paginator.assert_called_once_with('list_objects_v2')
+        mock_s3.get_paginator.return_value.paginate.assert_called_once_with(Bucket='abc', Prefix='bucket/dir/123',
+                                                                            Delimiter=',')
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(result.file)))
+        self.assertEqual(archive.namelist(), ['0.txt', '1.txt', '2.txt'])
+
     def test_zip_directory_successful_no_name(self, mock_s3):
         body = io.BytesIO(b'test')
 
-        mock_s3.list_objects.return_value = {'Contents': [
+        mock_s3.get_paginator.return_value.paginate.return_value = [{'Contents': [
             {'Key': 'abc'}
-        ]}
+        ]}]
 
         mock_s3.get_object.return_value = {
             'Body': body,
@@ -152,7 +405,7 @@ class TestS3StorageAdapter(TestCase):
     def test_zip_directory_no_files(self, mock_s3):
         body = io.BytesIO(b'test')
 
-        mock_s3.list_objects.return_value = {'Contents': []}
+        mock_s3.get_paginator.return_value.paginate.return_value = [{'Contents': []}]
 
         mock_s3.get_object.return_value = {
             'Body': body,
@@ -171,7 +424,7 @@ class TestS3StorageAdapter(TestCase):
     def test_zip_directory_exception(self, mock_s3):
         with main.app.test_request_context():
             g.trace_id = '123'
-            mock_s3.list_objects.side_effect = Exception('failed to get')
+            mock_s3.get_paginator.side_effect = Exception('failed to get')
             s3_adapter = S3StorageAdapter()
             s3_adapter._connection = mock_s3
             self.assertRaises(ApplicationError, s3_adapter.zip_directory, 'bucket', '123', 'dir', 'test.zip')
@@ -198,6 +451,33 @@ class TestS3StorageAdapter(TestCase):
         self.assertIn('external_reference', result)
         self.assertEqual('abc', result['external_reference'])
 
+    def test_get_file_external_url_file_etag(self, mock_s3):
+        mock_s3.list_objects_v2.return_value = {'Contents': []}
+        mock_s3.head_object.return_value = {'Metadata': {'sha256': 'hash'}}
+        mock_s3.generate_presigned_url.return_value = "abc"
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+
+        result = s3_adapter.get_file_external_url('bucket', 'file')
+
+        self.assertEqual({'external_reference': 'abc', 'etag': 'hash'}, result)
+
+    def test_get_etag(self, mock_s3):
+        mock_s3.head_object.return_value = {'Metadata': {'sha256': 'hash'}}
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+
+        self.assertEqual('hash', s3_adapter.get_etag('bucket', 'file', 'sub'))
+        mock_s3.head_object.assert_called_with(Bucket='abc', Key='bucket/sub/file')
+
+    def test_get_etag_no_file(self, mock_s3):
+        mock_s3.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'head_object')
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+
+        self.assertIsNone(s3_adapter.get_etag('bucket', 'file'))
+
     def test_get_file_external_url_file_no_file(self, mock_s3):
         mock_s3.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'get_object')
 
@@ -211,9 +491,12 @@ class TestS3StorageAdapter(TestCase):
     def test_get_file_external_url_dir_successful(self, mock_s3):
         body = io.BytesIO(b'test')
 
-        mock_s3.list_objects.return_value = {'Contents': [
+        mock_s3.list_objects_v2.return_value = {'Contents': [
             {'Key': 'abc'}
         ]}
+        mock_s3.get_paginator.return_value.paginate.return_value = [{'Contents': [
+            {'Key': 'abc'}
+        ]}]
 
         mock_s3.get_object.return_value = {
             'Body': body,
@@ -223,6 +506,7 @@ class TestS3StorageAdapter(TestCase):
             }
         }
 
+        mock_s3.head_object.side_effect = not_found
         mock_s3.generate_presigned_url.return_value = "abc"
 
         s3_adapter = S3StorageAdapter()
@@ -233,13 +517,83 @@ class TestS3StorageAdapter(TestCase):
         self.assertIsNotNone(result)
         self.assertIn('external_reference', result)
         self.assertEqual('abc', result['external_reference'])
+        mock_s3.upload_fileobj.assert_called_once()
+        self.assertEqual(mock_s3.upload_fileobj.call_args[1]['ExtraArgs']['ContentType'], 'application/zip')
+
+    def test_get_file_external_url_dir_cached(self, mock_s3):
+        main.app.config["ARCHIVE_CACHE_ENABLED"] = True
+        main.app.config["ARCHIVE_CACHE_LOCATION"] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, main.app.config["ARCHIVE_CACHE_LOCATION"])
+        self.addCleanup(main.app.config.update, ARCHIVE_CACHE_ENABLED=False)
+        mock_s3.list_objects_v2.return_value = {'Contents': [{'Key': 'bucket/file/abc'}]}
+        mock_s3.get_paginator.return_value.paginate.return_value = [{'Contents': [
+            {'Key': 'bucket/file/abc', 'Size': 4, 'ETag': 'etag'}
+        ]}]
+        mock_s3.head_object.side_effect = [not_found, {'LastModified': datetime.now(timezone.utc)}]
+        mock_s3.generate_presigned_url.return_value = "abc"
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+        result = s3_adapter.get_file_external_url('bucket', 'file')
+
+        fingerprint = S3StorageAdapter.get_listing_fingerprint([{'Key': 'bucket/file/abc', 'Size': 4,
+                                                                 'ETag': 'etag'}])
+        self.assertEqual('abc', result['external_reference'])
+        mock_s3.head_object.assert_called_with(Bucket='abc', Key='temp/bucket/{}'.format(fingerprint))
+        mock_s3.upload_fileobj.assert_not_called()
+
+    def test_get_file_external_url_dir_cache_expired(self, mock_s3):
+        main.app.config["ARCHIVE_CACHE_ENABLED"] = True
+        main.app.config["ARCHIVE_CACHE_LOCATION"] = tempfile.mkdtemp()
+        main.app.config["ARCHIVE_CACHE_TTL"] = 60
+        self.addCleanup(shutil.rmtree, main.app.config["ARCHIVE_CACHE_LOCATION"])
+        self.addCleanup(main.app.config.update, ARCHIVE_CACHE_ENABLED=False)
+        mock_s3.list_objects_v2.return_value = {'Contents': [{'Key': 'bucket/file/abc'}]}
+        mock_s3.get_paginator.return_value.paginate.return_value = [{'Contents': [
+            {'Key': 'bucket/file/abc', 'Size': 4, 'ETag': 'etag'}
+        ]}]
+        mock_s3.head_object.side_effect = [not_found,
+                                           {'LastModified': datetime.now(timezone.utc) - timedelta(seconds=120)}]
+        mock_s3.generate_presigned_url.return_value = "abc"
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+        result = s3_adapter.get_file_external_url('bucket', 'file')
+
+        self.assertEqual('abc', result['external_reference'])
+        mock_s3.upload_fileobj.assert_called_once()
+        self.assertTrue(mock_s3.upload_fileobj.call_args[0][2].startswith('temp/bucket/'))
+
+    def test_zip_directory_archive_cache(self, mock_s3):
+        main.app.config["S3_ZIP_CONCURRENCY"] = 1
+        main.app.config["ARCHIVE_CACHE_ENABLED"] = True
+        main.app.config["ARCHIVE_CACHE_LOCATION"] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, main.app.config["ARCHIVE_CACHE_LOCATION"])
+        self.addCleanup(main.app.config.update, ARCHIVE_CACHE_ENABLED=False)
+        mock_s3.get_paginator.return_value.paginate.side_effect = lambda **kwargs: [{'Contents': [
+            {'Key': 'dir/abc', 'Size': 4, 'ETag': 'etag'}
+        ]}]
+        body = MagicMock()
+        body.iter_chunks.return_value = iter([b'test'])
+        mock_s3.get_object.return_value = {'Body': body, 'Metadata': {'content-type': 'text/plain',
+                                                                      'file-name': 'test'}}
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+        archive = b''.join(s3_adapter.zip_directory('bucket', '123', 'dir', 'test.zip').file)
+        cached = s3_adapter.zip_directory('bucket', '123', 'dir', 'test.zip')
+
+        self.assertEqual(cached.file.read(), archive)
+        cached.file.close()
+        mock_s3.get_object.assert_called_once()
 
     def test_get_file_external_url_dir_no_file(self, mock_s3):
-        mock_s3.list_objects.side_effect = [
-            {'Contents': [{'Key': 'abc'}]}, {'Contents': []}]
+        mock_s3.list_objects_v2.return_value = {'Contents': [{'Key': 'abc'}]}
+        mock_s3.get_paginator.return_value.paginate.return_value = [{'Contents': []}]
 
         mock_s3.get_object.side_effect = ClientError({'Error': {'Code': 'NoSuchKey'}}, 'get_object')
 
+        mock_s3.head_object.side_effect = not_found
         mock_s3.generate_presigned_url.return_value = "abc"
 
         s3_adapter = S3StorageAdapter()
@@ -249,6 +603,42 @@ class TestS3StorageAdapter(TestCase):
 
         self.assertIsNone(result)
 
+    def test_get_s3_signed_url_cached(self, mock_s3):
+        mock_s3.generate_presigned_url.side_effect = ["abc", "def"]
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+
+        self.assertEqual('abc', s3_adapter.get_s3_signed_url('bucket/file'))
+        self.assertEqual('abc', s3_adapter.get_s3_signed_url('bucket/file'))
+        self.assertEqual('def', s3_adapter.get_s3_signed_url('bucket/other'))
+        self.assertEqual(2, mock_s3.generate_presigned_url.call_count)
+        stats = S3StorageAdapter.get_presigned_url_cache().stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+        self.assertEqual(5, stats['ttl'])
+
+    def test_get_s3_signed_url_cache_disabled(self, mock_s3):
+        main.app.config["S3_PRESIGNED_URL_CACHE_SIZE"] = 0
+        self.addCleanup(main.app.config.update, S3_PRESIGNED_URL_CACHE_SIZE=10000)
+        mock_s3.generate_presigned_url.side_effect = ["abc", "def"]
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+
+        self.assertEqual('abc', s3_adapter.get_s3_signed_url('bucket/file'))
+        self.assertEqual('def', s3_adapter.get_s3_signed_url('bucket/file'))
+
+    def test_delete_file_removes_signed_url(self, mock_s3):
+        mock_s3.generate_presigned_url.side_effect = ["abc", "def"]
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+        s3_adapter.get_s3_signed_url('bucket/file')
+        s3_adapter.delete_file('bucket', 'file')
+
+        self.assertEqual('def', s3_adapter.get_s3_signed_url('bucket/file'))
+
     def test_delete_file_successful(self, mock_s3):
 
         mock_s3.head_object.return_value = {'ResponseMetadata': {'HTTPStatusCode': 200}}
@@ -277,8 +667,62 @@ class TestS3StorageAdapter(TestCase):
             s3_adapter._connection = mock_s3
             self.assertRaises(ApplicationError, s3_adapter.delete_file, 'bucket', 'file')
 
+    def test_delete_files(self, mock_s3):
+        main.app.config["S3_DELETE_CHECK_EXISTS"] = False
+        self.addCleanup(main.app.config.update, S3_DELETE_CHECK_EXISTS=True)
+        mock_s3.delete_objects.side_effect = [{}, {'Errors': [{'Key': 'bucket/1001', 'Message': 'Access Denied'}]}]
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+        with main.app.test_request_context():
+            g.trace_id = '123'
+            results = s3_adapter.delete_files('bucket', [(str(index), None) for index in range(1500)])
+
+        # Split into requests of at most 1000 keys
+        self.assertEqual([len(call[1]['Delete']['Objects']) for call in mock_s3.delete_objects.call_args_list],
+                         [1000, 500])
+        self.assertEqual(results.count(True), 1499)
+        self.assertIsNone(results[1001])
+        mock_s3.head_object.assert_not_called()
+
+    def test_delete_files_check_exists(self, mock_s3):
+        mock_s3.head_object.side_effect = lambda **kwargs: {'Metadata': {}} if kwargs['Key'] == 'bucket/a/file' \
+            else self.raise_not_found()
+        mock_s3.delete_objects.return_value = {}
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+        results = s3_adapter.delete_files('bucket', [('file', 'a'), ('missing', None)])
+
+        self.assertEqual(results, [True, False])
+        mock_s3.delete_objects.assert_called_once_with(Bucket=ANY, Delete={'Objects': [{'Key': 'bucket/a/file'}],
+                                                                           'Quiet': True})
+
+    @staticmethod
+    def raise_not_found():
+        raise ClientError({'Error': {'Code': '404'}}, 'head_object')
+
+    def test_get_file_external_urls_listing_too_long(self, mock_s3):
+        # Only the first keys of a large directory are listed before heading the rest is fewer requests
+        pages = [{'Contents': [{'Key': 'bucket/0', 'Size': 4}]}, {'Contents': [{'Key': 'bucket/00', 'Size': 4}]},
+                 {'Contents': [{'Key': 'bucket/000', 'Size': 4}]}]
+        mock_s3.get_paginator.return_value.paginate.return_value = iter(pages)
+        mock_s3.head_object.return_value = {'ContentLength': 4, 'Metadata': {'sha256': 'hash'}}
+        mock_s3.generate_presigned_url.side_effect = lambda **kwargs: kwargs['Params']['Key']
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+        results = s3_adapter.get_file_external_urls('bucket', [('0', None), ('1', None), ('2', None)])
+
+        self.assertEqual(results, [{'external_reference': 'bucket/0'},
+                                   {'external_reference': 'bucket/1', 'etag': 'hash'},
+                                   {'external_reference': 'bucket/2', 'etag': 'hash'}])
+        mock_s3.get_paginator.return_value.paginate.assert_called_once_with(
+            Bucket=ANY, Prefix='bucket/', Delimiter='/', StartAfter='bucket/')
+        self.assertEqual(mock_s3.head_object.call_count, 2)
+
     def test_is_directory_true(self, mock_s3):
-        mock_s3.list_objects.return_value = {'Contents': [
+        mock_s3.list_objects_v2.return_value = {'Contents': [
             {'Key': 'abc'}
         ]}
 
@@ -288,7 +732,7 @@ class TestS3StorageAdapter(TestCase):
         self.assertTrue(s3_adapter.is_directory('bucket', 'file'))
 
     def test_is_directory_false_if_only_key_matches(self, mock_s3):
-        mock_s3.list_objects.return_value = {'Contents': [
+        mock_s3.list_objects_v2.return_value = {'Contents': [
             {'Key': 'bucket/abc'}
         ]}
 
@@ -297,8 +741,19 @@ class TestS3StorageAdapter(TestCase):
 
         self.assertFalse(s3_adapter.is_directory('bucket', 'abc'))
 
+    def test_is_directory_max_keys(self, mock_s3):
+        mock_s3.list_objects_v2.return_value = {'Contents': [
+            {'Key': 'bucket/abc'}, {'Key': 'bucket/abc/def'}
+        ]}
+
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+
+        self.assertTrue(s3_adapter.is_directory('bucket', 'abc'))
+        mock_s3.list_objects_v2.assert_called_once_with(Bucket='abc', Prefix='bucket/abc', Delimiter=',', MaxKeys=2)
+
     def test_is_directory_false(self, mock_s3):
-        mock_s3.list_objects.return_value = {'Contents': []}
+        mock_s3.list_objects_v2.return_value = {'Contents': []}
 
         s3_adapter = S3StorageAdapter()
         s3_adapter._connection = mock_s3
@@ -347,6 +802,110 @@ class TestS3StorageAdapter(TestCase):
 
             self.assertRaises(ApplicationError, s3_adapter.does_file_exist, 'key')
 
+    def test_get_metadata_cached(self, mock_s3):
+        mock_s3.head_object.return_value = {'ContentLength': 4, 'ContentType': 'binary/octet-stream',
+                                            'Metadata': {'content-type': 'text/plain', 'file-name': 'test.txt',
+                                                         'sha256': 'hash'}}
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+
+        s3_adapter.get_metadata('bucket/file')
+        metadata = s3_adapter.get_metadata('bucket/file')
+
+        self.assertTrue(metadata['exists'])
+        self.assertEqual(4, metadata['size'])
+        self.assertEqual('text/plain', metadata['content_type'])
+        self.assertEqual('test.txt', metadata['file_name'])
+        self.assertEqual('hash', metadata['etag'])
+        mock_s3.head_object.assert_called_once_with(Bucket='abc', Key='bucket/file')
+
+    def test_get_metadata_missing_cached(self, mock_s3):
+        mock_s3.head_object.side_effect = not_found
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+
+        self.assertFalse(s3_adapter.does_file_exist('bucket/file'))
+        self.assertFalse(s3_adapter.does_file_exist('bucket/file'))
+        self.assertIsNone(s3_adapter.get_file('bucket', 'file'))
+
+        mock_s3.head_object.assert_called_once()
+        mock_s3.get_object.assert_not_called()
+
+    def test_get_metadata_missing_not_cached(self, mock_s3):
+        self.addCleanup(main.app.config.update,
+                        S3_METADATA_CACHE_NEGATIVE_TTL=main.app.config['S3_METADATA_CACHE_NEGATIVE_TTL'])
+        main.app.config['S3_METADATA_CACHE_NEGATIVE_TTL'] = 0
+        mock_s3.head_object.side_effect = not_found
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+
+        self.assertFalse(s3_adapter.does_file_exist('bucket/file'))
+        self.assertFalse(s3_adapter.does_file_exist('bucket/file'))
+
+        self.assertEqual(2, mock_s3.head_object.call_count)
+
+    def test_get_file_caches_metadata(self, mock_s3):
+        mock_s3.get_object.return_value = {'Body': io.BytesIO(b'test'), 'ContentLength': 4,
+                                           'Metadata': {'content-type': 'text/plain', 'file-name': 'test.txt',
+                                                        'sha256': 'hash'}}
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+
+        s3_adapter.get_file('bucket', 'file')
+
+        self.assertEqual('hash', s3_adapter.get_etag('bucket', 'file'))
+        self.assertEqual(4, s3_adapter.get_metadata('bucket/file')['size'])
+        mock_s3.head_object.assert_not_called()
+
+    @patch('storage_api.dependencies.storage.s3_storage_adapter.uuid')
+    def test_save_file_caches_metadata(self, mock_uuid, mock_s3):
+        mock_uuid.uuid4.return_value = "123"
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+
+        s3_adapter.save_file('bucket', StorageItem(io.BytesIO(b'test'), 'text/plain', 'test'), 'dir')
+        metadata = s3_adapter.get_metadata('bucket/dir/123')
+
+        self.assertTrue(metadata['exists'])
+        self.assertEqual('text/plain', metadata['content_type'])
+        self.assertEqual('test', metadata['file_name'])
+        self.assertEqual(hashlib.sha256(b'test').hexdigest(), metadata['etag'])
+        mock_s3.head_object.assert_not_called()
+
+    def test_delete_file_caches_missing(self, mock_s3):
+        mock_s3.head_object.return_value = {'Metadata': {}}
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+
+        self.assertTrue(s3_adapter.delete_file('bucket', 'file'))
+
+        self.assertFalse(s3_adapter.does_file_exist('bucket/file'))
+        mock_s3.head_object.assert_called_once()
+
+    def test_is_directory_cached(self, mock_s3):
+        mock_s3.list_objects_v2.return_value = {'Contents': [{'Key': 'bucket/dir/one'}]}
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+
+        self.assertTrue(s3_adapter.is_directory('bucket', 'dir'))
+        self.assertTrue(s3_adapter.is_directory('bucket', 'dir'))
+
+        mock_s3.list_objects_v2.assert_called_once()
+
+    @patch('storage_api.dependencies.storage.s3_storage_adapter.uuid')
+    def test_save_file_invalidates_directories(self, mock_uuid, mock_s3):
+        mock_uuid.uuid4.return_value = "123"
+        mock_s3.list_objects_v2.return_value = {'Contents': []}
+        s3_adapter = S3StorageAdapter()
+        s3_adapter._connection = mock_s3
+
+        self.assertFalse(s3_adapter.is_directory('bucket', 'dir'))
+        s3_adapter.save_file('bucket', StorageItem(io.BytesIO(b'test'), 'text/plain', 'test'), 'dir')
+        mock_s3.list_objects_v2.return_value = {'Contents': [{'Key': 'bucket/dir/123'}]}
+
+        self.assertTrue(s3_adapter.is_directory('bucket', 'dir'))
+        self.assertEqual(2, mock_s3.list_objects_v2.call_count)
+
     def test_get_full_filename_supports_csv(self, mock_s3):
         with main.app.test_request_context():
             g.trace_id = '123'
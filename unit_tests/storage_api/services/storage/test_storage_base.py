@@ -1,4 +1,5 @@
 from unittest import TestCase
+from unittest.mock import patch
 
 from storage_api.dependencies.storage.storage_base import StorageBase
 
@@ -34,6 +35,29 @@ class TestStorageBase(TestCase):
             mbase = MockBase()
             mbase.zip_directory(1, 1, 1, 1)
 
+    def test_base_get_etag_not_implemented(self):
+        with self.assertRaises(NotImplementedError):
+            mbase = MockBase()
+            mbase.get_etag(1, 1)
+
+    def test_resolve_directory(self):
+        mbase = MockBase()
+        with patch.object(mbase, 'is_directory', return_value=True), \
+                patch.object(mbase, 'zip_directory') as mock_zip_directory:
+            result = mbase.resolve('bucket', 'dir', None, archive_name='archive.zip')
+
+        self.assertEqual(result, (mock_zip_directory.return_value, True))
+        mock_zip_directory.assert_called_with('bucket', 'dir', None, 'archive.zip')
+
+    def test_resolve_file(self):
+        mbase = MockBase()
+        with patch.object(mbase, 'is_directory', return_value=False), \
+                patch.object(mbase, 'get_file') as mock_get_file:
+            result = mbase.resolve('bucket', 'file', None, byte_range='range')
+
+        self.assertEqual(result, (mock_get_file.return_value, False))
+        mock_get_file.assert_called_with('bucket', 'file', None, byte_range='range')
+
     def test_get_file_external_url(self):
         with self.assertRaises(NotImplementedError):
             mbase = MockBase()
@@ -41,6 +65,9 @@ class TestStorageBase(TestCase):
 
 
 class MockBase(StorageBase):
+    def get_etag(self, bucket, file_id, subdirectories=None):
+        return super(MockBase, self).get_etag(bucket, file_id, subdirectories)
+
     def get_file_external_url(self, bucket, file_id, subdirectories=None):
         return super(MockBase, self).get_file_external_url(bucket, file_id, subdirectories)
 
@@ -0,0 +1,65 @@
+import io
+import zipfile
+from datetime import datetime
+from unittest import TestCase
+
+from storage_api.dependencies.storage.zip_stream import (IteratorFile,
+                                                         ZipMember, ZipStream)
+
+CONTENT = b'test' * 50000
+
+
+class TestZipStream(TestCase):
+    def test_zip_stream(self):
+        members = [ZipMember('a.txt', [CONTENT[:1000], CONTENT[1000:]], datetime(2020, 1, 2, 3, 4, 6)),
+                   ZipMember('b.txt', [], None)]
+
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(ZipStream(members))))
+
+        self.assertEqual(archive.namelist(), ['a.txt', 'b.txt'])
+        self.assertEqual(archive.read('a.txt'), CONTENT)
+        self.assertEqual(archive.read('b.txt'), b'')
+        self.assertEqual(archive.getinfo('a.txt').date_time, (2020, 1, 2, 3, 4, 6))
+        self.assertIsNone(archive.testzip())
+
+    def test_zip_stream_reads_members_lazily(self):
+        read = []
+
+        def members():
+            for name in ['a.txt', 'b.txt']:
+                read.append(name)
+                yield ZipMember(name, [CONTENT], None)
+
+        stream = iter(ZipStream(members()))
+        next(stream)
+
+        self.assertEqual(read, ['a.txt'])
+
+    def test_zip_stream_close(self):
+        closed = []
+
+        def members():
+            try:
+                yield ZipMember('a.txt', [CONTENT], None)
+            finally:
+                closed.append(True)
+
+        stream = ZipStream(members())
+        next(iter(stream))
+        stream.close()
+
+        self.assertEqual(closed, [True])
+
+    def test_zip_stream_old_date(self):
+        members = [ZipMember('a.txt', [b'test'], datetime(1970, 1, 1))]
+
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(ZipStream(members))))
+
+        self.assertEqual(archive.getinfo('a.txt').date_time, (1980, 1, 1, 0, 0, 0))
+
+    def test_iterator_file(self):
+        file = IteratorFile([b'te', b'', b'st', CONTENT])
+
+        self.assertEqual(file.read(3), b'tes')
+        self.assertEqual(file.read(), b't' + CONTENT)
+        self.assertEqual(file.read(), b'')
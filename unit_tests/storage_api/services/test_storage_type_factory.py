@@ -13,6 +13,9 @@ class TestStorageTypeFactory(TestCase):
     def create_app(self):
         return main.app
 
+    def setUp(self):
+        self.addCleanup(main.app.config.update, STORAGE_TYPE=main.app.config['STORAGE_TYPE'])
+
     def test_file_service(self):
         main.app.config["STORAGE_TYPE"] = "file"
         result = storage_type_factory.get_storage_type()
@@ -32,3 +35,10 @@ class TestStorageTypeFactory(TestCase):
         except Exception as ex:
             self.assertTrue(type(ex) is NotImplementedError)
             self.assertTrue(True)
+
+    def test_is_reserved_bucket(self):
+        main.app.config["STORAGE_TYPE"] = "file"
+
+        self.assertTrue(storage_type_factory.is_reserved_bucket('.index'))
+        self.assertTrue(storage_type_factory.is_reserved_bucket('..'))
+        self.assertFalse(storage_type_factory.is_reserved_bucket('bucket'))
@@ -0,0 +1,175 @@
+import base64
+import json
+import time
+from unittest import TestCase
+from unittest.mock import Mock
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from flask import g
+from jwt_validation.exceptions import ValidationFailure
+from storage_api import main
+from storage_api.cache import get_cache_stats
+from storage_api.dependencies import token_validation
+
+# Only for signing test tokens
+PRIVATE_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def encode_segment(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def encode_integer(value):
+    return encode_segment(value.to_bytes((value.bit_length() + 7) // 8, 'big'))
+
+
+JWKS = {'keys': [{'kty': 'RSA', 'kid': 'key1', 'use': 'sig',
+                  'n': encode_integer(PRIVATE_KEY.public_key().public_numbers().n),
+                  'e': encode_integer(PRIVATE_KEY.public_key().public_numbers().e)}]}
+
+
+def make_token(claims, kid='key1', alg='RS256'):
+    header = encode_segment(json.dumps({'alg': alg, 'typ': 'JWT', 'kid': kid}).encode())
+    payload = encode_segment(json.dumps(claims).encode())
+    message = '{}.{}'.format(header, payload).encode()
+    signature = PRIVATE_KEY.sign(message, padding.PKCS1v15(), hashes.SHA256())
+    return '{}.{}.{}'.format(header, payload, encode_segment(signature))
+
+
+class TestTokenValidation(TestCase):
+    def setUp(self):
+        self.addCleanup(main.app.config.update,
+                        JWT_VALIDATION_CACHE_SIZE=main.app.config['JWT_VALIDATION_CACHE_SIZE'],
+                        JWT_VALIDATION_CACHE_TTL=main.app.config['JWT_VALIDATION_CACHE_TTL'],
+                        JWT_SIGNING_KEYS_URL=main.app.config['JWT_SIGNING_KEYS_URL'],
+                        JWT_ISSUER=main.app.config['JWT_ISSUER'], JWT_AUDIENCE=main.app.config['JWT_AUDIENCE'])
+        main.app.config.update(JWT_VALIDATION_CACHE_SIZE=10, JWT_VALIDATION_CACHE_TTL=300, JWT_SIGNING_KEYS_URL=None,
+                               JWT_ISSUER=None, JWT_AUDIENCE=None)
+        self.reset()
+        self.addCleanup(self.reset)
+        context = main.app.test_request_context()
+        context.push()
+        self.addCleanup(context.pop)
+        g.trace_id = '123'
+        g.requests = Mock()
+        g.requests.get.return_value.json.return_value = JWKS
+
+    @staticmethod
+    def reset():
+        token_validation._validations = None
+        token_validation._signing_keys = None
+        token_validation._signing_keys_fetched = None
+
+    def test_get_claims(self):
+        token = make_token({'sub': 'user', 'exp': 2000000000})
+
+        self.assertEqual(token_validation.get_claims(token), {'sub': 'user', 'exp': 2000000000})
+        self.assertEqual(token_validation.get_claims('Bearer ' + token), {'sub': 'user', 'exp': 2000000000})
+        self.assertIsNone(token_validation.get_claims(make_token({'sub': 'user'})))
+        self.assertIsNone(token_validation.get_claims('Fake JWT'))
+        self.assertIsNone(token_validation.get_claims('a.b!.c'))
+
+    def test_is_valid_cached(self):
+        token = make_token({'exp': time.time() + 600})
+
+        self.assertFalse(token_validation.is_valid(token))
+        token_validation.add_valid(token)
+
+        self.assertTrue(token_validation.is_valid(token))
+        self.assertFalse(token_validation.is_valid(make_token({'exp': time.time() + 601})))
+        self.assertEqual(get_cache_stats()['jwt_validations']['hits'], 1)
+
+    def test_add_valid_expiry(self):
+        token = make_token({'exp': time.time() + 60})
+        token_validation.add_valid(token)
+        token_validation.add_valid(make_token({'exp': time.time() - 1}))
+        token_validation.add_valid('Fake JWT')
+
+        entries = token_validation.get_validation_cache()._entries
+        self.assertEqual(list(entries), [token_validation.get_cache_key(token)])
+        # Cached until the token expires, rather than for JWT_VALIDATION_CACHE_TTL
+        self.assertLessEqual(entries[token_validation.get_cache_key(token)][1], time.monotonic() + 60)
+
+    def test_add_valid_disabled(self):
+        main.app.config.update(JWT_VALIDATION_CACHE_SIZE=0)
+        token = make_token({'exp': time.time() + 600})
+
+        token_validation.add_valid(token)
+
+        self.assertFalse(token_validation.is_valid(token))
+
+    def test_is_valid_signature(self):
+        main.app.config.update(JWT_SIGNING_KEYS_URL='http://auth/keys')
+        token = make_token({'exp': time.time() + 600})
+
+        self.assertTrue(token_validation.is_valid(token))
+        self.assertTrue(token_validation.is_valid(make_token({'exp': time.time() + 601})))
+
+        # The keys are fetched once and the validations are cached
+        g.requests.get.assert_called_once_with('http://auth/keys')
+        self.assertTrue(token_validation.is_valid(token))
+        self.assertEqual(get_cache_stats()['jwt_validations']['hits'], 1)
+
+    def test_is_valid_signature_invalid(self):
+        main.app.config.update(JWT_SIGNING_KEYS_URL='http://auth/keys')
+        header, payload, signature = make_token({'exp': time.time() + 600}).split('.')
+        tampered = '{}.{}.{}'.format(header, encode_segment(json.dumps({'exp': time.time() + 6000}).encode()),
+                                     signature)
+
+        self.assertRaises(ValidationFailure, token_validation.is_valid, tampered)
+        self.assertRaises(ValidationFailure, token_validation.is_valid, make_token({'exp': time.time() - 1}))
+        self.assertRaises(ValidationFailure, token_validation.is_valid,
+                          make_token({'exp': time.time() + 600, 'nbf': time.time() + 60}))
+        self.assertEqual(token_validation.get_validation_cache().stats()['size'], 0)
+
+    def test_is_valid_signature_rs512(self):
+        main.app.config.update(JWT_SIGNING_KEYS_URL='http://auth/keys')
+        header = encode_segment(json.dumps({'alg': 'RS512', 'typ': 'JWT', 'kid': 'key1'}).encode())
+        payload = encode_segment(json.dumps({'exp': time.time() + 600}).encode())
+        message = '{}.{}'.format(header, payload).encode()
+
+        self.assertTrue(token_validation.is_valid('{}.{}.{}'.format(header, payload, encode_segment(
+            PRIVATE_KEY.sign(message, padding.PKCS1v15(), hashes.SHA512())))))
+        # Signed with a different hash to the one named by alg
+        self.assertRaises(ValidationFailure, token_validation.is_valid, '{}.{}.{}'.format(
+            header, payload, encode_segment(PRIVATE_KEY.sign(message, padding.PKCS1v15(), hashes.SHA256()))))
+
+    def test_is_valid_issuer_and_audience(self):
+        main.app.config.update(JWT_SIGNING_KEYS_URL='http://auth/keys', JWT_ISSUER='auth', JWT_AUDIENCE='storage')
+        exp = time.time() + 600
+
+        self.assertTrue(token_validation.is_valid(make_token({'exp': exp, 'iss': 'auth', 'aud': 'storage'})))
+        self.assertTrue(token_validation.is_valid(make_token({'exp': exp, 'iss': 'auth',
+                                                              'aud': ['search', 'storage']})))
+        self.assertRaises(ValidationFailure, token_validation.is_valid,
+                          make_token({'exp': exp, 'iss': 'other', 'aud': 'storage'}))
+        self.assertRaises(ValidationFailure, token_validation.is_valid, make_token({'exp': exp, 'aud': 'storage'}))
+        self.assertRaises(ValidationFailure, token_validation.is_valid,
+                          make_token({'exp': exp, 'iss': 'auth', 'aud': ['search']}))
+        self.assertRaises(ValidationFailure, token_validation.is_valid, make_token({'exp': exp, 'iss': 'auth'}))
+
+    def test_is_valid_signature_not_verifiable(self):
+        main.app.config.update(JWT_SIGNING_KEYS_URL='http://auth/keys')
+
+        self.assertFalse(token_validation.is_valid(make_token({'exp': time.time() + 600}, alg='HS256')))
+        self.assertFalse(token_validation.is_valid(make_token({'exp': time.time() + 600}, kid='key2')))
+        self.assertFalse(token_validation.is_valid(make_token({'exp': time.time() + 600}, kid='key3')))
+
+        # Unknown keys don't fetch the keys again until SIGNING_KEYS_REFRESH_INTERVAL has passed
+        g.requests.get.assert_called_once_with('http://auth/keys')
+
+    def test_is_valid_signing_keys_failed(self):
+        main.app.config.update(JWT_SIGNING_KEYS_URL='http://auth/keys')
+        g.requests.get.side_effect = ConnectionError('Failed')
+
+        self.assertFalse(token_validation.is_valid(make_token({'exp': time.time() + 600})))
+
+    def test_is_valid_signing_keys_refreshed(self):
+        main.app.config.update(JWT_SIGNING_KEYS_URL='http://auth/keys')
+        token_validation._signing_keys = {}
+        token_validation._signing_keys_fetched = time.monotonic() - token_validation.SIGNING_KEYS_REFRESH_INTERVAL
+
+        # A token signed with a new key fetches the keys again
+        self.assertTrue(token_validation.is_valid(make_token({'exp': time.time() + 600})))
+        g.requests.get.assert_called_once_with('http://auth/keys')
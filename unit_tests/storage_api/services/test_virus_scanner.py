@@ -0,0 +1,242 @@
+import io
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import g
+from storage_api import main
+from storage_api.cache import LRUCache, get_cache_stats
+from storage_api.dependencies import virus_scanner
+from storage_api.dependencies.virus_scanner import ClamdScanner, ScanError
+
+
+class FakeClamd(object):
+    """Answers the clamd session commands the scanner uses, finding a threat in any stream containing EICAR"""
+
+    def __init__(self, path, stream_max_length=1024 * 1024):
+        self.stream_max_length = stream_max_length
+        self.version = 'ClamAV 1.0.1/26914/Mon Jun 12 07:54:16 2023'
+        self.connections = 0
+        self.commands = []
+        self.largest_chunk = 0
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(5)
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                connection, address = self.server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def handle(self, connection):
+        with connection, connection.makefile('rb') as reader:
+            request_id = 0
+            while True:
+                command = self.read_command(reader)
+                self.commands.append(command)
+                if command in (None, b'END'):
+                    return
+                if command == b'IDSESSION':
+                    continue
+                request_id += 1
+                if command == b'PING':
+                    reply = 'PONG'
+                elif command == b'VERSION':
+                    reply = self.version
+                elif command == b'INSTREAM':
+                    reply = self.instream(reader)
+                else:
+                    reply = 'UNKNOWN COMMAND'
+                try:
+                    connection.sendall('{}: {}\0'.format(request_id, reply).encode())
+                except OSError:
+                    return
+                if reply.endswith('ERROR'):
+                    return
+
+    def instream(self, reader):
+        data = b''
+        while True:
+            header = reader.read(4)
+            if len(header) < 4:
+                # The scanner gave up on the scan and closed the connection
+                return 'stream: OK'
+            size = struct.unpack('!L', header)[0]
+            if size == 0:
+                break
+            self.largest_chunk = max(self.largest_chunk, size)
+            data += reader.read(size)
+            if len(data) > self.stream_max_length:
+                return 'INSTREAM size limit exceeded. ERROR'
+        if b'EICAR' in data:
+            return 'stream: Eicar-Test-Signature FOUND'
+        return 'stream: OK'
+
+    @staticmethod
+    def read_command(reader):
+        command = b''
+        while True:
+            char = reader.read(1)
+            if not char:
+                return None
+            if char == b'\0':
+                return command[1:]
+            command += char
+
+    def close(self):
+        self.server.close()
+
+
+class TestVirusScanner(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'clamd.sock')
+        self.clamd = FakeClamd(self.path, stream_max_length=1000)
+        self.addCleanup(self.clamd.close)
+
+    def scanner(self, **kwargs):
+        scanner = ClamdScanner(self.path, chunk_size=16, **kwargs)
+        self.addCleanup(scanner.close)
+        return scanner
+
+    def test_scan_clean(self):
+        self.assertIsNone(self.scanner().scan(io.BytesIO(b'clean file')))
+
+    def test_scan_threat(self):
+        self.assertEqual(self.scanner().scan(io.BytesIO(b'X5O!P%@AP EICAR')), 'Eicar-Test-Signature')
+
+    def test_scan_chunks(self):
+        file = io.BytesIO(b'a' * 100)
+
+        self.scanner().scan(file)
+
+        self.assertEqual(self.clamd.largest_chunk, 16)
+        self.assertEqual(file.tell(), 100)
+
+    def test_scan_reuses_connection(self):
+        scanner = self.scanner()
+
+        for i in range(3):
+            scanner.scan(io.BytesIO(b'clean file'))
+
+        self.assertEqual(self.clamd.connections, 1)
+        self.assertEqual(self.clamd.commands, [b'IDSESSION', b'INSTREAM', b'INSTREAM', b'INSTREAM'])
+
+    def test_scan_health_check(self):
+        scanner = self.scanner(health_check_interval=0)
+
+        scanner.scan(io.BytesIO(b'clean file'))
+        time.sleep(0.01)
+        scanner.scan(io.BytesIO(b'clean file'))
+
+        self.assertEqual(self.clamd.connections, 1)
+        self.assertEqual(self.clamd.commands, [b'IDSESSION', b'INSTREAM', b'PING', b'INSTREAM'])
+
+    def test_scan_replaces_closed_connection(self):
+        scanner = self.scanner(health_check_interval=0)
+        scanner.scan(io.BytesIO(b'clean file'))
+        # As clamd does to sessions that have been idle too long
+        scanner._idle[0]._socket.shutdown(socket.SHUT_RDWR)
+        time.sleep(0.01)
+
+        self.assertIsNone(scanner.scan(io.BytesIO(b'clean file')))
+        self.assertEqual(self.clamd.connections, 2)
+
+    def test_scan_error(self):
+        scanner = self.scanner()
+
+        self.assertRaises(ScanError, scanner.scan, io.BytesIO(b'a' * 2000))
+        # The session clamd ended isn't reused
+        self.assertIsNone(scanner.scan(io.BytesIO(b'clean file')))
+        self.assertEqual(self.clamd.connections, 2)
+
+    def test_scan_no_clamd(self):
+        scanner = ClamdScanner(os.path.join(self.directory, 'missing.sock'))
+
+        self.assertRaises(ScanError, scanner.scan, io.BytesIO(b'clean file'))
+
+    def test_scan_timeout(self):
+        scanner = self.scanner(timeout=0.05)
+        with patch.object(FakeClamd, 'instream', lambda clamd, reader: time.sleep(0.2) or 'stream: OK'):
+            self.assertRaises(ScanError, scanner.scan, io.BytesIO(b'clean file'))
+
+    def test_scan_pool_size(self):
+        scanner = self.scanner(pool_size=2)
+        threads = [threading.Thread(target=scanner.scan, args=(io.BytesIO(b'clean file' * 50),))
+                   for i in range(6)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertLessEqual(self.clamd.connections, 2)
+
+    def test_scan_verdict_cached(self):
+        verdicts = LRUCache(10)
+        scanner = self.scanner(verdicts=verdicts)
+
+        self.assertIsNone(scanner.scan(io.BytesIO(b'clean file')))
+        file = io.BytesIO(b'clean file')
+        self.assertIsNone(scanner.scan(file))
+        self.assertEqual(scanner.scan(io.BytesIO(b'EICAR')), 'Eicar-Test-Signature')
+        self.assertEqual(scanner.scan(io.BytesIO(b'EICAR')), 'Eicar-Test-Signature')
+
+        self.assertEqual(self.clamd.commands, [b'IDSESSION', b'VERSION', b'INSTREAM', b'INSTREAM'])
+        self.assertEqual(verdicts.stats()['hits'], 2)
+        self.assertEqual(file.tell(), 0)
+
+    def test_scan_verdict_cache_signatures_updated(self):
+        scanner = self.scanner(verdicts=LRUCache(10), version_check_interval=0)
+
+        scanner.scan(io.BytesIO(b'clean file'))
+        self.clamd.version = 'ClamAV 1.0.1/26915/Tue Jun 13 07:54:16 2023'
+        scanner.scan(io.BytesIO(b'clean file'))
+
+        self.assertEqual(self.clamd.commands, [b'IDSESSION', b'VERSION', b'INSTREAM', b'VERSION', b'INSTREAM'])
+
+    def test_scan_verdict_cache_no_version(self):
+        self.clamd.version = 'ClamAV 1.0.1'
+        scanner = self.scanner(verdicts=LRUCache(10))
+
+        scanner.scan(io.BytesIO(b'clean file'))
+        scanner.scan(io.BytesIO(b'clean file'))
+
+        self.assertEqual(self.clamd.commands, [b'IDSESSION', b'VERSION', b'INSTREAM', b'INSTREAM'])
+
+    def test_get_version(self):
+        self.assertEqual(self.scanner().get_version(), '1.0.1/26914')
+
+    def test_get_version_failed(self):
+        scanner = ClamdScanner(os.path.join(self.directory, 'missing.sock'))
+
+        with main.app.test_request_context():
+            g.trace_id = '123'
+            self.assertIsNone(scanner.get_version())
+
+    def test_get_virus_scanner(self):
+        self.addCleanup(setattr, virus_scanner, '_scanner', None)
+        virus_scanner._scanner = None
+        self.addCleanup(main.app.config.update, CLAMD_HOST=main.app.config['CLAMD_HOST'],
+                        CLAMD_SOCKET=main.app.config['CLAMD_SOCKET'])
+        with main.app.app_context():
+            main.app.config.update(CLAMD_HOST=None, CLAMD_SOCKET=self.path)
+
+            scanner = virus_scanner.get_virus_scanner()
+
+            self.assertIs(scanner, virus_scanner.get_virus_scanner())
+            self.assertEqual(scanner.address, self.path)
+            self.assertEqual(scanner.family, socket.AF_UNIX)
+            self.assertIn('clamd_verdicts', get_cache_stats())
@@ -1,9 +1,13 @@
+import base64
+import time
 from unittest import TestCase
 from unittest.mock import Mock, patch
 
 from flask import g
 from jwt_validation.exceptions import ValidationFailure
+from requests import Session
 from storage_api import app, main
+from storage_api.dependencies import token_validation
 from storage_api.exceptions import ApplicationError
 
 
@@ -99,6 +103,90 @@ class TestApp(TestCase):
 
                 g.requests.headers.update.assert_any_call({'X-Trace-ID': self.TRACE_ID})
 
+    @patch('storage_api.app.token_validation')
+    @patch('storage_api.app.validate')
+    @patch('storage_api.app.uuid')
+    @patch('storage_api.app.RequestsSessionTimeout')
+    def test_before_request_cached(self, requests_mock, uuid_mock, validate, token_validation_mock):
+        # Should not call authentication-api for a token already known to be valid
+        with main.app.app_context():
+            with main.app.test_request_context(headers={
+                "X-Trace-ID": self.TRACE_ID,
+                "Authorization": "Fake JWT"
+            }, method="POST"):
+                token_validation_mock.is_valid.return_value = True
+
+                app.before_request()
+
+                validate.assert_not_called()
+                token_validation_mock.add_valid.assert_not_called()
+                g.requests.headers.update.assert_any_call({'Authorization': "Fake JWT"})
+
+    @patch('storage_api.app.validate')
+    @patch('storage_api.app.uuid')
+    @patch('storage_api.app.RequestsSessionTimeout')
+    def test_before_request_caches_validation(self, requests_mock, uuid_mock, validate):
+        # Should cache a validation, so the next request with the token isn't sent to authentication-api
+        self.addCleanup(setattr, token_validation, '_validations', None)
+        token_validation._validations = None
+        header = base64.urlsafe_b64encode(b'{"alg": "none"}').decode().rstrip('=')
+        payload = base64.urlsafe_b64encode('{{"exp": {}}}'.format(int(time.time()) + 600).encode()).decode()
+        token = 'Bearer {}.{}.'.format(header, payload.rstrip('='))
+        with main.app.app_context():
+            for i in range(2):
+                with main.app.test_request_context(headers={
+                    "X-Trace-ID": self.TRACE_ID,
+                    "Authorization": token
+                }, method="POST"):
+                    app.before_request()
+
+        validate.assert_called_once_with(main.app.config['AUTHENTICATION_API_URL'] + '/authentication/validate',
+                                         token, requests_mock.return_value)
+
+    @patch('storage_api.app.requests.Session.request')
+    def test_requests_session(self, request_mock):
+        # Should be a requests session with a default timeout
+        requests_session = app.RequestsSessionTimeout()
+
+        requests_session.get('http://localhost/health')
+        requests_session.post('http://localhost/validate', json={'a': 1}, timeout=5)
+
+        get_call, post_call = request_mock.call_args_list
+        self.assertIsInstance(requests_session, Session)
+        self.assertEqual(get_call.args, ('GET', 'http://localhost/health'))
+        self.assertEqual(get_call.kwargs['timeout'], main.app.config['DEFAULT_TIMEOUT'])
+        self.assertEqual(post_call.args, ('POST', 'http://localhost/validate'))
+        self.assertEqual(post_call.kwargs['timeout'], 5)
+
+    def test_requests_session_shared_adapter(self):
+        self.addCleanup(setattr, app, '_adapter', None)
+        app._adapter = None
+
+        adapter = app.get_adapter()
+        first = app.RequestsSessionTimeout()
+        second = app.RequestsSessionTimeout()
+        first.headers.update({'X-Trace-ID': self.TRACE_ID})
+
+        self.assertIs(app.get_adapter(), adapter)
+        self.assertIs(first.get_adapter('http://localhost'), adapter)
+        self.assertIs(second.get_adapter('https://localhost'), adapter)
+        self.assertEqual(adapter._pool_maxsize, main.app.config['HTTP_POOL_SIZE'])
+        self.assertEqual(adapter.max_retries.total, main.app.config['HTTP_RETRIES'])
+        self.assertEqual(first.headers['Connection'], 'keep-alive')
+        # Each request's headers stay on its own session
+        self.assertNotIn('X-Trace-ID', second.headers)
+
+        # Closing a request's session leaves the shared connections open
+        adapter.poolmanager.connection_from_url('http://localhost')
+        first.close()
+        self.assertEqual(len(adapter.poolmanager.pools), 1)
+
+    def test_requests_session_no_keep_alive(self):
+        self.addCleanup(main.app.config.update, HTTP_KEEP_ALIVE=main.app.config['HTTP_KEEP_ALIVE'])
+        main.app.config.update(HTTP_KEEP_ALIVE=False)
+
+        self.assertEqual(app.RequestsSessionTimeout().headers['Connection'], 'close')
+
     def test_after_request(self):
         # Should set the X-API-Version to the expected value.
         response_mock = Mock()
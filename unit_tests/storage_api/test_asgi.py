@@ -0,0 +1,181 @@
+import asyncio
+import json
+import threading
+from unittest import TestCase
+
+from flask import Flask, Response, g, request, stream_with_context
+from storage_api import asgi, main
+
+
+def get_scope(method, path, query_string=b'', headers=None):
+    return {'type': 'http', 'method': method, 'path': path, 'query_string': query_string, 'root_path': '',
+            'headers': headers or [], 'http_version': '1.1', 'scheme': 'http', 'server': ('localhost', 8080),
+            'client': ('127.0.0.1', 1234)}
+
+
+def run_asgi(application, scope, messages, disconnect_after=None):
+    """Runs a request through application, returning the messages it sent"""
+    sent = []
+    asyncio.run(run_request(application, scope, messages, sent, disconnect_after))
+    return sent
+
+
+async def run_request(application, scope, messages, sent, disconnect_after=None, send_delay=0):
+    """Runs a request through application, adding the messages it sends to sent. send_delay is the seconds each
+    message takes to send, as for a slow client"""
+    received = list(messages)
+    disconnected = asyncio.Event()
+
+    async def receive():
+        if received:
+            return received.pop(0)
+        await disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        await asyncio.sleep(send_delay)
+        sent.append(message)
+        if disconnect_after is not None and len(sent) >= disconnect_after:
+            disconnected.set()
+            # Lets the disconnect be seen before the next chunk is sent
+            await asyncio.sleep(0.01)
+
+    await application(scope, receive, send)
+
+
+class TestAsgi(TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.application = asgi.AsgiApplication(self.app, 2)
+        self.addCleanup(self.application.executor.shutdown)
+        self.closed = []
+        self.generated = []
+
+        @self.app.before_request
+        def before_request():
+            g.value = request.args.get('value')
+
+        @self.app.route('/echo/<name>', methods=['POST'])
+        def echo(name):
+            return Response(name.encode() + b':' + request.get_data(), headers={'X-Value': g.value})
+
+        @self.app.route('/stream')
+        def stream():
+            chunks = int(request.args.get('chunks', 5))
+
+            def generate():
+                try:
+                    self.generated.append(('started', g.value))
+                    for i in range(chunks):
+                        # The request context is kept from one chunk to the next
+                        yield '{}{};'.format(g.value, i).encode()
+                    self.generated.append(('finished', g.value))
+                finally:
+                    self.closed.append(threading.current_thread().name)
+            return Response(stream_with_context(generate()))
+
+    def test_request(self):
+        sent = run_asgi(self.application,
+                        get_scope('POST', '/echo/café', b'value=1', [(b'content-length', b'6')]),
+                        [{'type': 'http.request', 'body': b'abc', 'more_body': True},
+                         {'type': 'http.request', 'body': b'def', 'more_body': False}])
+
+        self.assertEqual(sent[0]['type'], 'http.response.start')
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn((b'x-value', b'1'), sent[0]['headers'])
+        self.assertEqual(b''.join(message.get('body', b'') for message in sent[1:]), 'café:abcdef'.encode())
+        self.assertFalse(sent[-1]['more_body'])
+
+    def test_request_chunked(self):
+        sent = run_asgi(self.application,
+                        get_scope('POST', '/echo/a', headers=[(b'transfer-encoding', b'chunked')]),
+                        [{'type': 'http.request', 'body': b'abc', 'more_body': True},
+                         {'type': 'http.request', 'body': b'def', 'more_body': False}])
+
+        self.assertEqual(b''.join(message.get('body', b'') for message in sent[1:]), b'a:abcdef')
+
+    def test_streamed_response(self):
+        sent = run_asgi(self.application, get_scope('GET', '/stream', b'value=x'),
+                        [{'type': 'http.request', 'body': b'', 'more_body': False}])
+
+        self.assertEqual([message.get('body') for message in sent[1:]],
+                         [b'x0;', b'x1;', b'x2;', b'x3;', b'x4;', b''])
+        self.assertEqual(len(self.closed), 1)
+        self.assertTrue(self.closed[0].startswith('asgi'))
+
+    def test_streamed_response_disconnect(self):
+        sent = run_asgi(self.application, get_scope('GET', '/stream', b'value=x'),
+                        [{'type': 'http.request', 'body': b'', 'more_body': False}], disconnect_after=2)
+
+        # The rest of the response isn't generated once the client has gone
+        self.assertEqual([message.get('body') for message in sent[1:]], [b'x0;'])
+        self.assertEqual(len(self.closed), 1)
+
+    def test_slow_downloads(self):
+        async def run():
+            # Twice as many downloads as threads, each to a client slow to take every chunk
+            await asyncio.gather(*(
+                run_request(self.application, get_scope('GET', '/stream', 'value={}&chunks=20'.format(i).encode()),
+                            [{'type': 'http.request', 'body': b'', 'more_body': False}], sent, send_delay=0.005)
+                for i in range(4)))
+        sent = []
+        asyncio.run(run())
+
+        bodies = [message['body'] for message in sent if message.get('body')]
+        self.assertCountEqual(bodies, ['{}{};'.format(i, chunk).encode() for i in range(4) for chunk in range(20)])
+        # Every download was started before any had been read to its end, as none holds a thread while it waits
+        # on its client
+        self.assertEqual([event for event, value in self.generated[:4]], ['started'] * 4)
+        self.assertEqual(len(self.closed), 4)
+
+    def test_write(self):
+        def app(environ, start_response):
+            # Some of the response is given to the write callable, rather than returned
+            write = start_response('200 OK', [('Content-Type', 'text/plain')])
+            write(b'abc')
+            return [b'def']
+        application = asgi.AsgiApplication(app, 1)
+        self.addCleanup(application.executor.shutdown)
+
+        sent = run_asgi(application, get_scope('GET', '/'),
+                        [{'type': 'http.request', 'body': b'', 'more_body': False}])
+
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual([message.get('body') for message in sent[1:]], [b'abc', b'def', b''])
+
+    def test_not_found(self):
+        sent = run_asgi(self.application, get_scope('GET', '/missing'),
+                        [{'type': 'http.request', 'body': b'', 'more_body': False}])
+
+        self.assertEqual(sent[0]['status'], 404)
+
+    def test_lifespan(self):
+        sent = run_asgi(self.application, {'type': 'lifespan'},
+                        [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+
+        self.assertEqual(sent, [{'type': 'lifespan.startup.complete'}, {'type': 'lifespan.shutdown.complete'}])
+
+    def test_get_environ(self):
+        scope = get_scope('GET', '/api/v1.0/storage/bucket/a b', b'subdirectories=x',
+                          [(b'content-type', b'text/plain'), (b'x-trace-id', b'123'), (b'accept', b'a'),
+                           (b'accept', b'b')])
+        scope['root_path'] = '/api'
+
+        environ = asgi.get_environ(scope, asgi.RequestBody(None, None))
+
+        self.assertEqual(environ['SCRIPT_NAME'], '/api')
+        self.assertEqual(environ['PATH_INFO'], '/v1.0/storage/bucket/a b')
+        self.assertEqual(environ['QUERY_STRING'], 'subdirectories=x')
+        self.assertEqual(environ['CONTENT_TYPE'], 'text/plain')
+        self.assertEqual(environ['HTTP_X_TRACE_ID'], '123')
+        self.assertEqual(environ['HTTP_ACCEPT'], 'a,b')
+        self.assertEqual(environ['SERVER_PORT'], '8080')
+        self.assertEqual(environ['REMOTE_ADDR'], '127.0.0.1')
+
+    def test_application(self):
+        sent = run_asgi(asgi.application, get_scope('GET', '/health'),
+                        [{'type': 'http.request', 'body': b'', 'more_body': False}])
+
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(json.loads(b''.join(message.get('body', b'') for message in sent[1:]))['app'],
+                         main.app.config['APP_NAME'])
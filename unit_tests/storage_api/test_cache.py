@@ -0,0 +1,61 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from storage_api.cache import LRUCache, get_cache_stats, register_cache
+
+
+class TestCache(TestCase):
+    def test_get_put(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('b', 2), 2)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    @patch('storage_api.cache.time.monotonic')
+    def test_expires(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        cache = LRUCache(10, ttl=10)
+        cache.put('a', 1)
+        cache.put('b', 2, ttl=30)
+
+        mock_monotonic.return_value = 120
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.stats()['expirations'], 1)
+        self.assertEqual(cache.stats()['size'], 1)
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.put('a', 1)
+
+        self.assertIsNone(cache.get('a'))
+
+    def test_remove(self):
+        cache = LRUCache(10)
+        cache.put('a', 1)
+
+        self.assertTrue(cache.remove('a'))
+        self.assertFalse(cache.remove('a'))
+        self.assertIsNone(cache.get('a'))
+
+    def test_register_cache(self):
+        cache = register_cache('test_register', LRUCache(10))
+        cache.get('a')
+
+        self.assertEqual(get_cache_stats()['test_register']['misses'], 1)
@@ -0,0 +1,24 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from storage_api.commands import register_commands
+from storage_api.main import app
+
+
+class TestCommands(TestCase):
+    def test_register_commands(self):
+        test_app = MagicMock()
+        register_commands(test_app)
+
+        test_app.cli.add_command.assert_called()
+        test_app.logger.info.assert_called_with("Commands registered")
+
+    @patch('storage_api.commands.FileStorageAdapter')
+    def test_rebuild_file_index(self, mock_adapter):
+        mock_adapter.get_index.return_value.rebuild.return_value = 3
+
+        result = app.test_cli_runner().invoke(args=['rebuild-file-index', 'bucket'])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Indexed 3 files', result.output)
+        mock_adapter.get_index.return_value.rebuild.assert_called_with('bucket')
@@ -0,0 +1,88 @@
+import threading
+import time
+from concurrent.futures import Future
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import g, request
+from storage_api import main
+from storage_api.concurrency import ordered_prefetch, with_current_context
+
+
+class TestConcurrency(TestCase):
+    def test_ordered_prefetch_order(self):
+        def func(item):
+            # Later items finish first
+            time.sleep((5 - item) / 1000)
+            return item * 2
+
+        result = list(ordered_prefetch(func, range(5), 5))
+
+        self.assertEqual(result, [0, 2, 4, 6, 8])
+
+    def test_ordered_prefetch_max_workers(self):
+        lock = threading.Lock()
+        running = [0]
+        most_running = [0]
+
+        def func(item):
+            with lock:
+                running[0] += 1
+                most_running[0] = max(most_running[0], running[0])
+            time.sleep(0.005)
+            with lock:
+                running[0] -= 1
+            return item
+
+        result = list(ordered_prefetch(func, range(10), 3))
+
+        self.assertEqual(result, list(range(10)))
+        self.assertLessEqual(most_running[0], 3)
+
+    @patch('storage_api.concurrency.ThreadPoolExecutor')
+    def test_ordered_prefetch_memory_budget(self, mock_executor):
+        started = []
+
+        def submit(func, item):
+            future = Future()
+            future.set_result(func(item))
+            return future
+
+        mock_executor.return_value.__enter__.return_value.submit.side_effect = submit
+        results = ordered_prefetch(started.append, [5, 5, 5, 20, 5], 10, memory_budget=10, cost=lambda item: item)
+
+        next(results)
+        # The first two fit in the budget, the third has to wait for the first to be consumed
+        self.assertEqual(started, [5, 5])
+        next(results)
+        self.assertEqual(started, [5, 5, 5])
+        # The item bigger than the budget only starts once everything before it has been consumed
+        next(results)
+        self.assertEqual(started, [5, 5, 5])
+        next(results)
+        self.assertEqual(started, [5, 5, 5, 20])
+        self.assertEqual(len(list(results)), 1)
+
+    def test_ordered_prefetch_exception(self):
+        def func(item):
+            if item == 2:
+                raise ValueError('failed')
+            return item
+
+        results = ordered_prefetch(func, range(5), 2)
+
+        self.assertEqual(next(results), 0)
+        self.assertEqual(next(results), 1)
+        self.assertRaises(ValueError, next, results)
+
+    def test_with_current_context(self):
+        result = []
+        with main.app.test_request_context('/path'):
+            g.trace_id = 'trace'
+            run = with_current_context(lambda value: result.append((value, g.trace_id, request.path)))
+
+        thread = threading.Thread(target=run, args=('value',))
+        thread.start()
+        thread.join()
+
+        self.assertEqual(result, [('value', 'trace', '/path')])
@@ -1,11 +1,19 @@
 import collections
+import io
 import json
+import logging
+import sys
+import threading
+import traceback
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 
 from flask import g
+from storage_api import extensions
 from storage_api.extensions import (ContextualFilter, JsonAuditFormatter,
-                                    JsonFormatter, register_extensions)
+                                    JsonFormatter, LogWriter,
+                                    QueueingStreamHandler, encode_log_entry,
+                                    register_extensions)
 from storage_api.main import app
 
 
@@ -108,3 +116,96 @@ class TestExtensions(TestCase):
 
         # Check expected items are contained in log entry
         self.assertNotEqual(returned_log_entry.find(expected_log_entry_string), -1)
+
+    def test_json_formatter_matches_json_dumps(self):
+        try:
+            raise ValueError('bad "value"\n')
+        except ValueError:
+            record = logging.makeLogRecord({'levelname': 'ERROR', 'trace_id': 'abc', 'exc_info': sys.exc_info(),
+                                            'msg': 'caf\u00e9 %s \x01 \U0001f600', 'args': ('\t"quoted"',)})
+
+        returned_log_entry = self.json_formatter.format(record)
+
+        expected_log_entry = collections.OrderedDict(
+            [('timestamp', self.json_formatter.formatTime(record)),
+             ('level', 'ERROR'),
+             ('traceid', 'abc'),
+             ('message', 'caf\u00e9 \t"quoted" \x01 \U0001f600'),
+             ('exception', traceback.format_exception(*record.exc_info))])
+        self.assertEqual(returned_log_entry, json.dumps(expected_log_entry))
+        self.assertIn('ValueError: bad "value"\n', expected_log_entry['exception'][-1])
+
+    def test_encode_log_entry(self):
+        items = [('string', 'a\u2028"\\'), ('none', None), ('list', ['a', 'b\n']), ('empty', []),
+                 ('number', 1.5), ('mixed', ['a', 1]), ('dict', {'a': 1})]
+
+        self.assertEqual(encode_log_entry(items), json.dumps(collections.OrderedDict(items)))
+
+    def test_log_writer(self):
+        stream = io.StringIO()
+        writer = LogWriter(stream, 10)
+
+        for i in range(5):
+            self.assertTrue(writer.write('line {}'.format(i)))
+        writer.stop()
+
+        self.assertEqual(stream.getvalue(), ''.join('line {}\n'.format(i) for i in range(5)))
+
+    def test_log_writer_forked(self):
+        stream = io.StringIO()
+        writer = LogWriter(stream, 10)
+
+        # Nothing is started until a line is written
+        self.assertIsNone(writer._thread)
+        writer.write('line 0')
+        parent_thread = writer._thread
+        writer.stop()
+        with patch('storage_api.extensions.os.getpid', return_value=-1):
+            # A forked process has no copy of the parent's thread, so starts its own
+            writer.write('line 1')
+            self.assertIsNot(writer._thread, parent_thread)
+            writer.stop()
+
+        self.assertEqual(stream.getvalue(), 'line 0\nline 1\n')
+
+    def test_log_writer_full(self):
+        writing = threading.Event()
+        release = threading.Event()
+
+        class SlowStream(io.StringIO):
+            def write(self, line):
+                writing.set()
+                release.wait()
+                return super(SlowStream, self).write(line)
+
+        stream = SlowStream()
+        writer = LogWriter(stream, 2)
+        writer.write('line 0')
+        writing.wait()
+
+        # Line 0 is being written, lines 1 and 2 fill the queue and lines 3 and 4 are dropped
+        results = [writer.write('line {}'.format(i)) for i in range(1, 5)]
+        release.set()
+        writer.stop()
+
+        self.assertEqual(results, [True, True, False, False])
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(lines[:3], ['line 0', 'line 1', 'line 2'])
+        warning = json.loads(lines[3])
+        self.assertEqual(warning['level'], 'WARNING')
+        self.assertEqual(warning['message'], '2 log records were dropped as the log queue was full')
+        self.assertEqual(len(lines), 4)
+
+    def test_queueing_stream_handler(self):
+        stream = io.StringIO()
+        handler = QueueingStreamHandler(stream, 10, 'block')
+        self.addCleanup(extensions._log_writers.pop, id(stream))
+        handler.setFormatter(self.json_audit_formatter)
+        record = logging.makeLogRecord({'trace_id': '123', 'msg': 'test %s', 'args': ('message',)})
+
+        handler.handle(record)
+        handler.writer.stop()
+
+        self.assertEqual(stream.getvalue(), self.json_audit_formatter.format(record) + '\n')
+        # Handlers for the same stream share a writer, so their lines stay in order
+        self.assertIs(QueueingStreamHandler(stream).writer, handler.writer)
@@ -0,0 +1,248 @@
+import io
+import os
+import shutil
+import tempfile
+from datetime import datetime, timezone
+
+from flask_testing import TestCase
+from storage_api import main
+from storage_api.model.storage_item import StorageItem
+from storage_api.responses import send_not_modified, send_storage_item
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+
+
+class TestResponses(TestCase):
+    def create_app(self):
+        main.app.config["FILE_SERVE_MODE"] = "stream"
+        main.app.config["FILE_ACCEL_REDIRECT_LOCATION"] = "/protected-storage/"
+        return main.app
+
+    def setUp(self):
+        self.storage_location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.storage_location)
+        main.app.config["FILE_STORAGE_LOCATION"] = self.storage_location
+
+        self.path = os.path.join(self.storage_location, 'bucket', 'a b.pdf')
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'wb') as stored_file:
+            stored_file.write(b'0123456789')
+
+    def get_stored_item(self, **kwargs):
+        return StorageItem(io.open(self.path, 'rb'), 'application/pdf', 'a b.pdf', self.path, **kwargs)
+
+    def test_stream(self):
+        with main.app.test_request_context():
+            response = send_storage_item(self.get_stored_item())
+            response.direct_passthrough = False
+
+            self.assertEqual(response.get_data(), b'0123456789')
+            self.assertEqual(response.mimetype, 'application/pdf')
+            self.assertNotIn('Content-Disposition', response.headers)
+
+    def test_stream_without_path(self):
+        main.app.config["FILE_SERVE_MODE"] = "x-accel-redirect"
+        with main.app.test_request_context():
+            response = send_storage_item(StorageItem(io.BytesIO(b'test'), 'application/zip', 'archive.zip'),
+                                         as_attachment=True)
+            response.direct_passthrough = False
+
+            self.assertEqual(response.get_data(), b'test')
+            self.assertNotIn('X-Accel-Redirect', response.headers)
+            self.assertEqual(response.headers['Content-Disposition'], 'attachment; filename=archive.zip')
+
+    def test_stream_whole_content_range(self):
+        stored_item = StorageItem(io.BytesIO(b'test'), 'text/plain', 'a.txt', size=4)
+        stored_item.content_range = (0, 4)
+        stored_item.chunk_size = 3
+        with main.app.test_request_context():
+            response = send_storage_item(stored_item)
+
+            self.assertEqual(list(response.response), [b'tes', b't'])
+            self.assertEqual(response.content_length, 4)
+            self.assertEqual(response.mimetype, 'text/plain')
+            response.close()
+            self.assertTrue(stored_item.file.closed)
+
+    def test_stream_iterable(self):
+        closed = []
+
+        class Chunks(object):
+            def __iter__(self):
+                return iter([b'te', b'st'])
+
+            def close(self):
+                closed.append(True)
+
+        with main.app.test_request_context():
+            response = send_storage_item(StorageItem(Chunks(), 'application/zip', 'archive.zip'),
+                                         as_attachment=True)
+
+            self.assertEqual(response.get_data(), b'test')
+            self.assertEqual(response.headers['Content-Disposition'], 'attachment; filename=archive.zip')
+            self.assertNotIn('Content-Length', response.headers)
+            response.close()
+            self.assertEqual(closed, [True])
+
+    def test_sendfile(self):
+        main.app.config["FILE_SERVE_MODE"] = "sendfile"
+        stored_item = self.get_stored_item()
+        with main.app.test_request_context():
+            response = send_storage_item(stored_item)
+            response.direct_passthrough = False
+
+            self.assertTrue(stored_item.file.closed)
+            self.assertEqual(response.get_data(), b'0123456789')
+            self.assertEqual(response.content_length, 10)
+
+    def test_x_sendfile(self):
+        main.app.config["FILE_SERVE_MODE"] = "x-sendfile"
+        stored_item = self.get_stored_item()
+        with main.app.test_request_context():
+            response = send_storage_item(stored_item, as_attachment=True)
+
+            self.assertTrue(stored_item.file.closed)
+            self.assertEqual(response.headers['X-Sendfile'], self.path)
+            self.assertEqual(response.get_data(), b'')
+            self.assertIn('attachment', response.headers['Content-Disposition'])
+
+    def test_x_accel_redirect(self):
+        main.app.config["FILE_SERVE_MODE"] = "x-accel-redirect"
+        stored_item = self.get_stored_item()
+        with main.app.test_request_context():
+            response = send_storage_item(stored_item)
+
+            self.assertTrue(stored_item.file.closed)
+            self.assertEqual(response.headers['X-Accel-Redirect'], '/protected-storage/bucket/a%20b.pdf')
+            self.assertEqual(response.mimetype, 'application/pdf')
+            self.assertEqual(response.get_data(), b'')
+
+    def test_x_sendfile_validators(self):
+        main.app.config["FILE_SERVE_MODE"] = "x-accel-redirect"
+        modified = datetime(2020, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+        with main.app.test_request_context():
+            response = send_storage_item(self.get_stored_item(size=10, etag='hash', last_modified=modified))
+
+            # The fronting web server sends the file, but the validators still come from the app
+            self.assertEqual(response.headers['ETag'], '"hash"')
+            self.assertEqual(response.last_modified, modified)
+
+    def test_single_range(self):
+        with main.app.test_request_context(headers={'Range': 'bytes=2-4'}):
+            response = send_storage_item(self.get_stored_item(size=10))
+
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.headers['Content-Range'], 'bytes 2-4/10')
+            self.assertEqual(response.content_length, 3)
+            self.assertEqual(response.get_data(), b'234')
+
+    def test_suffix_range(self):
+        with main.app.test_request_context(headers={'Range': 'bytes=-3'}):
+            response = send_storage_item(self.get_stored_item(size=10))
+
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.headers['Content-Range'], 'bytes 7-9/10')
+            self.assertEqual(response.get_data(), b'789')
+
+    def test_range_beyond_end(self):
+        with main.app.test_request_context(headers={'Range': 'bytes=8-20'}):
+            response = send_storage_item(self.get_stored_item(size=10))
+
+            self.assertEqual(response.headers['Content-Range'], 'bytes 8-9/10')
+            self.assertEqual(response.get_data(), b'89')
+
+    def test_multiple_ranges(self):
+        with main.app.test_request_context(headers={'Range': 'bytes=0-1,5-6'}):
+            response = send_storage_item(self.get_stored_item(size=10))
+            data = response.get_data()
+
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.mimetype, 'multipart/byteranges')
+            self.assertEqual(response.content_length, len(data))
+            boundary = response.mimetype_params['boundary'].encode()
+            parts = data.split(b'--' + boundary)
+            self.assertEqual(len(parts), 4)
+            self.assertIn(b'Content-Range: bytes 0-1/10\r\n\r\n01\r\n', parts[1])
+            self.assertIn(b'Content-Range: bytes 5-6/10\r\n\r\n56\r\n', parts[2])
+            self.assertEqual(parts[3], b'--\r\n')
+
+    def test_unsatisfiable_range(self):
+        stored_item = self.get_stored_item(size=10)
+        with main.app.test_request_context(headers={'Range': 'bytes=10-20'}):
+            with self.assertRaises(RequestedRangeNotSatisfiable):
+                send_storage_item(stored_item)
+            self.assertTrue(stored_item.file.closed)
+
+    def test_range_unknown_size(self):
+        with main.app.test_request_context(headers={'Range': 'bytes=2-4'}):
+            response = send_storage_item(StorageItem(io.BytesIO(b'0123456789'), 'text/plain', 'a.txt'))
+            response.direct_passthrough = False
+
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.get_data(), b'234')
+
+    def test_if_range_matches(self):
+        last_modified = datetime(2020, 1, 1, 12, 0, 0, 500, timezone.utc)
+        with main.app.test_request_context(headers={'Range': 'bytes=2-4',
+                                                    'If-Range': 'Wed, 01 Jan 2020 12:00:00 GMT'}):
+            response = send_storage_item(self.get_stored_item(size=10, last_modified=last_modified))
+
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.get_data(), b'234')
+
+    def test_if_range_does_not_match(self):
+        last_modified = datetime(2021, 1, 1, tzinfo=timezone.utc)
+        with main.app.test_request_context(headers={'Range': 'bytes=2-4',
+                                                    'If-Range': 'Wed, 01 Jan 2020 12:00:00 GMT'}):
+            response = send_storage_item(self.get_stored_item(size=10, last_modified=last_modified))
+            response.direct_passthrough = False
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_data(), b'0123456789')
+            self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+            self.assertEqual(response.headers['Last-Modified'], 'Fri, 01 Jan 2021 00:00:00 GMT')
+
+    def test_partial_item_without_range(self):
+        stored_item = StorageItem(io.BytesIO(b'23'), 'text/plain', 'a.txt', size=10)
+        stored_item.content_range = (2, 4)
+        stored_item.range_reader = lambda start, stop: [b'0123456789'[start:stop]]
+        with main.app.test_request_context():
+            response = send_storage_item(stored_item)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content_length, 10)
+            self.assertEqual(response.get_data(), b'0123456789')
+
+    def test_partial_item_with_range(self):
+        stored_item = StorageItem(io.BytesIO(b'23'), 'text/plain', 'a.txt', size=10)
+        stored_item.content_range = (2, 4)
+        stored_item.range_reader = lambda start, stop: self.fail('Range should not be fetched again')
+        with main.app.test_request_context(headers={'Range': 'bytes=2-3'}):
+            response = send_storage_item(stored_item)
+
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.get_data(), b'23')
+
+    def test_etag(self):
+        with main.app.test_request_context():
+            response = send_storage_item(self.get_stored_item(size=10, etag='hash'))
+
+            self.assertEqual(response.headers['ETag'], '"hash"')
+
+    def test_if_range_etag_matches(self):
+        with main.app.test_request_context(headers={'Range': 'bytes=2-4', 'If-Range': '"hash"'}):
+            response = send_storage_item(self.get_stored_item(size=10, etag='hash'))
+
+            self.assertEqual(response.status_code, 206)
+
+    def test_if_range_weak_etag(self):
+        with main.app.test_request_context(headers={'Range': 'bytes=2-4', 'If-Range': 'W/"hash"'}):
+            response = send_storage_item(self.get_stored_item(size=10, etag='hash'))
+
+            self.assertEqual(response.status_code, 200)
+
+    def test_send_not_modified(self):
+        with main.app.test_request_context():
+            response = send_not_modified('hash')
+
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.headers['ETag'], '"hash"')
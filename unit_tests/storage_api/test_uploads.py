@@ -0,0 +1,65 @@
+import io
+from unittest import TestCase
+
+from storage_api.uploads import MultipartStream, spool
+from werkzeug.datastructures import FileStorage
+from werkzeug.test import encode_multipart
+
+
+class TestUploads(TestCase):
+    def encode(self, fields):
+        boundary, body = encode_multipart({name: FileStorage(*value) if isinstance(value, tuple) else value
+                                           for name, value in fields.items()})
+        return io.BytesIO(body), boundary.encode()
+
+    def test_multipart_stream_files(self):
+        body, boundary = self.encode({'field': 'value',
+                                      'file1': (io.BytesIO(b'one'), 'one.txt', None, 'text/plain'),
+                                      'file2': (io.BytesIO(b'two' * 100000), 'two.bin')})
+        files = []
+
+        for name, file in MultipartStream(body, boundary, chunk_size=1024):
+            files.append((name, file.filename, file.content_type, file.read()))
+
+        self.assertEqual(files, [('file1', 'one.txt', 'text/plain', b'one'),
+                                 ('file2', 'two.bin', 'application/octet-stream', b'two' * 100000)])
+
+    def test_multipart_stream_reads_as_files_are_read(self):
+        body, boundary = self.encode({'file1': (io.BytesIO(b'one' * 100000), 'one.txt'),
+                                      'file2': (io.BytesIO(b'two'), 'two.txt')})
+
+        name, file = next(iter(MultipartStream(body, boundary, chunk_size=1024)))
+        file.read(10)
+
+        self.assertLess(body.tell(), 10 * 1024)
+
+    def test_multipart_stream_skips_unread_files(self):
+        body, boundary = self.encode({'file1': (io.BytesIO(b'one' * 100000), 'one.txt'),
+                                      'file2': (io.BytesIO(b'two'), 'two.txt')})
+        files = []
+
+        for name, file in MultipartStream(body, boundary):
+            file.read(2)
+            files.append(name)
+
+        self.assertEqual(files, ['file1', 'file2'])
+
+    def test_multipart_stream_no_files(self):
+        body, boundary = self.encode({'field': 'value'})
+
+        self.assertEqual(list(MultipartStream(body, boundary)), [])
+
+    def test_multipart_stream_truncated(self):
+        body, boundary = self.encode({'file': (io.BytesIO(b'one' * 1000), 'one.txt')})
+        uploads = MultipartStream(io.BytesIO(body.getvalue()[:2000]), boundary)
+        name, file = next(iter(uploads))
+
+        self.assertRaises(ValueError, file.read)
+        self.assertIsInstance(uploads.error, ValueError)
+
+    def test_spool(self):
+        spooled = spool(io.BytesIO(b'test'), 2)
+
+        self.assertEqual(spooled.read(), b'test')
+        # Larger than the memory threshold, so written to disk
+        self.assertTrue(spooled._rolled)
@@ -1,6 +1,7 @@
 from flask import url_for
 from flask_testing import TestCase
 from storage_api import main
+from storage_api.cache import LRUCache, register_cache
 
 
 class TestGeneral(TestCase):
@@ -13,3 +14,12 @@ class TestGeneral(TestCase):
         response = self.client.get(url_for('general.check_status'))
 
         self.assert_status(response, 200)
+
+    def test_cache_stats(self):
+        """Should respond with the statistics of each registered cache."""
+        register_cache('test', LRUCache(10))
+
+        response = self.client.get(url_for('general.cache_stats'))
+
+        self.assert_status(response, 200)
+        self.assertEqual(response.json['caches']['test']['max_size'], 10)
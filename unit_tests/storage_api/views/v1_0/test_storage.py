@@ -1,10 +1,16 @@
+import email
 import io
+import json
+import threading
+import zipfile
 from unittest.mock import MagicMock, Mock, patch
 
-from flask import url_for
+from flask import g, url_for
 from flask_testing import TestCase
 from storage_api import main
+from storage_api.dependencies.virus_scanner import ScanError
 from storage_api.model.storage_item import StorageItem
+from storage_api.views.v1_0 import storage
 
 mock_file = io.BytesIO(b'testfile')
 
@@ -17,20 +23,98 @@ class TestStorage(TestCase):
     def test_get_storage_file_found(self, mock_factory):
         storage_item = StorageItem(mock_file, "abc", "mockfile.txt")
         mock_file_service = MagicMock()
-        mock_file_service.is_directory.return_value = False
-        mock_file_service.get_file.return_value = storage_item
+        mock_file_service.resolve.return_value = (storage_item, False)
 
         mock_factory.get_storage_type.return_value = mock_file_service
 
         get_response = self.client.get(url_for('storage.get_file', bucket=1, file_id=1))
         self.assertEqual(get_response.status_code, 200)
 
+    @patch('storage_api.app.validate')
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_reserved_bucket(self, mock_factory, validate):
+        # The file index and archive cache are hidden folders in FILE_STORAGE_LOCATION by default
+        get_response = self.client.get(url_for('storage.get_file', bucket='.index', file_id='bucket'))
+        delete_response = self.client.delete(url_for('storage.delete_file', bucket='.archives', file_id='1'),
+                                             headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(get_response.status_code, 404)
+        self.assertEqual(delete_response.status_code, 404)
+        mock_factory.get_storage_type.assert_not_called()
+
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_get_storage_file_range(self, mock_factory):
+        storage_item = StorageItem(io.BytesIO(b'testfile'), "text/plain", "mockfile.txt", size=8)
+        mock_file_service = MagicMock()
+        mock_file_service.resolve.return_value = (storage_item, False)
+
+        mock_factory.get_storage_type.return_value = mock_file_service
+
+        get_response = self.client.get(url_for('storage.get_file', bucket=1, file_id=1),
+                                       headers={'Range': 'bytes=0-3'})
+        self.assertEqual(get_response.status_code, 206)
+        self.assertEqual(get_response.data, b'test')
+        self.assertEqual(mock_file_service.resolve.call_args[1]['byte_range'].to_header(), 'bytes=0-3')
+
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_get_storage_file_range_not_satisfiable(self, mock_factory):
+        storage_item = StorageItem(io.BytesIO(b'testfile'), "text/plain", "mockfile.txt", size=8)
+        mock_file_service = MagicMock()
+        mock_file_service.resolve.return_value = (storage_item, False)
+
+        mock_factory.get_storage_type.return_value = mock_file_service
+
+        get_response = self.client.get(url_for('storage.get_file', bucket=1, file_id=1),
+                                       headers={'Range': 'bytes=10-'})
+        self.assertEqual(get_response.status_code, 416)
+        self.assertEqual(get_response.headers['Content-Range'], 'bytes */8')
+
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_get_storage_file_etag(self, mock_factory):
+        storage_item = StorageItem(io.BytesIO(b'testfile'), "text/plain", "mockfile.txt", etag="hash")
+        mock_file_service = MagicMock()
+        mock_file_service.resolve.return_value = (storage_item, False)
+
+        mock_factory.get_storage_type.return_value = mock_file_service
+
+        get_response = self.client.get(url_for('storage.get_file', bucket=1, file_id=1))
+        self.assertEqual(get_response.status_code, 200)
+        self.assertEqual(get_response.headers['ETag'], '"hash"')
+        mock_file_service.get_etag.assert_not_called()
+
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_get_storage_file_not_modified(self, mock_factory):
+        mock_file_service = MagicMock()
+        mock_file_service.get_etag.return_value = "hash"
+
+        mock_factory.get_storage_type.return_value = mock_file_service
+
+        get_response = self.client.get(url_for('storage.get_file', bucket=1, file_id=1, subdirectories='sub'),
+                                       headers={'If-None-Match': '"other", "hash"'})
+        self.assertEqual(get_response.status_code, 304)
+        self.assertEqual(get_response.headers['ETag'], '"hash"')
+        mock_file_service.get_etag.assert_called_with('1', '1', 'sub')
+        mock_file_service.resolve.assert_not_called()
+
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_get_storage_file_modified(self, mock_factory):
+        storage_item = StorageItem(io.BytesIO(b'testfile'), "text/plain", "mockfile.txt", etag="hash")
+        mock_file_service = MagicMock()
+        mock_file_service.get_etag.return_value = "hash"
+        mock_file_service.resolve.return_value = (storage_item, False)
+
+        mock_factory.get_storage_type.return_value = mock_file_service
+
+        get_response = self.client.get(url_for('storage.get_file', bucket=1, file_id=1),
+                                       headers={'If-None-Match': '"other"'})
+        self.assertEqual(get_response.status_code, 200)
+        self.assertEqual(get_response.data, b'testfile')
+
     @patch('storage_api.views.v1_0.storage.storage_type_factory')
     def test_get_storage_is_directory(self, mock_factory):
         storage_item = StorageItem(mock_file, "abc", "mockfile.txt")
         mock_file_service = MagicMock()
-        mock_file_service.is_directory.return_value = True
-        mock_file_service.zip_directory.return_value = storage_item
+        mock_file_service.resolve.return_value = (storage_item, True)
 
         mock_factory.get_storage_type.return_value = mock_file_service
 
@@ -40,8 +124,7 @@ class TestStorage(TestCase):
     @patch('storage_api.views.v1_0.storage.storage_type_factory')
     def test_get_storage_file_not_found(self, mock_factory):
         mock_file_service = MagicMock()
-        mock_file_service.is_directory.return_value = False
-        mock_file_service.get_file.return_value = None
+        mock_file_service.resolve.return_value = (None, False)
 
         mock_factory.get_storage_type.return_value = mock_file_service
 
@@ -51,8 +134,7 @@ class TestStorage(TestCase):
     @patch('storage_api.views.v1_0.storage.storage_type_factory')
     def test_get_storage_directory_failed_to_zip(self, mock_factory):
         mock_file_service = MagicMock()
-        mock_file_service.is_directory.return_value = True
-        mock_file_service.zip_directory.return_value = None
+        mock_file_service.resolve.return_value = (None, True)
 
         mock_factory.get_storage_type.return_value = mock_file_service
 
@@ -62,8 +144,7 @@ class TestStorage(TestCase):
     @patch('storage_api.views.v1_0.storage.storage_type_factory')
     def test_get_storage_exception_thrown(self, mock_factory):
         mock_file_service = MagicMock()
-        mock_file_service.is_directory.return_value = False
-        mock_file_service.get_file.side_effect = Exception("test")
+        mock_file_service.resolve.side_effect = Exception("test")
 
         mock_factory.get_storage_type.return_value = mock_file_service
 
@@ -112,6 +193,153 @@ class TestStorage(TestCase):
                                           headers={'Authorization': 'Fake JWT'})
         self.assertEqual(get_response.status_code, 500)
 
+    @patch('storage_api.app.validate')
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_delete_storage_files(self, mock_factory, validate):
+        mock_file_service = MagicMock()
+        mock_file_service.delete_files.return_value = [True, False, None]
+        mock_factory.get_storage_type.return_value = mock_file_service
+
+        response = self.client.post(url_for('storage.delete_files', bucket='bucket'),
+                                    json={'files': [{'file_id': '1'}, {'file_id': '2', 'subdirectories': 'a,b'},
+                                                    {'file_id': '3'}]},
+                                    headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {'files': [{'file_id': '1', 'status': 'deleted'},
+                                                   {'file_id': '2', 'subdirectories': 'a,b', 'status': 'not_found'},
+                                                   {'file_id': '3', 'status': 'failed'}]})
+        mock_file_service.delete_files.assert_called_once_with('bucket', [('1', None), ('2', 'a,b'), ('3', None)])
+
+    @patch('storage_api.app.validate')
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_delete_storage_files_repeated(self, mock_factory, validate):
+        mock_file_service = MagicMock()
+        mock_file_service.delete_files.return_value = [True, False]
+        mock_factory.get_storage_type.return_value = mock_file_service
+
+        response = self.client.post(url_for('storage.delete_files', bucket='bucket'),
+                                    json={'files': [{'file_id': '1'}, {'file_id': '2'}, {'file_id': '1'}]},
+                                    headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([file['status'] for file in response.json['files']], ['deleted', 'not_found', 'deleted'])
+        mock_file_service.delete_files.assert_called_once_with('bucket', [('1', None), ('2', None)])
+
+    @patch('storage_api.app.validate')
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_delete_storage_files_invalid(self, mock_factory, validate):
+        for body in [None, {}, {'files': []}, {'files': [{'subdirectories': 'a'}]}, {'files': ['1']},
+                     {'files': [{'file_id': '1', 'subdirectories': ['a']}]}]:
+            response = self.client.post(url_for('storage.delete_files', bucket='bucket'), json=body,
+                                        headers={'Authorization': 'Fake JWT'})
+            self.assertEqual(response.status_code, 400)
+        mock_factory.get_storage_type.assert_not_called()
+
+    @patch('storage_api.app.validate')
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_delete_storage_files_too_many(self, mock_factory, validate):
+        self.addCleanup(main.app.config.update, BATCH_MAX_FILES=main.app.config['BATCH_MAX_FILES'])
+        main.app.config['BATCH_MAX_FILES'] = 2
+
+        response = self.client.post(url_for('storage.delete_files', bucket='bucket'),
+                                    json={'files': [{'file_id': str(index)} for index in range(3)]},
+                                    headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['error_message'], 'Too many files in batch request')
+
+    @patch('storage_api.app.validate')
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_get_storage_files_zip(self, mock_factory, validate):
+        mock_file_service = MagicMock()
+        mock_file_service.get_file.side_effect = self.get_batch_file
+        mock_factory.get_storage_type.return_value = mock_file_service
+
+        response = self.client.post(url_for('storage.get_files', bucket='bucket'),
+                                    json={'files': [{'file_id': '1', 'subdirectories': 'a,b'}, {'file_id': 'missing'},
+                                                    {'file_id': 'broken'}, {'file_id': '2'}]},
+                                    headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/zip')
+        self.assertIn('archive.zip', response.headers['Content-Disposition'])
+        archive = zipfile.ZipFile(io.BytesIO(response.data))
+        self.assertEqual(archive.namelist(), ['a/b/1/one.txt', '2/two.txt', 'manifest.json'])
+        self.assertEqual(archive.read('a/b/1/one.txt'), b'file 1')
+        self.assertEqual(json.loads(archive.read('manifest.json')), {'files': [
+            {'file_id': '1', 'subdirectories': 'a,b', 'status': 'found', 'name': 'a/b/1/one.txt'},
+            {'file_id': 'missing', 'status': 'not_found'},
+            {'file_id': 'broken', 'status': 'failed'},
+            {'file_id': '2', 'status': 'found', 'name': '2/two.txt'}]})
+
+    @patch('storage_api.app.validate')
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_get_storage_files_multipart(self, mock_factory, validate):
+        mock_file_service = MagicMock()
+        mock_file_service.get_file.side_effect = self.get_batch_file
+        mock_factory.get_storage_type.return_value = mock_file_service
+
+        response = self.client.post(url_for('storage.get_files', bucket='bucket'),
+                                    json={'files': [{'file_id': '1', 'subdirectories': 'a,b'}, {'file_id': 'missing'}],
+                                          'format': 'multipart'},
+                                    headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 200)
+        message = email.message_from_bytes(
+            'Content-Type: {}\r\n\r\n'.format(response.headers['Content-Type']).encode() + response.data)
+        parts = message.get_payload()
+        self.assertEqual([(part['X-File-Id'], part['X-Subdirectories'], part['X-Status']) for part in parts],
+                         [('1', 'a,b', 'found'), ('missing', None, 'not_found')])
+        self.assertEqual(parts[0].get_content_type(), 'text/plain')
+        self.assertEqual(parts[0].get_filename(), 'one.txt')
+        self.assertEqual(parts[0].get_payload(), 'file 1')
+        self.assertEqual(parts[1].get_payload(), '')
+
+    @patch('storage_api.app.validate')
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_get_storage_files_invalid_format(self, mock_factory, validate):
+        response = self.client.post(url_for('storage.get_files', bucket='bucket'),
+                                    json={'files': [{'file_id': '1'}], 'format': 'tar'},
+                                    headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 400)
+
+    @patch('storage_api.app.validate')
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_get_storage_file_external_urls(self, mock_factory, validate):
+        mock_file_service = MagicMock()
+        mock_file_service.get_file_external_urls.return_value = [{'external_reference': 'url', 'etag': 'hash'}, None]
+        mock_factory.get_storage_type.return_value = mock_file_service
+
+        response = self.client.post(url_for('storage.get_file_external_urls', bucket='bucket'),
+                                    json={'files': [{'file_id': '1', 'subdirectories': 'a,b'}, {'file_id': '2'}]},
+                                    headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {'bucket/1?subdirectories=a,b': {'external_reference': 'url', 'etag': 'hash'},
+                                         'bucket/2': None})
+        mock_file_service.get_file_external_urls.assert_called_once_with('bucket', [('1', 'a,b'), ('2', None)])
+
+    @staticmethod
+    def get_batch_file(bucket, file_id, subdirectories=None):
+        if file_id == 'broken':
+            raise Exception('failed to get')
+        if file_id == 'missing':
+            return None
+        name = {'1': 'one.txt', '2': 'two.txt'}[file_id]
+        return StorageItem(io.BytesIO('file {}'.format(file_id).encode()), 'text/plain', name)
+
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_rollback(self, mock_factory):
+        mock_file_service = MagicMock()
+        mock_factory.get_storage_type.return_value = mock_file_service
+
+        storage.rollback({'file1': [{'bucket': 'bucket', 'file_id': '1', 'subdirectory': 'a'}],
+                          'file2': [{'bucket': 'bucket', 'file_id': '2'}]})
+
+        mock_file_service.delete_files.assert_called_once_with('bucket', [('1', 'a'), ('2', None)])
+
     @patch('storage_api.app.validate')
     @patch('storage_api.views.v1_0.storage.storage_type_factory')
     def test_save_storage_file_successful(self, mock_factory, validate):
@@ -128,14 +356,14 @@ class TestStorage(TestCase):
 
     @patch('storage_api.app.validate')
     @patch('storage_api.views.v1_0.storage.storage_type_factory')
-    @patch('storage_api.views.v1_0.storage.pyclamd')
-    def test_scan_and_save_successful(self, mock_pyclamd, mock_factory, validate):
+    @patch('storage_api.views.v1_0.storage.virus_scanner')
+    def test_scan_and_save_successful(self, mock_scanner, mock_factory, validate):
         mock_file_service = MagicMock()
         mock_file_service.save_file.return_value = {"bucket": "1", "key": "123"}
 
         mock_factory.get_storage_type.return_value = mock_file_service
 
-        mock_pyclamd.ClamdUnixSocket.return_value.scan_stream.return_value = False
+        mock_scanner.get_virus_scanner.return_value.scan.return_value = None
 
         get_response = self.client.post(
             url_for('storage.save_file', bucket=1, scan=True),
@@ -145,11 +373,11 @@ class TestStorage(TestCase):
 
     @patch('storage_api.app.validate')
     @patch('storage_api.views.v1_0.storage.rollback')
-    @patch('storage_api.views.v1_0.storage.pyclamd')
-    def test_scan_and_save_threat_found(self, mock_pyclamd, mock_rollback, validate):
+    @patch('storage_api.views.v1_0.storage.virus_scanner')
+    def test_scan_and_save_threat_found(self, mock_scanner, mock_rollback, validate):
         eicar_test = b'X5O!P%@AP[4\\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*'
 
-        mock_pyclamd.ClamdUnixSocket.return_value.scan_stream.return_value = True
+        mock_scanner.get_virus_scanner.return_value.scan.return_value = 'Eicar-Signature'
 
         response = self.client.post(url_for('storage.save_file', bucket=1, scan=True),
                                     data={'file': (io.BytesIO(eicar_test), 'file.txt')},
@@ -158,6 +386,20 @@ class TestStorage(TestCase):
         self.assertEqual(response.json['error_message'], "Virus scan failed on uploaded document")
         mock_rollback.assert_called()
 
+    @patch('storage_api.app.validate')
+    @patch('storage_api.views.v1_0.storage.rollback')
+    @patch('storage_api.views.v1_0.storage.virus_scanner')
+    def test_scan_and_save_scan_failed(self, mock_scanner, mock_rollback, validate):
+        mock_scanner.get_virus_scanner.return_value.scan.side_effect = ScanError('clamd is down')
+
+        response = self.client.post(url_for('storage.save_file', bucket=1, scan=True),
+                                    data={'file': (io.BytesIO(b'my file contents'), 'file.txt')},
+                                    headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json['error_code'], 'S-02')
+        mock_rollback.assert_called()
+
     @patch('storage_api.app.validate')
     @patch('storage_api.views.v1_0.storage.storage_type_factory')
     def test_save_storage_file_successful_with_expires_header(self, mock_factory, validate):
@@ -237,6 +479,185 @@ class TestStorage(TestCase):
         self.assertEqual(response['error_code'], 'S-01')
         self.assertEqual(response['error_message'], 'Failed to save the requested file. Rolling back any changes')
 
+    @patch('storage_api.app.validate')
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_save_storage_files_concurrently(self, mock_factory, validate):
+        self.addCleanup(main.app.config.update, UPLOAD_CONCURRENCY=main.app.config['UPLOAD_CONCURRENCY'])
+        main.app.config['UPLOAD_CONCURRENCY'] = 3
+        # Only passed once all three files are being saved at the same time
+        barrier = threading.Barrier(3, timeout=5)
+        trace_ids = []
+
+        def save_file(bucket, item, subdirectories):
+            barrier.wait()
+            trace_ids.append(g.trace_id)
+            return {"bucket": bucket, "file_id": item.file_name}
+
+        mock_factory.get_storage_type.return_value.save_file.side_effect = save_file
+
+        response = self.client.post(
+            url_for('storage.save_file', bucket=1),
+            data={'file{}'.format(i): (io.BytesIO(b'my file contents'), 'file{}.txt'.format(i)) for i in range(3)},
+            headers={'Authorization': 'Fake JWT', 'X-Trace-ID': 'trace'})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(list(response.json.items()), [
+            ('file0', [{'bucket': '1', 'file_id': 'file0.txt'}]),
+            ('file1', [{'bucket': '1', 'file_id': 'file1.txt'}]),
+            ('file2', [{'bucket': '1', 'file_id': 'file2.txt'}])])
+        self.assertEqual(trace_ids, ['trace'] * 3)
+
+    @patch('storage_api.app.validate')
+    @patch('storage_api.views.v1_0.storage.rollback')
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    @patch('storage_api.views.v1_0.storage.virus_scanner')
+    def test_scan_and_save_threat_found_rolls_back_others(self, mock_scanner, mock_factory, mock_rollback,
+                                                          validate):
+        mock_scanner.get_virus_scanner.return_value.scan.side_effect = \
+            lambda file: 'Eicar-Signature' if b'EICAR' in file.read() else None
+        mock_factory.get_storage_type.return_value.save_file.side_effect = \
+            lambda bucket, item, subdirectories: {"bucket": bucket, "file_id": item.file_name}
+
+        response = self.client.post(
+            url_for('storage.save_file', bucket=1, scan=True),
+            data={'file1': (io.BytesIO(b'my file contents'), 'file1.txt'),
+                  'file2': (io.BytesIO(b'EICAR'), 'file2.txt'),
+                  'file3': (io.BytesIO(b'my file contents'), 'file3.txt')},
+            headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['error_message'], "Virus scan failed on uploaded document")
+        saved = mock_rollback.call_args[0][0]
+        self.assertNotIn('file2', saved)
+        self.assertEqual(saved['file1'], [{'bucket': '1', 'file_id': 'file1.txt'}])
+
+    @patch('storage_api.app.validate')
+    @patch('storage_api.views.v1_0.storage.rollback')
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    @patch('storage_api.views.v1_0.storage.virus_scanner')
+    def test_scan_and_save_unexpected_error_rolls_back_others(self, mock_scanner, mock_factory, mock_rollback,
+                                                              validate):
+        def scan(file):
+            if b'broken' in file.read():
+                raise OSError('Connection reset')
+            return None
+
+        mock_scanner.get_virus_scanner.return_value.scan.side_effect = scan
+        mock_factory.get_storage_type.return_value.save_file.side_effect = \
+            lambda bucket, item, subdirectories: {"bucket": bucket, "file_id": item.file_name}
+
+        response = self.client.post(
+            url_for('storage.save_file', bucket=1, scan=True),
+            data={'file1': (io.BytesIO(b'my file contents'), 'file1.txt'),
+                  'file2': (io.BytesIO(b'broken'), 'file2.txt'),
+                  'file3': (io.BytesIO(b'my file contents'), 'file3.txt')},
+            headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json['error_code'], 'S-01')
+        self.assertEqual(response.json['error_message'], 'Failed to save the requested file. Rolling back any changes')
+        saved = mock_rollback.call_args[0][0]
+        self.assertNotIn('file2', saved)
+        self.assertEqual(saved['file1'], [{'bucket': '1', 'file_id': 'file1.txt'}])
+
+    def stream_uploads(self):
+        self.addCleanup(main.app.config.update, UPLOAD_INGESTION_MODE=main.app.config['UPLOAD_INGESTION_MODE'],
+                        MAX_CONTENT_LENGTH=main.app.config['MAX_CONTENT_LENGTH'])
+        main.app.config['UPLOAD_INGESTION_MODE'] = 'stream'
+
+    @patch('storage_api.app.validate')
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_save_storage_file_stream(self, mock_factory, validate):
+        self.stream_uploads()
+        saved = []
+
+        def save_file(bucket, item, subdirectories):
+            saved.append((item.file_name, item.meta_type, item.file.read(), item.file.seekable()))
+            return {"bucket": bucket, "file_id": item.file_name}
+
+        mock_factory.get_storage_type.return_value.save_file.side_effect = save_file
+
+        response = self.client.post(
+            url_for('storage.save_file', bucket=1),
+            data={
+                'file1': (io.BytesIO(b'my file contents'), 'file1.txt', 'text/plain'),
+                'file2': (io.BytesIO(b'more contents'), 'file2.txt', 'text/plain')
+            },
+            headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json, {'file1': [{'bucket': '1', 'file_id': 'file1.txt'}],
+                                         'file2': [{'bucket': '1', 'file_id': 'file2.txt'}]})
+        self.assertEqual(saved, [('file1.txt', 'text/plain', b'my file contents', False),
+                                 ('file2.txt', 'text/plain', b'more contents', False)])
+
+    @patch('storage_api.app.validate')
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    @patch('storage_api.views.v1_0.storage.virus_scanner')
+    def test_scan_and_save_stream(self, mock_scanner, mock_factory, validate):
+        self.stream_uploads()
+        mock_scanner.get_virus_scanner.return_value.scan.return_value = None
+        saved = []
+
+        def save_file(bucket, item, subdirectories):
+            saved.append(item.file.read())
+            return {"bucket": bucket, "file_id": "123"}
+
+        mock_factory.get_storage_type.return_value.save_file.side_effect = save_file
+
+        response = self.client.post(
+            url_for('storage.save_file', bucket=1, scan=True),
+            data={'file': (io.BytesIO(b'my file contents'), 'file.txt')},
+            headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 201)
+        mock_scanner.get_virus_scanner.return_value.scan.assert_called_once()
+        self.assertEqual(saved, [b'my file contents'])
+
+    @patch('storage_api.app.validate')
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_save_storage_file_stream_no_file(self, mock_factory, validate):
+        self.stream_uploads()
+
+        response = self.client.post(url_for('storage.save_file', bucket=1), data={'field': 'value'},
+                                    headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['error_message'], 'No File in request')
+        mock_factory.get_storage_type.return_value.save_file.assert_not_called()
+
+    @patch('storage_api.app.validate')
+    @patch('storage_api.views.v1_0.storage.rollback')
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_save_storage_file_stream_truncated(self, mock_factory, mock_rollback, validate):
+        self.stream_uploads()
+        mock_factory.get_storage_type.return_value.save_file.side_effect = \
+            lambda bucket, item, subdirectories: {"bucket": bucket, "file_id": item.file.read()}
+        body = (b'--boundary\r\nContent-Disposition: form-data; name="file"; filename="file.txt"\r\n\r\n'
+                b'contents\r\n--boundary\r\nContent-Disposition: form-data; name="file2"; filename="file2.txt"'
+                b'\r\n\r\ncont')
+
+        response = self.client.post(url_for('storage.save_file', bucket=1), data=body,
+                                    content_type='multipart/form-data; boundary=boundary',
+                                    headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['error_message'], 'Failed to read the uploaded files')
+        mock_rollback.assert_called_once_with({'file': [{'bucket': '1', 'file_id': b'contents'}]})
+
+    @patch('storage_api.app.validate')
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_save_storage_file_stream_too_large(self, mock_factory, validate):
+        self.stream_uploads()
+        main.app.config['MAX_CONTENT_LENGTH'] = 100
+
+        response = self.client.post(url_for('storage.save_file', bucket=1),
+                                    data={'file': (io.BytesIO(b'a' * 1000), 'file.txt')},
+                                    headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 413)
+        mock_factory.get_storage_type.return_value.save_file.assert_not_called()
+
     @patch('storage_api.views.v1_0.storage.storage_type_factory')
     def test_get_file_external_url(self, mock_factory):
         mock_file_service = Mock()
@@ -250,6 +671,18 @@ class TestStorage(TestCase):
         self.assertIn('external_reference', json)
         self.assertEqual('abc', json['external_reference'])
 
+    @patch('storage_api.views.v1_0.storage.storage_type_factory')
+    def test_get_file_external_url_etag(self, mock_factory):
+        mock_file_service = Mock()
+        mock_file_service.get_file_external_url.return_value = {"external_reference": "abc", "etag": "hash"}
+        mock_factory.get_storage_type.return_value = mock_file_service
+
+        result = self.client.get(url_for('storage.get_file_external_url', bucket=1, file_id=1))
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual({'external_reference': 'abc'}, result.json)
+        self.assertEqual(result.headers['ETag'], '"hash"')
+
     @patch('storage_api.views.v1_0.storage.storage_type_factory')
     def test_get_file_external_url_no_file(self, mock_factory):
         mock_file_service = Mock()
@@ -0,0 +1,428 @@
+import hashlib
+import io
+import os
+import zipfile
+from unittest.mock import patch
+
+import boto3
+from flask import url_for
+from flask_testing import TestCase
+from moto import mock_s3
+from storage_api import main
+from storage_api.exceptions import ApplicationError
+from storage_api.dependencies.storage.s3_storage_adapter import \
+    S3StorageAdapter
+
+S3_BUCKET = 'test-bucket'
+# The smallest part size S3 allows
+PART_SIZE = 5 * 1024 * 1024
+
+
+@mock_s3
+class TestStorageS3Requests(TestCase):
+    """Counts the S3 requests each endpoint makes against a local S3 stand-in"""
+
+    def create_app(self):
+        return main.app
+
+    def setUp(self):
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+        self.addCleanup(main.app.config.update, STORAGE_TYPE=main.app.config['STORAGE_TYPE'],
+                        S3_BUCKET=main.app.config['S3_BUCKET'],
+                        S3_DELETE_CHECK_EXISTS=main.app.config['S3_DELETE_CHECK_EXISTS'],
+                        ARCHIVE_CACHE_ENABLED=main.app.config['ARCHIVE_CACHE_ENABLED'],
+                        S3_MULTIPART_THRESHOLD=main.app.config['S3_MULTIPART_THRESHOLD'],
+                        S3_MULTIPART_CHUNKSIZE=main.app.config['S3_MULTIPART_CHUNKSIZE'],
+                        UPLOAD_INGESTION_MODE=main.app.config['UPLOAD_INGESTION_MODE'],
+                        STORAGE_DEDUPLICATION=main.app.config['STORAGE_DEDUPLICATION'])
+        main.app.config.update(STORAGE_TYPE='s3', S3_BUCKET=S3_BUCKET, S3_DELETE_CHECK_EXISTS=True,
+                               ARCHIVE_CACHE_ENABLED=False)
+
+        connection = boto3.client('s3', region_name='us-east-1')
+        connection.create_bucket(Bucket=S3_BUCKET)
+        self.sha256 = hashlib.sha256(b'test').hexdigest()
+        for key, content_type in [('bucket/file', 'text/plain'),
+                                  ('bucket/dir/one', 'text/plain'), ('bucket/dir/two', 'text/plain')]:
+            connection.put_object(Bucket=S3_BUCKET, Key=key, Body=b'test', ContentType=content_type,
+                                  Metadata={'file-name': key.rsplit('/', 1)[1], 'content-type': content_type,
+                                            'sha256': self.sha256})
+
+        adapter = S3StorageAdapter()
+        self.addCleanup(setattr, adapter, '_connection', adapter._connection)
+        adapter._connection = connection
+        self.connection = connection
+        S3StorageAdapter._presigned_urls = None
+        S3StorageAdapter._metadata = None
+
+        self.operations = []
+        connection.meta.events.register('before-call.s3.*', self.record_operation)
+
+    def record_operation(self, model, **kwargs):
+        self.operations.append(model.name)
+
+    def test_get_file(self):
+        response = self.client.get(url_for('storage.get_file', bucket='bucket', file_id='file'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'test')
+        self.assertEqual(self.operations, ['GetObject'])
+
+    def test_get_directory(self):
+        response = self.client.get(url_for('storage.get_file', bucket='bucket', file_id='dir'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/zip')
+        # The archive is generated as the response is read
+        archive = zipfile.ZipFile(io.BytesIO(response.data))
+        self.assertEqual(archive.namelist(), ['one.txt', 'two.txt'])
+        self.assertEqual(self.operations, ['GetObject', 'ListObjectsV2', 'GetObject', 'GetObject'])
+
+    def test_get_file_repeated(self):
+        self.client.get(url_for('storage.get_file', bucket='bucket', file_id='file'))
+        response = self.client.get(url_for('storage.get_file', bucket='bucket', file_id='file'),
+                                   headers={'If-None-Match': '"{}"'.format(self.sha256)})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.operations, ['GetObject'])
+
+    def test_get_missing(self):
+        response = self.client.get(url_for('storage.get_file', bucket='bucket', file_id='missing'))
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.operations, ['GetObject', 'ListObjectsV2'])
+
+    def test_get_file_saved_since_missing(self):
+        self.client.get(url_for('storage.get_file', bucket='bucket', file_id='new'))
+        # Saved by another instance while this one has the key cached as missing
+        self.connection.put_object(Bucket=S3_BUCKET, Key='bucket/new', Body=b'new', ContentType='text/plain',
+                                   Metadata={'file-name': 'new', 'content-type': 'text/plain'})
+        self.operations.clear()
+
+        response = self.client.get(url_for('storage.get_file', bucket='bucket', file_id='new'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertEqual(response.data, b'new')
+        self.assertEqual(self.operations, ['ListObjectsV2', 'GetObject'])
+
+    def test_get_file_external_url_repeated(self):
+        self.client.get(url_for('storage.get_file_external_url', bucket='bucket', file_id='file'))
+        response = self.client.get(url_for('storage.get_file_external_url', bucket='bucket', file_id='file'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.operations, ['HeadObject'])
+
+    def test_get_file_external_url(self):
+        response = self.client.get(url_for('storage.get_file_external_url', bucket='bucket', file_id='file'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.operations, ['HeadObject'])
+
+    @patch('storage_api.app.validate')
+    def test_delete_file(self, validate):
+        response = self.client.delete(url_for('storage.delete_file', bucket='bucket', file_id='file'),
+                                      headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.operations, ['HeadObject', 'DeleteObject'])
+
+    @patch('storage_api.app.validate')
+    def test_delete_file_without_check(self, validate):
+        main.app.config['S3_DELETE_CHECK_EXISTS'] = False
+
+        response = self.client.delete(url_for('storage.delete_file', bucket='bucket', file_id='file'),
+                                      headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.operations, ['DeleteObject'])
+
+    @patch('storage_api.app.validate')
+    def test_get_files(self, validate):
+        response = self.client.post(url_for('storage.get_files', bucket='bucket'),
+                                    json={'files': [{'file_id': 'one', 'subdirectories': 'dir'},
+                                                    {'file_id': 'missing'}, {'file_id': 'file'}]},
+                                    headers={'Authorization': 'Fake JWT'})
+
+        archive = zipfile.ZipFile(io.BytesIO(response.data))
+        self.assertEqual(archive.namelist(), ['dir/one/one', 'file/file', 'manifest.json'])
+        self.assertEqual(archive.read('file/file'), b'test')
+        # One request for each file, without checking for directories
+        self.assertEqual(self.operations, ['GetObject', 'GetObject', 'GetObject'])
+
+    @patch('storage_api.app.validate')
+    def test_get_file_external_urls(self, validate):
+        response = self.client.post(url_for('storage.get_file_external_urls', bucket='bucket'),
+                                    json={'files': [{'file_id': 'file'}, {'file_id': 'one', 'subdirectories': 'dir'},
+                                                    {'file_id': 'two', 'subdirectories': 'dir'},
+                                                    {'file_id': 'missing', 'subdirectories': 'dir'},
+                                                    {'file_id': 'dir'}]},
+                                    headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(response.json), ['bucket/dir', 'bucket/file', 'bucket/missing?subdirectories=dir',
+                                                 'bucket/one?subdirectories=dir', 'bucket/two?subdirectories=dir'])
+        self.assertIn('/bucket/dir/two?', response.json['bucket/two?subdirectories=dir']['external_reference'])
+        self.assertIsNone(response.json['bucket/missing?subdirectories=dir'])
+        # Directories are not zipped
+        self.assertIsNone(response.json['bucket/dir'])
+        # One listing for each directory, rather than a head_object for each file
+        self.assertEqual(self.operations, ['ListObjectsV2', 'ListObjectsV2'])
+
+    @patch('storage_api.app.validate')
+    def test_get_file_external_urls_deduplicated(self, validate):
+        main.app.config['STORAGE_DEDUPLICATION'] = True
+        response = self.client.post(url_for('storage.save_file', bucket='bucket'),
+                                    data={'file': (io.BytesIO(b'test'), 'test.txt', 'text/plain')},
+                                    headers={'Authorization': 'Fake JWT'})
+        file_id = response.json['file'][0]['file_id']
+        S3StorageAdapter._metadata = None
+        self.operations.clear()
+
+        response = self.client.post(url_for('storage.get_file_external_urls', bucket='bucket'),
+                                    json={'files': [{'file_id': file_id}]}, headers={'Authorization': 'Fake JWT'})
+
+        result = response.json['bucket/{}'.format(file_id)]
+        self.assertIn('/content/{}?'.format(self.sha256), result['external_reference'])
+        self.assertEqual(result['etag'], self.sha256)
+        # The reference is empty, so it is looked up to find its content
+        self.assertEqual(self.operations, ['ListObjectsV2', 'HeadObject'])
+
+    @patch('storage_api.app.validate')
+    def test_delete_files(self, validate):
+        response = self.client.post(url_for('storage.delete_files', bucket='bucket'),
+                                    json={'files': [{'file_id': 'one', 'subdirectories': 'dir'},
+                                                    {'file_id': 'two', 'subdirectories': 'dir'},
+                                                    {'file_id': 'missing'}]},
+                                    headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([file['status'] for file in response.json['files']], ['deleted', 'deleted', 'not_found'])
+        self.assertEqual(self.operations, ['HeadObject', 'HeadObject', 'HeadObject', 'DeleteObjects'])
+        self.assertEqual([s3_object['Key'] for s3_object in self.connection.list_objects_v2(
+            Bucket=S3_BUCKET)['Contents']], ['bucket/file'])
+
+    @patch('storage_api.app.validate')
+    def test_delete_files_repeated(self, validate):
+        response = self.client.post(url_for('storage.delete_files', bucket='bucket'),
+                                    json={'files': [{'file_id': 'file'}, {'file_id': 'file'}]},
+                                    headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([file['status'] for file in response.json['files']], ['deleted', 'deleted'])
+        self.assertEqual(self.operations, ['HeadObject', 'DeleteObjects'])
+
+    @patch('storage_api.app.validate')
+    def test_delete_files_without_check(self, validate):
+        main.app.config['S3_DELETE_CHECK_EXISTS'] = False
+
+        response = self.client.post(url_for('storage.delete_files', bucket='bucket'),
+                                    json={'files': [{'file_id': 'file'}, {'file_id': 'one', 'subdirectories': 'dir'}]},
+                                    headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.operations, ['DeleteObjects'])
+
+    @patch('storage_api.app.validate')
+    def test_save_file(self, validate):
+        response = self.client.post(url_for('storage.save_file', bucket='bucket'),
+                                    data={'file': (io.BytesIO(b'test'), 'test.txt')},
+                                    headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.operations, ['PutObject'])
+
+    @patch('storage_api.app.validate')
+    def test_save_file_stream(self, validate):
+        main.app.config['UPLOAD_INGESTION_MODE'] = 'stream'
+
+        response = self.client.post(url_for('storage.save_file', bucket='bucket'),
+                                    data={'file': (io.BytesIO(b'test'), 'test.txt', 'text/plain')},
+                                    headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.operations, ['PutObject'])
+        key = 'bucket/{}'.format(response.json['file'][0]['file_id'])
+        s3_object = self.connection.get_object(Bucket=S3_BUCKET, Key=key)
+        self.assertEqual(s3_object['Body'].read(), b'test')
+        self.assertEqual(s3_object['Metadata'], {'file-name': 'test.txt', 'content-type': 'text/plain',
+                                                 'sha256': self.sha256})
+
+    @patch('storage_api.app.validate')
+    def test_save_file_multipart(self, validate):
+        main.app.config.update(S3_MULTIPART_THRESHOLD=PART_SIZE, S3_MULTIPART_CHUNKSIZE=PART_SIZE)
+        content = os.urandom(PART_SIZE * 2 + 1)
+
+        response = self.client.post(url_for('storage.save_file', bucket='bucket'),
+                                    data={'file': (io.BytesIO(content), 'test.bin')},
+                                    headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(sorted(self.operations), ['CompleteMultipartUpload', 'CreateMultipartUpload',
+                                                   'UploadPart', 'UploadPart', 'UploadPart'])
+        key = 'bucket/{}'.format(response.json['file'][0]['file_id'])
+        metadata = self.connection.head_object(Bucket=S3_BUCKET, Key=key)['Metadata']
+        self.assertEqual(metadata['file-name'], 'test.bin')
+        self.assertEqual(metadata['sha256'], hashlib.sha256(content).hexdigest())
+
+    @patch('storage_api.app.validate')
+    def test_save_file_multipart_aborted(self, validate):
+        main.app.config.update(S3_MULTIPART_THRESHOLD=PART_SIZE, S3_MULTIPART_CHUNKSIZE=PART_SIZE)
+        self.connection.meta.events.register('before-call.s3.UploadPart', self.fail_upload_part)
+
+        response = self.client.post(url_for('storage.save_file', bucket='bucket'),
+                                    data={'file': (io.BytesIO(os.urandom(PART_SIZE * 2)), 'test.bin')},
+                                    headers={'Authorization': 'Fake JWT'})
+
+        self.assertEqual(response.status_code, 500)
+        self.assertIn('AbortMultipartUpload', self.operations)
+        self.assertNotIn('Uploads', self.connection.list_multipart_uploads(Bucket=S3_BUCKET))
+
+    @patch('storage_api.app.validate')
+    def test_save_file_deduplicated(self, validate):
+        main.app.config['STORAGE_DEDUPLICATION'] = True
+
+        file_ids = []
+        for name, content_type in (('first.txt', 'text/plain'), ('second.csv', 'text/csv')):
+            response = self.client.post(url_for('storage.save_file', bucket='bucket'),
+                                        data={'file': (io.BytesIO(b'test'), name, content_type)},
+                                        headers={'Authorization': 'Fake JWT'})
+            self.assertEqual(response.status_code, 201)
+            file_ids.append(response.json['file'][0]['file_id'])
+
+        # The content is only uploaded once, the second file is a reference to it
+        self.assertEqual(self.operations, ['PutObject', 'HeadObject', 'PutObject', 'PutObject', 'HeadObject',
+                                           'PutObject', 'HeadObject', 'PutObject', 'HeadObject'])
+        content = self.connection.get_object(Bucket=S3_BUCKET, Key='content/{}'.format(self.sha256))
+        self.assertEqual(content['Body'].read(), b'test')
+        reference = self.connection.head_object(Bucket=S3_BUCKET, Key='bucket/{}'.format(file_ids[1]))
+        self.assertEqual(reference['ContentLength'], 0)
+        self.assertEqual(reference['Metadata']['content-key'], 'content/{}'.format(self.sha256))
+
+        S3StorageAdapter._metadata = None
+        response = self.client.get(url_for('storage.get_file', bucket='bucket', file_id=file_ids[1]))
+        self.assertEqual(response.data, b'test')
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(response.headers['ETag'], '"{}"'.format(self.sha256))
+
+        # The content is kept until its last reference is deleted
+        self.client.delete(url_for('storage.delete_file', bucket='bucket', file_id=file_ids[0]),
+                           headers={'Authorization': 'Fake JWT'})
+        self.assertEqual(self.list_content_keys(), ['content-references/{}/bucket/{}'.format(self.sha256, file_ids[1]),
+                                                    'content/{}'.format(self.sha256)])
+        self.client.delete(url_for('storage.delete_file', bucket='bucket', file_id=file_ids[1]),
+                           headers={'Authorization': 'Fake JWT'})
+        self.assertEqual(self.list_content_keys(), [])
+
+    @patch('storage_api.app.validate')
+    def test_deduplicated_content_not_a_bucket(self, validate):
+        main.app.config['STORAGE_DEDUPLICATION'] = True
+        self.client.post(url_for('storage.save_file', bucket='bucket'),
+                         data={'file': (io.BytesIO(b'test'), 'first.txt', 'text/plain')},
+                         headers={'Authorization': 'Fake JWT'})
+        self.operations.clear()
+
+        get_response = self.client.get(url_for('storage.get_file', bucket='content', file_id=self.sha256))
+        delete_response = self.client.delete(url_for('storage.delete_file', bucket='content', file_id=self.sha256),
+                                             headers={'Authorization': 'Fake JWT'})
+        references_response = self.client.get(url_for('storage.get_file', bucket='content-references',
+                                                      file_id=self.sha256))
+
+        self.assertEqual([get_response.status_code, delete_response.status_code, references_response.status_code],
+                         [404, 404, 404])
+        self.assertEqual(self.operations, [])
+        self.assertIn('content/{}'.format(self.sha256), self.list_content_keys())
+
+    @patch('storage_api.app.validate')
+    def test_get_file_deduplicated_content_missing(self, validate):
+        main.app.config['STORAGE_DEDUPLICATION'] = True
+        response = self.client.post(url_for('storage.save_file', bucket='bucket'),
+                                    data={'file': (io.BytesIO(b'test'), 'first.txt', 'text/plain')},
+                                    headers={'Authorization': 'Fake JWT'})
+        file_id = response.json['file'][0]['file_id']
+        self.connection.delete_object(Bucket=S3_BUCKET, Key='content/{}'.format(self.sha256))
+
+        for cached in (True, False):
+            if not cached:
+                S3StorageAdapter._metadata = None
+            response = self.client.get(url_for('storage.get_file', bucket='bucket', file_id=file_id))
+
+            self.assertEqual(response.status_code, 500)
+            # The reference exists, so it isn't cached as missing
+            self.assertIsNone(S3StorageAdapter.get_metadata_cache().get(('file', 'bucket/' + file_id)))
+
+        self.operations.clear()
+        response = self.client.get(url_for('storage.get_file', bucket='bucket', file_id=file_id))
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.operations, ['GetObject', 'GetObject'])
+
+        # A directory holding the reference can't be zipped either, rather than ending the archive early
+        self.connection.copy_object(Bucket=S3_BUCKET, Key='bucket/dir/three',
+                                    CopySource={'Bucket': S3_BUCKET, 'Key': 'bucket/' + file_id})
+        response = self.client.get(url_for('storage.get_file', bucket='bucket', file_id='dir'))
+        with self.assertRaises(ApplicationError):
+            response.get_data()
+
+    @patch('storage_api.app.validate')
+    def test_save_file_deduplicated_during_delete(self, validate):
+        main.app.config['STORAGE_DEDUPLICATION'] = True
+        response = self.client.post(url_for('storage.save_file', bucket='bucket'),
+                                    data={'file': (io.BytesIO(b'test'), 'first.txt', 'text/plain')},
+                                    headers={'Authorization': 'Fake JWT'})
+        first_key = 'bucket/{}'.format(response.json['file'][0]['file_id'])
+        content_key = 'content/{}'.format(self.sha256)
+        references_prefix = 'content-references/{}/'.format(self.sha256)
+        steps = []
+
+        # Interleaves a delete of the first file's reference with the save of a second file with the same content.
+        # The delete lists the references before the save's is recorded, then deletes the content after the save
+        # has found it.
+        def before_put_object(params, **kwargs):
+            if not steps and params['Key'].startswith(references_prefix):
+                steps.append('delete listed')
+                self.connection.delete_object(Bucket=S3_BUCKET, Key=references_prefix + first_key)
+                listed = self.connection.list_objects_v2(Bucket=S3_BUCKET, Prefix=references_prefix, MaxKeys=1)
+                self.assertNotIn('Contents', listed)
+
+        def after_head_object(**kwargs):
+            if steps == ['delete listed']:
+                steps.append('content deleted')
+                self.connection.delete_object(Bucket=S3_BUCKET, Key=content_key)
+
+        self.connection.meta.events.register('before-parameter-build.s3.PutObject', before_put_object)
+        self.connection.meta.events.register('after-call.s3.HeadObject', after_head_object)
+        response = self.client.post(url_for('storage.save_file', bucket='bucket'),
+                                    data={'file': (io.BytesIO(b'test'), 'second.txt', 'text/plain')},
+                                    headers={'Authorization': 'Fake JWT'})
+        self.connection.delete_object(Bucket=S3_BUCKET, Key=first_key)
+
+        self.assertEqual(steps, ['delete listed', 'content deleted'])
+        # The save found the content gone once its reference was recorded, and uploaded it again
+        S3StorageAdapter._metadata = None
+        response = self.client.get(url_for('storage.get_file', bucket='bucket',
+                                           file_id=response.json['file'][0]['file_id']))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'test')
+
+    @patch('storage_api.app.validate')
+    def test_get_file_external_url_deduplicated(self, validate):
+        main.app.config['STORAGE_DEDUPLICATION'] = True
+        response = self.client.post(url_for('storage.save_file', bucket='bucket'),
+                                    data={'file': (io.BytesIO(b'test'), 'test.txt', 'text/plain')},
+                                    headers={'Authorization': 'Fake JWT'})
+        S3StorageAdapter._metadata = None
+
+        response = self.client.get(url_for('storage.get_file_external_url', bucket='bucket',
+                                           file_id=response.json['file'][0]['file_id']))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('/content/{}?'.format(self.sha256), response.json['external_reference'])
+        self.assertIn('response-content-type=text%2Fplain', response.json['external_reference'])
+
+    def list_content_keys(self):
+        response = self.connection.list_objects_v2(Bucket=S3_BUCKET, Prefix='content')
+        return [s3_object['Key'] for s3_object in response.get('Contents', [])]
+
+    @staticmethod
+    def fail_upload_part(**kwargs):
+        raise ConnectionError('connection lost')